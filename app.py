@@ -1,10 +1,17 @@
 # app.py
+import os
+import time
+import uuid
+
 import streamlit as st
 import pandas as pd
 import networkx as nx
 import matplotlib.pyplot as plt
 
 import qle_backend as qle
+import qle_advisor
+import qle_layout
+from qle_columnar import ColumnarResult
 
 st.set_page_config(layout="wide", page_title="Query Lineage Exploration")
 st.title("Query Lineage Exploration (QLE)")
@@ -22,10 +29,56 @@ if "last_result_cols" not in st.session_state:
     st.session_state["last_result_cols"] = None
 if "last_result_qid" not in st.session_state:
     st.session_state["last_result_qid"] = None
+if "last_result_page" not in st.session_state:
+    st.session_state["last_result_page"] = 0
+
+# Page of the selected query's saved result snapshot being shown
+if "snapshot_page" not in st.session_state:
+    st.session_state["snapshot_page"] = (None, 0)
+
+# Keyset cursor for the history panel: None = newest page
+if "history_cursor" not in st.session_state:
+    st.session_state["history_cursor"] = None
+
+# Each session keeps at most one result stream (and pooled connection) open
+if "stream_owner" not in st.session_state:
+    st.session_state["stream_owner"] = uuid.uuid4().hex
+
+# Background query job (qle.submit_query) the editor is waiting on
+if "active_job" not in st.session_state:
+    st.session_state["active_job"] = None
+
+HISTORY_PAGE_SIZE = 50
+JOB_POLL_INTERVAL = 0.5  # seconds between reruns while a query is running
+poll_job = False
+
+
+def _clear_last_result():
+    # Streams hold a pooled connection open; give it back before forgetting them
+    prev = st.session_state.get("last_result_rows")
+    if isinstance(prev, qle.ResultStream):
+        prev.close()
+    st.session_state["last_result_rows"] = None
+    st.session_state["last_result_cols"] = None
+    st.session_state["last_result_qid"] = None
+    st.session_state["last_result_page"] = 0
+
+
+def _result_frame(rows, cols):
+    # Columnar results wrap their arrays (built once, reused across reruns)
+    if isinstance(rows, ColumnarResult):
+        return rows.to_pandas()
+    return pd.DataFrame(rows, columns=cols)
+
 
 # Try to fetch history to check DB connection
 try:
-    history = qle.get_query_history(limit=50)
+    cursor = st.session_state["history_cursor"] or {}
+    history = qle.get_query_history_page(limit=HISTORY_PAGE_SIZE, **cursor)
+    if not history and cursor:
+        # Paged past the end (e.g. after deletions): fall back to the newest page
+        st.session_state["history_cursor"] = None
+        history = qle.get_query_history_page(limit=HISTORY_PAGE_SIZE)
     db_error = None
 except Exception as e:
     history = []
@@ -53,12 +106,29 @@ with left_col:
                         "executed_at",
                         "runtime_ms",
                         "row_count",
+                        "status",
                         "tables",
                         "error_message",
                     ]
                 ]
             )
 
+            col_newer, col_older = st.columns(2)
+            with col_newer:
+                if st.button(
+                    "Newer", disabled=st.session_state["history_cursor"] is None
+                ):
+                    st.session_state["history_cursor"] = {
+                        "after_query_id": history[0]["query_id"]
+                    }
+                    st.rerun()
+            with col_older:
+                if st.button("Older", disabled=len(history) < HISTORY_PAGE_SIZE):
+                    st.session_state["history_cursor"] = {
+                        "before_query_id": history[-1]["query_id"]
+                    }
+                    st.rerun()
+
             selected_id = st.selectbox(
                 "Select query to inspect",
                 options=[row["query_id"] for row in history],
@@ -72,19 +142,31 @@ with center_col:
     if db_error:
         st.error("No lineage: database connection failed.")
     else:
-        nodes, edges = qle.get_lineage_graph()
-        if nodes:
-            G = nx.DiGraph()
-            node_ids = [n["query_id"] for n in nodes]
-            G.add_nodes_from(node_ids)
-
-            for e in edges:
-                G.add_edge(e["parent_query_id"], e["child_query_id"])
-
-            pos = nx.spring_layout(G, seed=42)
+        # Process-wide cached graph; only new/deleted queries are re-fetched
+        G, graph_version = qle.get_lineage_digraph()
+        if G.number_of_nodes():
+            layout_mode = st.radio(
+                "Layout",
+                options=qle_layout.LAYOUT_MODES,
+                format_func=lambda m: {
+                    "incremental": "Incremental (force)",
+                    "hierarchical": "Hierarchical (DAG)",
+                }[m],
+                horizontal=True,
+            )
+            # Positions are cached per graph version; new queries are placed
+            # next to their parents instead of re-running the whole layout
+            pos = qle_layout.layout(G, graph_version, mode=layout_mode)
 
             fig, ax = plt.subplots()
-            nx.draw(G, pos, with_labels=True, ax=ax, arrows=True)
+            # Edges proposed by similarity inference are drawn dashed, edges
+            # from a query to its replays dotted
+            line_styles = {"inferred": "dashed", "rerun": "dotted"}
+            edge_style = [
+                line_styles.get(d.get("edge_type"), "solid")
+                for _, _, d in G.edges(data=True)
+            ]
+            nx.draw(G, pos, with_labels=True, ax=ax, arrows=True, style=edge_style)
             st.pyplot(fig)
         else:
             st.write("No lineage yet. Run some queries.")
@@ -104,11 +186,40 @@ with right_col:
             st.markdown(
                 f"**Results for last run query Q{st.session_state['last_result_qid']}**"
             )
-            df_last = pd.DataFrame(
-                st.session_state["last_result_rows"],
-                columns=st.session_state["last_result_cols"],
-            )
-            st.dataframe(df_last.head(50), use_container_width=True)
+            last_rows = st.session_state["last_result_rows"]
+            if isinstance(last_rows, qle.ResultStream):
+                page = st.session_state["last_result_page"]
+                try:
+                    df_last = _result_frame(
+                        last_rows.page(page), st.session_state["last_result_cols"]
+                    )
+                    st.dataframe(df_last, use_container_width=True)
+
+                    total = last_rows.row_count
+                    st.caption(
+                        f"Page {page + 1}"
+                        + (f" of {last_rows.num_pages()} ({total} rows)" if total is not None else "")
+                    )
+                    col_prev, col_next = st.columns(2)
+                    with col_prev:
+                        if st.button("Previous page", disabled=page == 0):
+                            st.session_state["last_result_page"] = page - 1
+                            st.rerun()
+                    with col_next:
+                        if st.button(
+                            "Next page",
+                            disabled=len(df_last) < last_rows.page_size,
+                        ):
+                            st.session_state["last_result_page"] = page + 1
+                            st.rerun()
+                except RuntimeError:
+                    st.caption("Result cursor expired; re-run the query to browse it again.")
+            else:
+                if isinstance(last_rows, ColumnarResult):
+                    # Slice before converting: only the shown rows reach pandas
+                    last_rows = last_rows.slice(0, 50)
+                df_last = _result_frame(last_rows, st.session_state["last_result_cols"])
+                st.dataframe(df_last.head(50), use_container_width=True)
         else:
             st.caption("Run a query to see results here.")
 
@@ -125,8 +236,23 @@ with right_col:
                 f"Rows: {q_details['row_count']}"
             )
             st.write(f"Tables: {tables}")
+            if q_details.get("phase_us"):
+                st.caption(
+                    "Phases: "
+                    + ", ".join(
+                        f"{phase} {us / 1000:.2f} ms"
+                        for phase, us in q_details["phase_us"].items()
+                    )
+                )
             if q_details["error_message"]:
                 st.error(f"Error: {q_details['error_message']}")
+            if q_details.get("cache_hit"):
+                st.caption("Answered from the result cache.")
+            if q_details.get("served_by_view_id"):
+                st.caption(
+                    f"Rewritten onto pinned view #{q_details['served_by_view_id']} "
+                    f"(est. {q_details['est_saved_ms']} ms saved)"
+                )
 
             if pinned:
                 st.success(
@@ -134,6 +260,118 @@ with right_col:
                     f"({pinned['storage_bytes']} bytes)"
                 )
 
+            snapshot = qle.get_result_snapshot(selected_id)
+            if snapshot is not None:
+                with st.expander(f"Saved result ({snapshot.row_count} rows)"):
+                    snap_qid, snap_page = st.session_state["snapshot_page"]
+                    if snap_qid != selected_id:
+                        snap_page = 0
+                    st.dataframe(
+                        snapshot.page(snap_page).to_pandas(), use_container_width=True
+                    )
+                    st.caption(f"Page {snap_page + 1} of {snapshot.num_pages()}")
+                    col_sp, col_sn = st.columns(2)
+                    with col_sp:
+                        if st.button("Previous", key="snap_prev", disabled=snap_page == 0):
+                            st.session_state["snapshot_page"] = (selected_id, snap_page - 1)
+                            st.rerun()
+                    with col_sn:
+                        if st.button(
+                            "Next",
+                            key="snap_next",
+                            disabled=snap_page + 1 >= snapshot.num_pages(),
+                        ):
+                            st.session_state["snapshot_page"] = (selected_id, snap_page + 1)
+                            st.rerun()
+
+            with st.expander("Query plan"):
+                plan = qle.get_query_plan(selected_id)
+                if st.button("Capture plan (EXPLAIN ANALYZE)"):
+                    try:
+                        qle.capture_query_plan(selected_id)
+                        plan = qle.get_query_plan(selected_id)
+                    except Exception as e:
+                        st.error(f"Failed to capture plan: {e}")
+                if plan is None:
+                    st.write("No plan captured for this query.")
+                else:
+                    st.caption(f"Captured {plan['captured_at']}")
+                    st.json(plan["summary"], expanded=False)
+
+                # Diff against a parent in the lineage graph
+                parents = sorted(G.predecessors(selected_id)) if selected_id in G else []
+                if parents:
+                    diff_parent = st.selectbox(
+                        "Diff against parent",
+                        options=parents,
+                        format_func=lambda qid: f"Q{qid}",
+                    )
+                    if st.button("Diff plans"):
+                        try:
+                            st.json(
+                                qle.get_plan_diff(
+                                    diff_parent, selected_id, capture_missing=True
+                                )
+                            )
+                        except Exception as e:
+                            st.error(f"Failed to diff plans: {e}")
+
+            with st.expander("Export result"):
+                # The export streams to a file on the server; the download
+                # button then serves that file
+                col_ef, col_ec = st.columns(2)
+                with col_ef:
+                    export_fmt = st.radio(
+                        "Format", qle.EXPORT_FORMATS, horizontal=True, key="export_fmt"
+                    )
+                with col_ec:
+                    export_gzip = st.checkbox("gzip", key="export_gzip")
+                if st.button("Export"):
+                    try:
+                        st.session_state["export_result"] = (
+                            selected_id,
+                            qle.export_query(
+                                selected_id,
+                                fmt=export_fmt,
+                                compression="gzip" if export_gzip else None,
+                            ),
+                        )
+                    except Exception as e:
+                        st.error(f"Export failed: {e}")
+                export_for, export = st.session_state.get("export_result", (None, None))
+                if export_for == selected_id and os.path.exists(export["path"]):
+                    st.caption(
+                        f"{export['rows']} rows, {export['bytes']} bytes in "
+                        f"{export['runtime_ms']:.0f} ms (logged as Q{export['query_id']})"
+                    )
+                    with open(export["path"], "rb") as f:
+                        st.download_button(
+                            "Download", f, file_name=os.path.basename(export["path"])
+                        )
+
+            with st.expander("Replay branch"):
+                st.caption(
+                    "Re-run this query and everything derived from it, "
+                    "independent queries in parallel, and compare runtimes."
+                )
+                if st.button("Replay"):
+                    try:
+                        with st.spinner("Replaying..."):
+                            st.session_state["replay_result"] = qle.replay_branch(selected_id)
+                    except Exception as e:
+                        st.error(f"Replay failed: {e}")
+                replay = st.session_state.get("replay_result")
+                if replay is not None and replay["root_query_id"] == selected_id:
+                    st.write(
+                        f"Replayed {replay['replayed']} queries in {replay['wall_ms']:.0f} ms "
+                        f"({replay['skipped']} skipped, {replay['failed']} failed). "
+                        f"Total runtime {replay['original_total_ms']:.0f} ms originally, "
+                        f"{replay['rerun_total_ms']:.0f} ms now."
+                    )
+                    st.dataframe(
+                        pd.DataFrame(replay["queries"]), use_container_width=True
+                    )
+
             # Buttons for selected query
             col_a, col_b, col_c = st.columns(3)
 
@@ -172,6 +410,15 @@ with right_col:
                         st.rerun()
                     except Exception as e:
                         st.error(f"Failed to delete query: {e}")
+                if st.button("Delete with derived queries"):
+                    try:
+                        deleted = qle.delete_subtree(selected_id)
+                        st.success(f"Deleted {len(deleted)} queries.")
+                        st.session_state["sql_input"] = ""
+                        st.session_state["parent_ids"] = []
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Failed to delete queries: {e}")
 
         st.markdown("---")
         st.markdown("**New / Modified Query**")
@@ -193,32 +440,58 @@ with right_col:
         )
         st.session_state["sql_input"] = sql_input  # keep in sync
 
-        # Run query button — store results and rerun so history/graph refresh
-        if st.button("Run query"):
+        timeout_s = st.number_input(
+            "Statement timeout (seconds, 0 = none)", min_value=0, value=0
+        )
+
+        job_id = st.session_state["active_job"]
+        job = qle.get_job(job_id) if job_id is not None else None
+        if job_id is not None and job is None:
+            st.session_state["active_job"] = None
+        elif job is not None and not job.done:
+            # The query runs on a worker; rerun periodically to show progress
+            st.info(f"Job {job.job_id} {job.status} for {job.elapsed():.1f} s …")
+            if st.button("Cancel query", disabled=job.cancel_requested):
+                qle.cancel_query(job.job_id)
+                st.rerun()
+            poll_job = True
+        elif job is not None:
+            st.session_state["active_job"] = None
+            if job.exception is not None:
+                st.error(f"Error executing query: {job.exception}")
+            else:
+                qid, rows, cols, err = job.result
+                if job.status in ("cancelled", "timeout"):
+                    st.warning(f"Query Q{qid} {job.status}.")
+                elif err:
+                    st.error(f"Query Q{qid} failed: {err}")
+                else:
+                    st.success(f"Query Q{qid} succeeded.")
+                    # Save results so they persist across reruns
+                    st.session_state["last_result_rows"] = rows
+                    st.session_state["last_result_cols"] = cols
+                    st.session_state["last_result_qid"] = qid
+
+                # Refresh UI (history + graph) while keeping last_result_*
+                st.session_state["history_cursor"] = None
+                st.rerun()
+
+        # Run query button — submit to a worker and poll until it finishes
+        if st.button("Run query", disabled=st.session_state["active_job"] is not None):
             if not sql_input.strip():
                 st.warning("Please enter SQL.")
             else:
                 try:
-                    qid, rows, cols, err = qle.run_query(
-                        sql_input, parent_query_ids=st.session_state["parent_ids"]
+                    _clear_last_result()
+                    st.session_state["active_job"] = qle.submit_query(
+                        sql_input,
+                        parent_query_ids=st.session_state["parent_ids"],
+                        stream=True,
+                        statement_timeout_ms=int(timeout_s * 1000) or None,
+                        stream_owner=st.session_state["stream_owner"],
                     )
                     # After using parent_ids once, clear them by default
                     st.session_state["parent_ids"] = []
-
-                    if err:
-                        st.error(f"Query Q{qid} failed: {err}")
-                        # Clear last result on failure
-                        st.session_state["last_result_rows"] = None
-                        st.session_state["last_result_cols"] = None
-                        st.session_state["last_result_qid"] = None
-                    else:
-                        st.success(f"Query Q{qid} succeeded.")
-                        # Save results so they persist across reruns
-                        st.session_state["last_result_rows"] = rows
-                        st.session_state["last_result_cols"] = cols
-                        st.session_state["last_result_qid"] = qid
-
-                    # Refresh UI (history + graph) while keeping last_result_*
                     st.rerun()
                 except Exception as e:
                     st.error(f"Error executing query: {e}")
@@ -235,12 +508,17 @@ with right_col:
                     with st.expander(
                         f"{pv['view_name']} (from Q{pv['query_id']})"
                     ):
-                        st.write(f"Created: {pv['created_at']}")
+                        st.write(f"Created: {pv['created_at']} (by {pv['pinned_by']})")
                         st.write(f"Storage: {pv['storage_bytes']} bytes")
+                        if pv["refreshed_at"] is not None:
+                            st.write(
+                                f"Last refreshed: {pv['refreshed_at']} "
+                                f"({pv['refresh_ms']} ms)"
+                            )
                         st.markdown("**Originating SQL:**")
                         st.code(pv["sql_text"], language="sql")
 
-                        col_v1, col_v2 = st.columns(2)
+                        col_v1, col_v2, col_v3 = st.columns(3)
 
                         # Preview button
                         with col_v1:
@@ -273,18 +551,171 @@ with right_col:
                                 st.session_state["parent_ids"] = []
                                 st.rerun()
 
+                        with col_v3:
+                            if st.button(
+                                "Refresh now",
+                                key=f"refresh_{pv['view_id']}",
+                            ):
+                                try:
+                                    qle.refresh_pinned_view(pv["view_id"])
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"Failed to refresh view: {e}")
+
+                        if st.button(
+                            "Export as CSV (gzip)",
+                            key=f"export_{pv['view_id']}",
+                        ):
+                            try:
+                                export = qle.export_view(pv["view_id"], compression="gzip")
+                                with open(export["path"], "rb") as f:
+                                    st.download_button(
+                                        "Download",
+                                        f,
+                                        file_name=os.path.basename(export["path"]),
+                                        key=f"download_{pv['view_id']}",
+                                    )
+                            except Exception as e:
+                                st.error(f"Failed to export view: {e}")
+
         st.markdown("---")
         st.subheader("Maintenance")
 
+        with st.expander("Connection pool stats"):
+            st.json(qle.pool_stats())
+
+        with st.expander("Metrics"):
+            if st.button("Serve metrics for scraping"):
+                try:
+                    server = qle.start_metrics_server()
+                    host, port = server.server_address[:2]
+                    st.success(f"Serving http://{host}:{port}/metrics and /metrics.json")
+                except OSError as e:
+                    st.error(f"Could not start metrics server: {e}")
+            st.json(qle.metrics_snapshot(), expanded=False)
+
+        with st.expander("Result snapshots"):
+            enabled = qle.snapshot_stats()["enabled"]
+            if st.checkbox("Save results to disk", value=enabled) != enabled:
+                if enabled:
+                    qle.disable_snapshots()
+                else:
+                    qle.enable_snapshots()
+                st.rerun()
+            st.json(qle.snapshot_stats())
+
+        with st.expander("Log partitions & retention"):
+            try:
+                partitions = qle.list_partitions()
+                if partitions:
+                    st.dataframe(pd.DataFrame(partitions), use_container_width=True)
+                retention_days = st.number_input(
+                    "Archive months older than (days)",
+                    min_value=1,
+                    value=qle.RETENTION_DAYS or 180,
+                )
+                col_r1, col_r2 = st.columns(2)
+                with col_r1:
+                    retention_dry_run = st.button("Preview retention")
+                with col_r2:
+                    retention_apply = st.button("Archive old months")
+                if retention_dry_run or retention_apply:
+                    report = qle.apply_retention(
+                        max_age_days=retention_days, dry_run=not retention_apply
+                    )
+                    st.json(report, expanded=False)
+            except Exception as e:
+                st.error(f"Retention failed: {e}")
+
+        with st.expander("Query shapes"):
+            shape_order = st.selectbox(
+                "Sort by",
+                options=["total", "p95", "mean", "executions", "last_seen"],
+                format_func=lambda o: {
+                    "total": "Total runtime",
+                    "p95": "p95 runtime",
+                    "mean": "Mean runtime",
+                    "executions": "Executions",
+                    "last_seen": "Last seen",
+                }[o],
+            )
+            shapes = qle.get_fingerprint_stats(order_by=shape_order, limit=20)
+            if shapes:
+                st.dataframe(pd.DataFrame(shapes), use_container_width=True)
+            else:
+                st.write("No queries logged yet.")
+
+        with st.expander("Lineage inference"):
+            enabled = qle.inference_stats()["enabled"]
+            threshold = st.slider(
+                "Similarity threshold",
+                min_value=0.3,
+                max_value=1.0,
+                value=qle.INFERENCE_THRESHOLD,
+                step=0.05,
+                disabled=enabled,
+            )
+            if st.checkbox("Propose parents for unlinked queries", value=enabled) != enabled:
+                if enabled:
+                    qle.disable_lineage_inference()
+                else:
+                    qle.enable_lineage_inference(threshold=threshold)
+                st.rerun()
+            if enabled and st.button("Infer parents for existing queries"):
+                try:
+                    proposals = qle.infer_lineage()
+                    st.success(f"Added {len(proposals)} inferred edges.")
+                    if proposals:
+                        st.dataframe(pd.DataFrame(proposals), use_container_width=True)
+                except Exception as e:
+                    st.error(f"Inference failed: {e}")
+            st.json(qle.inference_stats())
+
+        with st.expander("Pinned view refresh"):
+            running = qle.refresh_stats()["running"]
+            if st.checkbox("Refresh stale views in the background", value=running) != running:
+                if running:
+                    qle.stop_refresh_scheduler()
+                else:
+                    qle.start_refresh_scheduler()
+                st.rerun()
+            st.json(qle.refresh_stats())
+            stale = qle.get_stale_views()
+            if stale:
+                st.write("Stale views:")
+                st.dataframe(pd.DataFrame(stale), use_container_width=True)
+            else:
+                st.write("All pinned views are up to date.")
+
+        with st.expander("View advisor"):
+            budget_mb = st.number_input(
+                "Storage budget (MB)",
+                min_value=1,
+                value=qle_advisor.ADVISOR_CONFIG["storage_budget_bytes"] >> 20,
+            )
+            col_a1, col_a2 = st.columns(2)
+            with col_a1:
+                dry_run = st.button("Dry run")
+            with col_a2:
+                apply_plan = st.button("Apply")
+            if dry_run or apply_plan:
+                try:
+                    report = qle_advisor.advise(
+                        dry_run=not apply_plan,
+                        storage_budget_bytes=int(budget_mb) << 20,
+                    )
+                    st.text(qle_advisor.format_report(report))
+                except Exception as e:
+                    st.error(f"Advisor failed: {e}")
+
         # Clear ALL history button
         if st.button("⚠ Clear ALL QLE history (irreversible)"):
             try:
+                # Release any open result cursor first so DROP VIEW can't block on it
+                _clear_last_result()
                 qle.clear_history()
                 st.session_state["sql_input"] = ""
                 st.session_state["parent_ids"] = []
-                st.session_state["last_result_rows"] = None
-                st.session_state["last_result_cols"] = None
-                st.session_state["last_result_qid"] = None
                 st.success(
                     "Cleared all query history, lineage, and pinned views. "
                     "Note: underlying IMDB tables are untouched."
@@ -292,3 +723,7 @@ with right_col:
                 st.rerun()
             except Exception as e:
                 st.error(f"Failed to clear history: {e}")
+
+if poll_job:
+    time.sleep(JOB_POLL_INTERVAL)
+    st.rerun()
@@ -1,34 +1,387 @@
 CREATE SCHEMA IF NOT EXISTS qle;
 
--- One row per query execution
+-- Databases created before the query log was partitioned: set the old heap
+-- tables aside; their rows are copied into the partitioned tables below
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('qle.query') AND relkind = 'r') THEN
+        ALTER TABLE qle.query RENAME TO legacy_query;
+        ALTER TABLE qle.query_table RENAME TO legacy_query_table;
+        ALTER TABLE qle.edge RENAME TO legacy_edge;
+        ALTER INDEX qle.query_pkey RENAME TO legacy_query_pkey;
+        ALTER SEQUENCE qle.query_query_id_seq RENAME TO legacy_query_query_id_seq;
+        DROP INDEX IF EXISTS qle.query_executed_at_idx,
+                             qle.query_pinned_view_id_idx,
+                             qle.query_fingerprint_idx,
+                             qle.query_table_query_id_idx,
+                             qle.edge_parent_query_id_idx,
+                             qle.edge_child_query_id_idx;
+    END IF;
+END
+$$;
+
+-- Statement texts, stored once however often they are run; qle.query
+-- rows point here by md5 of the text
+CREATE TABLE IF NOT EXISTS qle.sql_text (
+    sql_hash TEXT PRIMARY KEY,   -- md5(sql_text)
+    sql_text TEXT NOT NULL
+);
+
+-- One row per query execution. The log is partitioned by month of
+-- executed_at (see qle.ensure_partitions); query_table and edge rows live
+-- in the partition of their query, so retention can detach a month at once.
 CREATE TABLE IF NOT EXISTS qle.query (
-    query_id       SERIAL PRIMARY KEY,
+    query_id       SERIAL,
     executed_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    sql_text       TEXT NOT NULL,
+    sql_hash       TEXT NOT NULL REFERENCES qle.sql_text (sql_hash),
+    fingerprint    TEXT,          -- hash of the literal-stripped statement (qle_sql)
     runtime_ms     INTEGER,
+    runtime_us     BIGINT,        -- execute + fetch, from perf_counter_ns
+    phase_us       JSONB,         -- {"connect": .., "execute": .., "fetch": .., ...} in microseconds
     row_count      BIGINT,
     error_message  TEXT,          -- NULL if successful
-    pinned_view_id INTEGER        -- FK to qle.pinned_view, nullable
-);
+    status         TEXT NOT NULL DEFAULT 'ok',  -- 'ok', 'error', 'cancelled', 'timeout'
+    cache_hit      BOOLEAN NOT NULL DEFAULT FALSE,  -- answered from the result cache
+    served_by_view_id INTEGER,    -- pinned view the query was rewritten onto, if any
+    est_saved_ms   INTEGER,       -- estimated time saved by that rewrite
+    pinned_view_id INTEGER,       -- FK to qle.pinned_view, nullable
+    PRIMARY KEY (query_id, executed_at)
+) PARTITION BY RANGE (executed_at);
 
 -- Base tables referenced by each query (coarse provenance)
 CREATE TABLE IF NOT EXISTS qle.query_table (
-    query_id   INTEGER REFERENCES qle.query(query_id) ON DELETE CASCADE,
-    table_name TEXT NOT NULL
-);
+    query_id    INTEGER NOT NULL,
+    executed_at TIMESTAMPTZ NOT NULL,  -- the query's, so the row shares its partition
+    table_name  TEXT NOT NULL,
+    FOREIGN KEY (query_id, executed_at)
+        REFERENCES qle.query (query_id, executed_at) ON DELETE CASCADE
+) PARTITION BY RANGE (executed_at);
 
--- Lineage edges: which query came from which
+-- Lineage edges: which query came from which. Stored with the child; the
+-- parent has no FK because it may have been archived by retention (see
+-- qle.archived_query), and delete_queries removes its edges explicitly.
 CREATE TABLE IF NOT EXISTS qle.edge (
-    parent_query_id INTEGER REFERENCES qle.query(query_id) ON DELETE CASCADE,
-    child_query_id  INTEGER REFERENCES qle.query(query_id) ON DELETE CASCADE,
-    edge_type       TEXT NOT NULL   -- 'derived', 'rerun', etc.
+    parent_query_id   INTEGER NOT NULL,
+    child_query_id    INTEGER NOT NULL,
+    child_executed_at TIMESTAMPTZ NOT NULL,
+    edge_type         TEXT NOT NULL,   -- 'derived', 'rerun', 'inferred' (proposed by similarity), 'export', etc.
+    FOREIGN KEY (child_query_id, child_executed_at)
+        REFERENCES qle.query (query_id, executed_at) ON DELETE CASCADE
+) PARTITION BY RANGE (child_executed_at);
+
+-- Transitive closure of qle.edge: one row per (ancestor, descendant) pair,
+-- including each query with itself at depth 0; depth = fewest edges between them.
+-- No FKs (qle.query's key includes executed_at): delete_queries and
+-- retention keep it in step, and rows from archived ancestors are kept.
+CREATE TABLE IF NOT EXISTS qle.lineage_closure (
+    ancestor_id   INTEGER NOT NULL,
+    descendant_id INTEGER NOT NULL,
+    depth         INTEGER NOT NULL,
+    PRIMARY KEY (ancestor_id, descendant_id)
+);
+
+-- Queries archived by retention that still have descendants in the log, so
+-- lineage crossing the retention boundary stays resolvable
+CREATE TABLE IF NOT EXISTS qle.archived_query (
+    query_id    INTEGER PRIMARY KEY,
+    executed_at TIMESTAMPTZ NOT NULL,
+    sql_text    TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    archive     TEXT NOT NULL   -- partition it was archived with, e.g. 'query_p202601'
+);
+
+-- EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) plans captured for queries
+CREATE TABLE IF NOT EXISTS qle.query_plan (
+    query_id           INTEGER PRIMARY KEY,
+    captured_at        TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    plan               JSONB NOT NULL,
+    planning_ms        DOUBLE PRECISION,
+    execution_ms       DOUBLE PRECISION,
+    total_cost         DOUBLE PRECISION,
+    shared_hit_blocks  BIGINT,
+    shared_read_blocks BIGINT
 );
 
 -- Materialized views you pinned
 CREATE TABLE IF NOT EXISTS qle.pinned_view (
     view_id       SERIAL PRIMARY KEY,
-    query_id      INTEGER REFERENCES qle.query(query_id),
+    query_id      INTEGER,
     view_name     TEXT UNIQUE NOT NULL,
     created_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    storage_bytes BIGINT
+    storage_bytes BIGINT,
+    pinned_by     TEXT NOT NULL DEFAULT 'user',  -- 'user' or 'advisor'
+    source_versions JSONB,        -- source table version vector at last pin/refresh
+    refreshed_at  TIMESTAMPTZ,    -- NULL until the first refresh
+    refresh_ms    INTEGER,        -- duration of the last refresh
+    refresh_concurrently BOOLEAN  -- NULL = untried, FALSE = needs a blocking refresh
+);
+
+-- Per statement shape (fingerprint) aggregates, updated as executions are
+-- logged. Runtime columns cover successful runs; runtime_hist counts them
+-- per qle.runtime_bucket, and p95_ms is read off it.
+CREATE TABLE IF NOT EXISTS qle.fingerprint_stats (
+    fingerprint     TEXT PRIMARY KEY,
+    sample_sql_hash TEXT NOT NULL,   -- text of the latest execution
+    executions      BIGINT NOT NULL,
+    errors          BIGINT NOT NULL,
+    runtime_count   BIGINT NOT NULL,
+    runtime_sum_ms  DOUBLE PRECISION NOT NULL,
+    runtime_hist    BIGINT[] NOT NULL,
+    mean_ms         DOUBLE PRECISION,
+    p95_ms          DOUBLE PRECISION,
+    first_seen      TIMESTAMPTZ NOT NULL,
+    last_seen       TIMESTAMPTZ NOT NULL
+);
+
+-- Inferred lineage edges a user rejected, so they aren't proposed again
+CREATE TABLE IF NOT EXISTS qle.inference_rejection (
+    parent_query_id INTEGER NOT NULL,
+    child_query_id  INTEGER NOT NULL,
+    rejected_at     TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (parent_query_id, child_query_id)
+);
+
+-- Bulk ingestion (qle_ingest): how far each external log has been loaded,
+-- committed together with the rows it covers
+CREATE TABLE IF NOT EXISTS qle.ingest_checkpoint (
+    source     TEXT PRIMARY KEY,
+    position   BIGINT NOT NULL,   -- source records consumed (loaded or skipped)
+    loaded     BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Ids external logs give their statements, so later records (and restarts)
+-- can name them as parents
+CREATE TABLE IF NOT EXISTS qle.ingest_key (
+    source      TEXT NOT NULL,
+    external_id TEXT NOT NULL,
+    query_id    INTEGER NOT NULL,
+    executed_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (source, external_id)
 );
+
+-- Monthly partitions of qle.query, qle.query_table and qle.edge covering
+-- [from_ts, to_ts], named <table>_pYYYYMM (UTC months); returns how many were created
+CREATE OR REPLACE FUNCTION qle.ensure_partitions(from_ts TIMESTAMPTZ, to_ts TIMESTAMPTZ)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    m       TIMESTAMPTZ := date_trunc('month', from_ts, 'UTC');
+    t       TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE m <= to_ts LOOP
+        FOREACH t IN ARRAY ARRAY['query', 'query_table', 'edge'] LOOP
+            IF to_regclass(format('qle.%s_p%s', t, to_char(m AT TIME ZONE 'UTC', 'YYYYMM'))) IS NULL THEN
+                EXECUTE format(
+                    'CREATE TABLE qle.%I PARTITION OF qle.%I FOR VALUES FROM (%L) TO (%L)',
+                    t || '_p' || to_char(m AT TIME ZONE 'UTC', 'YYYYMM'),
+                    t,
+                    m,
+                    m + INTERVAL '1 month'
+                );
+                created := created + 1;
+            END IF;
+        END LOOP;
+        m := m + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END
+$$;
+
+SELECT qle.ensure_partitions(NOW(), NOW() + INTERVAL '1 month');
+
+-- Runtime histogram buckets: 0 holds runs under 1 ms, bucket i > 0 runs in
+-- [2^((i-1)/4), 2^(i/4)) ms, so each is ~19% wide; 128 buckets reach ~73 days
+CREATE OR REPLACE FUNCTION qle.runtime_bucket(runtime_ms DOUBLE PRECISION)
+RETURNS INTEGER
+LANGUAGE sql IMMUTABLE
+AS $$
+    SELECT CASE
+        WHEN runtime_ms < 1 THEN 0
+        ELSE LEAST(127, 1 + floor(4 * log(2, runtime_ms::numeric))::int)
+    END
+$$;
+
+-- Histogram (counts per bucket, 128 entries) of a set of runtimes
+CREATE OR REPLACE FUNCTION qle.runtime_hist(runtimes_ms INTEGER[])
+RETURNS BIGINT[]
+LANGUAGE sql IMMUTABLE
+AS $$
+    SELECT array_agg(COALESCE(c.n, 0) ORDER BY b.i)
+    FROM generate_series(0, 127) AS b(i)
+    LEFT JOIN (
+        SELECT qle.runtime_bucket(r) AS i, COUNT(*) AS n
+        FROM unnest(runtimes_ms) AS r
+        WHERE r IS NOT NULL
+        GROUP BY 1
+    ) c ON c.i = b.i
+$$;
+
+CREATE OR REPLACE FUNCTION qle.hist_add(a BIGINT[], b BIGINT[])
+RETURNS BIGINT[]
+LANGUAGE sql IMMUTABLE
+AS $$
+    SELECT array_agg(COALESCE(x, 0) + COALESCE(y, 0) ORDER BY i)
+    FROM unnest(a, b) WITH ORDINALITY AS t(x, y, i)
+$$;
+
+-- Upper bound (ms) of the bucket holding the q-quantile; NULL if empty
+CREATE OR REPLACE FUNCTION qle.hist_quantile(hist BIGINT[], q DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION
+LANGUAGE sql IMMUTABLE
+AS $$
+    SELECT power(2, (i - 1) / 4.0)
+    FROM (
+        SELECT i, SUM(n) OVER (ORDER BY i) AS running, SUM(n) OVER () AS total
+        FROM unnest(hist) WITH ORDINALITY AS t(n, i)
+    ) c
+    WHERE total > 0 AND running >= q * total
+    ORDER BY i
+    LIMIT 1
+$$;
+
+-- Upgrades for databases created from an older version of this file
+
+-- Copy the heap tables set aside at the top into the partitioned log
+DO $$
+DECLARE
+    cols TEXT;
+BEGIN
+    IF to_regclass('qle.legacy_query') IS NOT NULL THEN
+        PERFORM qle.ensure_partitions(
+            (SELECT MIN(executed_at) FROM qle.legacy_query),
+            (SELECT MAX(executed_at) FROM qle.legacy_query)
+        );
+        INSERT INTO qle.sql_text (sql_hash, sql_text)
+        SELECT DISTINCT md5(sql_text), sql_text FROM qle.legacy_query
+        ON CONFLICT DO NOTHING;
+        -- Only the columns the old table already had
+        SELECT string_agg(quote_ident(o.column_name), ', ') INTO cols
+        FROM information_schema.columns o
+        JOIN information_schema.columns n
+          ON n.table_schema = 'qle' AND n.table_name = 'query' AND n.column_name = o.column_name
+        WHERE o.table_schema = 'qle' AND o.table_name = 'legacy_query';
+        EXECUTE format(
+            'INSERT INTO qle.query (%s, sql_hash) SELECT %s, md5(sql_text) FROM qle.legacy_query',
+            cols, cols
+        );
+
+        INSERT INTO qle.query_table (query_id, executed_at, table_name)
+        SELECT t.query_id, q.executed_at, t.table_name
+        FROM qle.legacy_query_table t
+        JOIN qle.query q ON q.query_id = t.query_id;
+
+        INSERT INTO qle.edge (parent_query_id, child_query_id, child_executed_at, edge_type)
+        SELECT e.parent_query_id, e.child_query_id, q.executed_at, e.edge_type
+        FROM qle.legacy_edge e
+        JOIN qle.query q ON q.query_id = e.child_query_id
+        WHERE e.parent_query_id IS NOT NULL;
+
+        PERFORM setval(
+            pg_get_serial_sequence('qle.query', 'query_id'),
+            COALESCE((SELECT MAX(query_id) FROM qle.query), 1),
+            (SELECT COUNT(*) > 0 FROM qle.query)
+        );
+        -- CASCADE also drops the old FKs of lineage_closure, query_plan and pinned_view
+        DROP TABLE qle.legacy_edge, qle.legacy_query_table, qle.legacy_query CASCADE;
+    END IF;
+END
+$$;
+
+-- Move statement texts out of a partitioned log that still stores them inline
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 'qle' AND table_name = 'query' AND column_name = 'sql_text'
+    ) THEN
+        INSERT INTO qle.sql_text (sql_hash, sql_text)
+        SELECT DISTINCT md5(sql_text), sql_text FROM qle.query
+        ON CONFLICT DO NOTHING;
+        ALTER TABLE qle.query ADD COLUMN sql_hash TEXT;
+        UPDATE qle.query SET sql_hash = md5(sql_text);
+        ALTER TABLE qle.query
+            ALTER COLUMN sql_hash SET NOT NULL,
+            ADD FOREIGN KEY (sql_hash) REFERENCES qle.sql_text (sql_hash),
+            DROP COLUMN sql_text;
+    END IF;
+END
+$$;
+
+ALTER TABLE qle.query ADD COLUMN IF NOT EXISTS fingerprint TEXT;
+ALTER TABLE qle.query ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE qle.query ADD COLUMN IF NOT EXISTS served_by_view_id INTEGER;
+ALTER TABLE qle.query ADD COLUMN IF NOT EXISTS est_saved_ms INTEGER;
+ALTER TABLE qle.query ADD COLUMN IF NOT EXISTS runtime_us BIGINT;
+ALTER TABLE qle.query ADD COLUMN IF NOT EXISTS phase_us JSONB;
+ALTER TABLE qle.query ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'ok';
+UPDATE qle.query SET status = 'error' WHERE error_message IS NOT NULL AND status = 'ok';
+ALTER TABLE qle.pinned_view ADD COLUMN IF NOT EXISTS pinned_by TEXT NOT NULL DEFAULT 'user';
+ALTER TABLE qle.pinned_view ADD COLUMN IF NOT EXISTS source_versions JSONB;
+ALTER TABLE qle.pinned_view ADD COLUMN IF NOT EXISTS refreshed_at TIMESTAMPTZ;
+ALTER TABLE qle.pinned_view ADD COLUMN IF NOT EXISTS refresh_ms INTEGER;
+ALTER TABLE qle.pinned_view ADD COLUMN IF NOT EXISTS refresh_concurrently BOOLEAN;
+
+-- Build the closure for histories logged before it existed
+INSERT INTO qle.lineage_closure (ancestor_id, descendant_id, depth)
+WITH RECURSIVE walk(ancestor_id, descendant_id, depth) AS (
+    SELECT query_id, query_id, 0 FROM qle.query
+    UNION
+    SELECT w.ancestor_id, e.child_query_id, w.depth + 1
+    FROM walk w
+    JOIN qle.edge e ON e.parent_query_id = w.descendant_id
+)
+SELECT ancestor_id, descendant_id, MIN(depth)
+FROM walk
+WHERE NOT EXISTS (SELECT 1 FROM qle.lineage_closure)
+GROUP BY ancestor_id, descendant_id
+ON CONFLICT DO NOTHING;
+
+-- Fingerprint stats for histories logged before they were kept
+INSERT INTO qle.fingerprint_stats (
+    fingerprint, sample_sql_hash, executions, errors, runtime_count,
+    runtime_sum_ms, runtime_hist, mean_ms, p95_ms, first_seen, last_seen
+)
+SELECT b.fingerprint, b.sample_sql_hash, b.executions, b.errors, b.runtime_count,
+       b.runtime_sum_ms, b.runtime_hist,
+       b.runtime_sum_ms / NULLIF(b.runtime_count, 0),
+       qle.hist_quantile(b.runtime_hist, 0.95),
+       b.first_seen, b.last_seen
+FROM (
+    SELECT fingerprint,
+           (array_agg(sql_hash ORDER BY query_id DESC))[1] AS sample_sql_hash,
+           COUNT(*) AS executions,
+           COUNT(*) FILTER (WHERE status <> 'ok') AS errors,
+           COUNT(runtime_ms) FILTER (WHERE status = 'ok') AS runtime_count,
+           COALESCE(SUM(runtime_ms) FILTER (WHERE status = 'ok'), 0)::float8 AS runtime_sum_ms,
+           qle.runtime_hist(array_agg(runtime_ms) FILTER (WHERE status = 'ok')) AS runtime_hist,
+           MIN(executed_at) AS first_seen,
+           MAX(executed_at) AS last_seen
+    FROM qle.query
+    WHERE fingerprint IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM qle.fingerprint_stats)
+    GROUP BY fingerprint
+) b
+ON CONFLICT DO NOTHING;
+
+-- Indexes: history paging (newest first), per-query lookups and lineage hops
+CREATE INDEX IF NOT EXISTS query_executed_at_idx
+    ON qle.query (executed_at DESC, query_id DESC);
+CREATE INDEX IF NOT EXISTS query_pinned_view_id_idx
+    ON qle.query (pinned_view_id) WHERE pinned_view_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS query_table_query_id_idx
+    ON qle.query_table (query_id);
+CREATE INDEX IF NOT EXISTS edge_parent_query_id_idx
+    ON qle.edge (parent_query_id);
+CREATE INDEX IF NOT EXISTS edge_child_query_id_idx
+    ON qle.edge (child_query_id);
+CREATE INDEX IF NOT EXISTS pinned_view_query_id_idx
+    ON qle.pinned_view (query_id);
+CREATE INDEX IF NOT EXISTS query_fingerprint_idx
+    ON qle.query (fingerprint);
+CREATE INDEX IF NOT EXISTS query_sql_hash_idx
+    ON qle.query (sql_hash);
+CREATE INDEX IF NOT EXISTS lineage_closure_descendant_idx
+    ON qle.lineage_closure (descendant_id, depth);
@@ -0,0 +1,289 @@
+# qle_advisor.py
+"""
+Cost-based materialized-view advisor.
+
+Mines qle.query for statement shapes that are run often and are slow, scores
+each candidate by expected time saved per byte of storage, and keeps the
+best set pinned under a storage budget. Views the advisor pinned itself are
+dropped once their (time-decayed) benefit no longer earns their space;
+manual pins are only ever evicted with evict_manual=True.
+"""
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.extras
+
+import qle_backend as qle
+from qle_sql import parse_sql
+
+ADVISOR_CONFIG = {
+    "storage_budget_bytes": 1 << 30,  # total bytes all pinned views may use
+    "window": 5000,  # most recent successful queries to mine
+    "half_life_hours": 24.0,  # weight of an execution halves every half-life
+    "min_executions": 2,  # shapes seen fewer times are never pinned
+    "min_runtime_ms": 50,  # ... nor ones that are already fast
+    "fanout_weight": 0.5,  # extra weight per derived child in qle.edge
+    "evict_below_ms": 100.0,  # advisor views below this decayed benefit are dropped
+    "min_view_age_hours": 1.0,  # grace period before a fresh auto-pin can be evicted
+    "evict_manual": False,
+}
+
+# Per-row overhead (tuple header + item pointer) when estimating view size
+_ROW_OVERHEAD_BYTES = 28
+_MIN_VIEW_BYTES = 8192
+
+
+def _decay(executed_at, now, half_life_hours):
+    age_h = max(0.0, (now - executed_at).total_seconds() / 3600.0)
+    return 0.5 ** (age_h / half_life_hours)
+
+
+def _load_workload(cur, window):
+    cur.execute(
+        """
+        SELECT q.query_id,
+               q.executed_at,
+               s.sql_text,
+               q.runtime_ms,
+               q.cache_hit,
+               q.served_by_view_id,
+               q.est_saved_ms,
+               (SELECT COUNT(*) FROM qle.edge e
+                WHERE e.parent_query_id = q.query_id
+                  AND e.edge_type = 'derived') AS fanout
+        FROM qle.query q
+        JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+        WHERE q.error_message IS NULL
+        ORDER BY q.executed_at DESC, q.query_id DESC
+        LIMIT %s
+        """,
+        (window,),
+    )
+    return cur.fetchall()
+
+
+def _load_pinned(cur):
+    cur.execute(
+        """
+        SELECT pv.view_id, pv.view_name, pv.storage_bytes, pv.created_at,
+               pv.pinned_by, q.query_id, s.sql_text
+        FROM qle.pinned_view pv
+        JOIN qle.query q ON q.query_id = pv.query_id
+        JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+        """
+    )
+    return cur.fetchall()
+
+
+def _estimate_bytes(sql_text):
+    """Planner estimate of the materialized size (rows x width), or None if it can't plan."""
+    try:
+        with qle.pooled_conn("user") as conn:
+            with conn.cursor() as cur:
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql_text.strip().rstrip(";"))
+                plan = cur.fetchone()[0][0]["Plan"]
+    except psycopg2.Error:
+        return None
+    rows = plan.get("Plan Rows", 0)
+    width = plan.get("Plan Width", 0)
+    return max(_MIN_VIEW_BYTES, int(rows * (width + _ROW_OVERHEAD_BYTES)))
+
+
+def _shapes(workload, now, cfg):
+    """Group executions by normalized statement; decayed frequency, cost and fan-out per group."""
+    shapes = {}
+    for q in workload:
+        parsed = parse_sql(q["sql_text"])
+        if parsed.statement_type != "select" or not parsed.tables:
+            continue
+        if any(t.startswith("qle_view_") for t in parsed.tables):
+            continue
+        weight = _decay(q["executed_at"], now, cfg["half_life_hours"])
+        s = shapes.setdefault(
+            parsed.normalized_hash,
+            {
+                "normalized_hash": parsed.normalized_hash,
+                "query_id": q["query_id"],  # most recent execution (workload is newest first)
+                "sql_text": q["sql_text"],
+                "executions": 0,
+                "weight": 0.0,
+                "view_weight": 0.0,  # of the executions a pinned view served
+                "fanout": 0,
+                "runtimes": [],
+            },
+        )
+        s["executions"] += 1
+        s["weight"] += weight
+        if q["served_by_view_id"] is not None:
+            s["view_weight"] += weight
+        s["fanout"] += q["fanout"]
+        # Cache hits and view-served runs don't show what the query really costs
+        if not q["cache_hit"] and q["served_by_view_id"] is None and q["runtime_ms"]:
+            s["runtimes"].append(q["runtime_ms"])
+    for s in shapes.values():
+        s["mean_runtime_ms"] = (
+            sum(s["runtimes"]) / len(s["runtimes"]) if s["runtimes"] else 0.0
+        )
+        # Expected ms saved over the decay horizon if this shape were pinned;
+        # for a pinned shape, only from the executions its view didn't serve
+        # (those are counted through their est_saved_ms instead)
+        per_weight = s["mean_runtime_ms"] * (1.0 + cfg["fanout_weight"] * s["fanout"])
+        s["benefit_ms"] = s["weight"] * per_weight
+        s["unserved_benefit_ms"] = (s["weight"] - s["view_weight"]) * per_weight
+        del s["runtimes"], s["view_weight"]
+    return shapes
+
+
+def advise(dry_run=True, **overrides):
+    """
+    Score candidates and existing views, then pin/evict to fit the budget.
+
+    Returns a report dict: "pin" and "evict" (what was or, with dry_run,
+    would be done), "keep", the storage used before/after, and
+    "projected_savings_ms" (decayed benefit of the resulting view set).
+    """
+    cfg = dict(ADVISOR_CONFIG, **overrides)
+    now = datetime.now(timezone.utc)
+    qle.flush_log()
+
+    with qle.pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            workload = _load_workload(cur, cfg["window"])
+            pinned = _load_pinned(cur)
+
+    shapes = _shapes(workload, now, cfg)
+
+    # Benefit actually delivered by each view: decayed est_saved_ms of the
+    # queries it served, plus the benefit of its own shape's other executions
+    served = {}
+    for q in workload:
+        if q["served_by_view_id"] is not None:
+            served[q["served_by_view_id"]] = served.get(q["served_by_view_id"], 0.0) + (
+                _decay(q["executed_at"], now, cfg["half_life_hours"])
+                * (q["est_saved_ms"] or 0)
+            )
+
+    items = []
+    pinned_hashes = set()
+    for v in pinned:
+        h = parse_sql(v["sql_text"]).normalized_hash
+        pinned_hashes.add(h)
+        shape = shapes.get(h)
+        benefit = served.get(v["view_id"], 0.0)
+        if shape:
+            benefit += shape["unserved_benefit_ms"]
+        size = max(v["storage_bytes"] or 0, _MIN_VIEW_BYTES)
+        age_h = (now - v["created_at"]).total_seconds() / 3600.0
+        evictable = (v["pinned_by"] == "advisor" or cfg["evict_manual"]) and (
+            age_h >= cfg["min_view_age_hours"]
+        )
+        items.append(
+            {
+                "kind": "view",
+                "view_id": v["view_id"],
+                "view_name": v["view_name"],
+                "query_id": v["query_id"],
+                "bytes": size,
+                "benefit_ms": benefit,
+                "score": benefit / size,
+                "evictable": evictable,
+            }
+        )
+
+    for h, s in shapes.items():
+        if h in pinned_hashes:
+            continue
+        if s["executions"] < cfg["min_executions"] or s["mean_runtime_ms"] < cfg["min_runtime_ms"]:
+            continue
+        size = _estimate_bytes(s["sql_text"])
+        if size is None:
+            continue
+        items.append(
+            {
+                "kind": "candidate",
+                "query_id": s["query_id"],
+                "sql_text": s["sql_text"],
+                "executions": s["executions"],
+                "mean_runtime_ms": s["mean_runtime_ms"],
+                "fanout": s["fanout"],
+                "bytes": size,
+                "benefit_ms": s["benefit_ms"],
+                "score": s["benefit_ms"] / size,
+            }
+        )
+
+    # Views that can't be evicted always keep their space
+    budget = cfg["storage_budget_bytes"]
+    used = sum(i["bytes"] for i in items if i["kind"] == "view" and not i["evictable"])
+    keep, pin, evict = [], [], []
+    for item in items:
+        if item["kind"] == "view" and not item["evictable"]:
+            keep.append(item)
+
+    # Greedy knapsack on benefit per byte
+    for item in sorted(items, key=lambda i: i["score"], reverse=True):
+        if item["kind"] == "view" and not item["evictable"]:
+            continue
+        fits = used + item["bytes"] <= budget
+        if item["kind"] == "view":
+            if fits and item["benefit_ms"] >= cfg["evict_below_ms"]:
+                keep.append(item)
+                used += item["bytes"]
+            else:
+                evict.append(item)
+        elif fits and item["benefit_ms"] > 0:
+            pin.append(item)
+            used += item["bytes"]
+
+    report = {
+        "dry_run": dry_run,
+        "budget_bytes": budget,
+        "storage_before_bytes": sum(i["bytes"] for i in items if i["kind"] == "view"),
+        "storage_after_bytes": used,
+        "pin": pin,
+        "evict": evict,
+        "keep": keep,
+        "projected_savings_ms": sum(i["benefit_ms"] for i in keep + pin),
+        "errors": [],
+    }
+    if dry_run:
+        return report
+
+    for item in evict:
+        try:
+            qle.unpin_view(item["view_id"])
+        except (psycopg2.Error, ValueError) as e:
+            report["errors"].append(f"evict {item['view_name']}: {e}")
+    for item in pin:
+        try:
+            view_id, view_name, storage_bytes = qle.pin_query_as_view(
+                item["query_id"], pinned_by="advisor"
+            )
+            item.update(view_id=view_id, view_name=view_name, bytes=storage_bytes)
+        except (psycopg2.Error, ValueError) as e:
+            report["errors"].append(f"pin Q{item['query_id']}: {e}")
+    return report
+
+
+def format_report(report):
+    """Human-readable summary of an advise() report."""
+    verb = "Would" if report["dry_run"] else "Did"
+    lines = [
+        f"Budget {report['budget_bytes']:,} B; storage "
+        f"{report['storage_before_bytes']:,} B -> {report['storage_after_bytes']:,} B",
+        f"Projected savings: {report['projected_savings_ms'] / 1000.0:,.1f} s (decayed)",
+    ]
+    for item in report["pin"]:
+        lines.append(
+            f"{verb} pin Q{item['query_id']}: {item['executions']} runs, "
+            f"~{item['mean_runtime_ms']:.0f} ms each, ~{item['bytes']:,} B"
+        )
+    for item in report["evict"]:
+        lines.append(
+            f"{verb} evict {item['view_name']}: benefit {item['benefit_ms']:.0f} ms, "
+            f"{item['bytes']:,} B"
+        )
+    if not report["pin"] and not report["evict"]:
+        lines.append("No changes.")
+    lines.extend(f"Error: {e}" for e in report["errors"])
+    return "\n".join(lines)
@@ -1,271 +1,3154 @@
 # qle_backend.py
+import gzip
+import itertools
+import os
 import re
+import threading
 import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
 
-# Your Postgres connection
-DSN = "dbname=imdb user=postgres password=uromastyx host=localhost port=5432"
+import qle_metrics
+import qle_plans
+from qle_cache import FunctionVolatility, ResultCache, is_cacheable
+from qle_columnar import ColumnarResult
+from qle_graph import LineageGraphCache
+from qle_jobs import JobCancelled, JobRunner
+from qle_logger import WriteBehindLogger
+from qle_lsh import LSHIndex, MinHasher
+from qle_metrics import MetricsRegistry, PhaseTimer, current_timer
+from qle_pool import ConnectionPool
+from qle_refresh import RefreshScheduler
+from qle_snapshots import SnapshotStore
+from qle_sql import content_hash, parse_sql
+
+# Your Postgres connection
+DSN = "dbname=imdb user=postgres password=uromastyx host=localhost port=5432"
+
+# Connection pools: "meta" serves the qle.* bookkeeping tables, "user" runs the
+# analyst's own SQL, "refresh" runs background view refreshes (its maxconn
+# caps how many run at once). They can point at different DSNs / roles if needed.
+POOL_CONFIG = {
+    "meta": {"dsn": None, "minconn": 1, "maxconn": 4},
+    "user": {"dsn": None, "minconn": 1, "maxconn": 4, "reset_sql": "DISCARD ALL"},
+    "refresh": {"dsn": None, "minconn": 0, "maxconn": 1},
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Streaming results (run_query(..., stream=True))
+STREAM_PAGE_SIZE = 50  # rows per page handed to the UI
+STREAM_ITERSIZE = 2000  # rows per network round trip when iterating a stream
+STREAM_IDLE_TIMEOUT = 120  # seconds before an untouched stream is closed
+STREAM_BUSY_IDLE_TIMEOUT = 10  # ... while every "user" pool connection is checked out
+STREAM_COUNT_CHUNK = 100_000  # rows skipped per MOVE while counting a stream
+
+# Return results (and stream pages) as ColumnarResult typed column arrays
+# instead of a list of row dicts
+COLUMNAR_RESULTS = True
+
+# Default statement_timeout for user statements (None = server default)
+STATEMENT_TIMEOUT_MS = None
+
+
+# Process-wide metrics (perf_counter_ns phase timings, counters, gauges);
+# start_metrics_server() exposes them for local scraping
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
+_metrics = MetricsRegistry()
+_metrics.describe("qle_query_phase_seconds", "run_query time per phase")
+_metrics.describe("qle_queries_total", "Statements run through run_query, by status")
+_metrics.describe("qle_read_seconds", "Read API time per phase")
+_metrics.describe("qle_pool_checkout_seconds", "Time to check a connection out of a pool")
+_metrics.describe(
+    "qle_log_flush_timeouts_total", "flush_log() calls that returned with records still pending"
+)
+_metrics_server = None
+
+
+class _TimedCursorMixin:
+    """Adds execute / fetch time to the current qle_metrics.timed() call's phases."""
+
+    def execute(self, query, vars=None):
+        timer = current_timer()
+        if timer is None:
+            return super().execute(query, vars)
+        with timer.phase("execute"):
+            return super().execute(query, vars)
+
+    def fetchone(self):
+        timer = current_timer()
+        if timer is None:
+            return super().fetchone()
+        with timer.phase("fetch"):
+            return super().fetchone()
+
+    def fetchall(self):
+        timer = current_timer()
+        if timer is None:
+            return super().fetchall()
+        with timer.phase("fetch"):
+            return super().fetchall()
+
+
+class _TimedRealDictCursor(_TimedCursorMixin, psycopg2.extras.RealDictCursor):
+    pass
+
+
+def get_conn():
+    """Open a fresh, unpooled connection (scripts / one-off maintenance)."""
+    return psycopg2.connect(DSN)
+
+
+def configure_pools(**config):
+    """
+    Override pool settings and rebuild the pools on next use, e.g.
+    configure_pools(user={"maxconn": 8}, meta={"dsn": "...", "minconn": 2}).
+    Accepted keys per pool: dsn, minconn, maxconn, timeout, health_check_after, reset_sql.
+    """
+    with _pools_lock:
+        for kind, overrides in config.items():
+            if kind not in POOL_CONFIG:
+                raise ValueError(f"Unknown pool: {kind}")
+            POOL_CONFIG[kind].update(overrides)
+        _close_pools_locked()
+
+
+def _close_pools_locked():
+    for pool in _pools.values():
+        pool.closeall()
+    _pools.clear()
+
+
+def close_pools():
+    with _pools_lock:
+        _close_pools_locked()
+
+
+def get_pool(kind="meta"):
+    pool = _pools.get(kind)
+    if pool is not None:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(kind)
+        if pool is None:
+            cfg = dict(POOL_CONFIG[kind])
+            dsn = cfg.pop("dsn") or DSN
+            pool = ConnectionPool(dsn, name=kind, **cfg)
+            _pools[kind] = pool
+    return pool
+
+
+@contextmanager
+def pooled_conn(kind="meta"):
+    """Borrow a connection from the given pool; it is reset and returned on exit."""
+    start = time.perf_counter_ns()
+    with get_pool(kind).connection() as conn:
+        waited = time.perf_counter_ns() - start
+        _metrics.observe("qle_pool_checkout_seconds", waited / 1e9, pool=kind)
+        timer = current_timer()
+        if timer is not None:
+            timer.add("connect", waited)
+        yield conn
+
+
+def pool_stats():
+    """Checkout / wait statistics for each pool that has been created."""
+    return {kind: pool.stats() for kind, pool in list(_pools.items())}
+
+
+def _collect_gauges():
+    for kind, stats in pool_stats().items():
+        for key in ("size", "in_use", "idle", "waits", "timeouts"):
+            yield f"qle_pool_{key}", {"pool": kind}, stats[key]
+    for key, value in _result_cache.info().items():
+        yield f"qle_result_cache_{key}", {}, value
+    if _logger is not None:
+        yield "qle_log_pending", {}, _logger.pending()
+    if _jobs is not None:
+        for job in _jobs.jobs():
+            if not job.done:
+                yield "qle_job_running_seconds", {"job_id": job.job_id}, job.elapsed()
+    if _refresher is not None:
+        yield "qle_refresh_in_flight", {}, len(_refresher.in_flight())
+
+
+_metrics.add_collector(_collect_gauges)
+
+
+def metrics_snapshot():
+    """Counters, histograms and gauges as a JSON-able dict."""
+    return _metrics.snapshot()
+
+
+def metrics_text():
+    """Metrics in Prometheus text exposition format."""
+    return _metrics.render_prometheus()
+
+
+def start_metrics_server(host=None, port=None):
+    """
+    Serve /metrics (Prometheus text) and /metrics.json on a local port.
+    Idempotent: returns the running server if there is one.
+    """
+    global _metrics_server
+    with _pools_lock:
+        if _metrics_server is None:
+            _metrics_server = qle_metrics.serve(
+                _metrics, host or METRICS_HOST, port or METRICS_PORT
+            )
+        return _metrics_server
+
+
+def stop_metrics_server():
+    global _metrics_server
+    with _pools_lock:
+        server, _metrics_server = _metrics_server, None
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+def extract_table_names(sql_text: str):
+    """Base tables referenced by the statement (CTE names excluded), sorted."""
+    return list(parse_sql(sql_text).tables)
+
+
+# Statement types that can be wrapped in DECLARE ... CURSOR
+STREAMABLE_STATEMENTS = ("select", "values", "table")
+
+_open_streams = weakref.WeakSet()
+_streams_by_owner = weakref.WeakValueDictionary()  # run_query(stream_owner=...)
+_streams_by_owner_lock = threading.Lock()
+_stream_counter = itertools.count(1)
+
+
+class ResultStream:
+    """
+    A query result held open in a server-side (named) cursor.
+
+    Only the page currently being looked at is kept in memory; other pages
+    are fetched on demand by scrolling the cursor. The stream owns a "user"
+    pool connection until close() is called, its owner runs another query,
+    or it sits idle for longer than STREAM_IDLE_TIMEOUT
+    (STREAM_BUSY_IDLE_TIMEOUT while the pool is exhausted).
+    """
+
+    def __init__(self, pool, conn, cur, page_size, sql_text=None):
+        self._pool = pool
+        self.sql_text = sql_text
+        self._conn = conn
+        self._cur = cur
+        self._lock = threading.Lock()
+        self.page_size = page_size
+        # A named cursor only gets a description after its first FETCH
+        first = cur.fetchmany(page_size)
+        self.cols = [d.name for d in cur.description]
+        self._type_codes = [d.type_code for d in cur.description]
+        self._page = (0, self._as_page(first))
+        self.row_count = None  # filled in once known (short result or COUNT pass)
+        self.query_id = None
+        self.closed = False
+        self.last_used = time.monotonic()
+        if len(self._page[1]) < page_size:
+            self.row_count = len(self._page[1])
+
+    def first_page(self):
+        return self.page(0)
+
+    def page(self, n: int):
+        """Return the rows of page n (0-based); an empty list past the end."""
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("Result stream is closed; re-run the query")
+            self.last_used = time.monotonic()
+            if self._page[0] == n:
+                return self._page[1]
+            self._cur.scroll(n * self.page_size, mode="absolute")
+            rows = self._as_page(self._cur.fetchmany(self.page_size))
+            self._page = (n, rows)
+            return rows
+
+    def _as_page(self, rows):
+        if COLUMNAR_RESULTS:
+            return ColumnarResult.from_rows(rows, self.cols, self._type_codes)
+        return [dict(zip(self.cols, row)) for row in rows]
+
+    def num_pages(self):
+        if self.row_count is None:
+            return None
+        return max(1, -(-self.row_count // self.page_size))
+
+    def count_rows(self, chunk=None):
+        """
+        Find row_count by moving the cursor to the end on the stream's own
+        connection, `chunk` rows (STREAM_COUNT_CHUNK) per MOVE so page()
+        calls get in between. Returns the count, or None if the stream was
+        closed first.
+        """
+        chunk = chunk or STREAM_COUNT_CHUNK
+        pos = 0
+        while self.row_count is None:
+            with self._lock:
+                if self.closed:
+                    return None
+                with self._conn.cursor() as cur:
+                    cur.execute(f"MOVE ABSOLUTE {pos} IN {self._cur.name}")
+                    cur.execute(f"MOVE FORWARD {int(chunk)} IN {self._cur.name}")
+                    moved = cur.rowcount
+            pos += moved
+            if moved < chunk:
+                self.row_count = pos
+        return self.row_count
+
+    def estimate_size(self):
+        """
+        (rows, bytes) the result is expected to have: row_count if known,
+        else the planner's estimate. Either may be None.
+        """
+        if self.row_count is not None:
+            return self.row_count, None
+        if self.sql_text is None:
+            return None, None
+        with self._lock:
+            if self.closed:
+                return None, None
+            with self._conn.cursor() as cur:
+                cur.execute(f"EXPLAIN (FORMAT JSON) {_strip_trailing_semicolons(self.sql_text)}")
+                plan = cur.fetchone()[0][0]["Plan"]
+        rows = int(plan["Plan Rows"])
+        return rows, rows * int(plan["Plan Width"])
+
+    def batches(self, limit=None):
+        """
+        The whole result from the start as ColumnarResult batches of
+        STREAM_ITERSIZE rows, or only its first `limit` rows. Each batch
+        re-positions the cursor itself, so this can run on another thread
+        while the UI pages through page().
+        """
+        pos = 0
+        while limit is None or pos < limit:
+            size = self._cur.itersize if limit is None else min(self._cur.itersize, limit - pos)
+            with self._lock:
+                if self.closed:
+                    raise RuntimeError("Result stream is closed; re-run the query")
+                self._cur.scroll(pos, mode="absolute")
+                rows = self._cur.fetchmany(size)
+            if not rows:
+                return
+            pos += len(rows)
+            yield ColumnarResult.from_rows(rows, self.cols, self._type_codes)
+
+    def __iter__(self):
+        """Iterate every row from the start, STREAM_ITERSIZE rows per round trip."""
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("Result stream is closed; re-run the query")
+            self._cur.scroll(0, mode="absolute")
+            self._page = (None, [])
+        while True:
+            with self._lock:
+                batch = self._cur.fetchmany(self._cur.itersize)
+                self.last_used = time.monotonic()
+            if not batch:
+                return
+            for row in batch:
+                yield dict(zip(self.cols, row))
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._page = (None, [])
+            try:
+                self._cur.close()
+            except psycopg2.Error:
+                pass
+            # putconn() rolls back the read-only transaction holding the cursor
+            self._pool.putconn(self._conn)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def close_idle_streams(max_idle=None):
+    """
+    Close streams nobody has paged through for `max_idle` seconds
+    (STREAM_IDLE_TIMEOUT, or STREAM_BUSY_IDLE_TIMEOUT when the "user" pool
+    has no free connection).
+    """
+    if max_idle is None:
+        max_idle = STREAM_BUSY_IDLE_TIMEOUT if _user_pool_busy() else STREAM_IDLE_TIMEOUT
+    now = time.monotonic()
+    for stream in list(_open_streams):
+        if not stream.closed and now - stream.last_used > max_idle:
+            stream.close()
+
+
+def _strip_trailing_semicolons(sql_text):
+    return sql_text.strip().rstrip(";").rstrip()
+
+
+def _open_stream(sql_text, page_size, statement_timeout_ms=None, job=None, timer=None):
+    """Declare a scrollable named cursor for sql_text and fetch the first page."""
+    timer = timer or PhaseTimer()
+    pool = get_pool("user")
+    with timer.phase("connect"):
+        conn = pool.getconn()
+    try:
+        _prepare_user_statement(conn, statement_timeout_ms, job)
+        # Plain tuples; ResultStream turns each page into columns or dicts
+        cur = conn.cursor(
+            name=f"qle_stream_{next(_stream_counter)}",
+            scrollable=True,
+        )
+        cur.itersize = STREAM_ITERSIZE
+        try:
+            with timer.phase("execute"):
+                cur.execute(_strip_trailing_semicolons(sql_text))
+            # The query itself runs on the first FETCH, inside ResultStream
+            with timer.phase("fetch"):
+                stream = ResultStream(pool, conn, cur, page_size, sql_text)
+        finally:
+            if job is not None:
+                job.detach()
+    except Exception:
+        pool.putconn(conn, discard=conn.closed)
+        raise
+    _open_streams.add(stream)
+    return stream
+
+
+def _prepare_user_statement(conn, statement_timeout_ms, job):
+    """
+    Apply the statement timeout for the current transaction and report the
+    backend pid to `job` so it can be cancelled. Raises JobCancelled if the
+    job was cancelled before the statement started.
+    """
+    if statement_timeout_ms is None:
+        statement_timeout_ms = STATEMENT_TIMEOUT_MS
+    if statement_timeout_ms:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL statement_timeout = %s", (int(statement_timeout_ms),))
+    if job is not None and not job.attach(conn.get_backend_pid()):
+        raise JobCancelled("Query cancelled before it started")
+
+
+def _failure_status(e, job=None):
+    """qle.query.status for a failed execution: cancelled, timeout or error."""
+    if isinstance(e, JobCancelled):
+        return "cancelled"
+    if isinstance(e, psycopg2.errors.QueryCanceled):
+        # statement_timeout and pg_cancel_backend both raise QueryCanceled
+        if (job is not None and job.cancel_requested) or "user request" in str(e):
+            return "cancelled"
+        return "timeout"
+    return "error"
+
+
+def _close_owner_stream(owner, stream=None):
+    """Close owner's previous stream (each owner keeps at most one open); register `stream`."""
+    if owner is None:
+        return
+    with _streams_by_owner_lock:
+        prev = _streams_by_owner.pop(owner, None)
+        if stream is not None:
+            _streams_by_owner[owner] = stream
+    if prev is not None and prev is not stream:
+        prev.close()
+
+
+def _count_rows_in_background(stream):
+    """
+    Count a stream whose size is unknown on its own connection (no second
+    execution, no extra pool connection); updates qle.query.row_count.
+    """
+
+    def work():
+        try:
+            row_count = stream.count_rows()
+            if row_count is None:
+                return
+            flush_log()
+            with pooled_conn("meta") as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE qle.query SET row_count = %s WHERE query_id = %s",
+                        (row_count, stream.query_id),
+                    )
+                conn.commit()
+        except Exception:
+            # The row count is informational; a failed count pass leaves it NULL
+            pass
+
+    threading.Thread(target=work, name="qle-row-count", daemon=True).start()
+
+
+# Columns of qle.query written for each logged execution (besides query_id)
+QUERY_LOG_COLUMNS = (
+    "executed_at",
+    "sql_hash",
+    "fingerprint",
+    "runtime_ms",
+    "row_count",
+    "error_message",
+    "cache_hit",
+    "served_by_view_id",
+    "est_saved_ms",
+    "status",
+    "runtime_us",
+    "phase_us",
+)
+
+# WriteBehindLogger when write-behind logging is enabled, else None (synchronous)
+_logger = None
+LOG_FLUSH_TIMEOUT = 5.0  # seconds flush_log() waits for pending records by default
+
+
+def _make_log_record(
+    sql_text, runtime_ms, row_count, error_message, parent_query_ids, **extra
+):
+    record = {
+        "executed_at": datetime.now(timezone.utc),
+        "sql_text": sql_text,  # stored once per distinct text in qle.sql_text
+        "sql_hash": content_hash(sql_text),
+        "fingerprint": parse_sql(sql_text).fingerprint_hash,
+        "runtime_ms": runtime_ms,
+        "row_count": row_count,
+        "error_message": error_message,
+        "cache_hit": False,
+        "served_by_view_id": None,
+        "est_saved_ms": None,
+        # "ok", "error", "cancelled" or "timeout"
+        "status": "ok" if error_message is None else "error",
+        "runtime_us": None,
+        "phase_us": None,  # {phase: microseconds}
+        "parent_query_ids": list(parent_query_ids),
+    }
+    record.update(extra)
+    return record
+
+
+def _log_values(record, cols):
+    return tuple(
+        psycopg2.extras.Json(v) if isinstance(v, dict) else v
+        for v in (record.get(c) for c in cols)
+    )
+
+
+def _store_sql_texts(cur, records):
+    """Add the records' statement texts to qle.sql_text (each distinct text once)."""
+    texts = {}
+    for r in records:
+        # Records journaled by an older version carry only the text
+        r.setdefault("sql_hash", content_hash(r["sql_text"]))
+        texts[r["sql_hash"]] = r["sql_text"]
+    # In key order, so concurrent writers lock the same rows in the same order
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO qle.sql_text (sql_hash, sql_text) VALUES %s ON CONFLICT (sql_hash) DO NOTHING",
+        sorted(texts.items()),
+        page_size=len(texts),
+    )
+
+
+def _update_fingerprint_stats(cur, query_ids):
+    """
+    Fold just-inserted executions into qle.fingerprint_stats. Counts and
+    runtime sums are added; the runtime histograms are merged and p95 is
+    read off the merged one, so no history is rescanned.
+    """
+    cur.execute(
+        """
+        INSERT INTO qle.fingerprint_stats AS s (
+            fingerprint, sample_sql_hash, executions, errors, runtime_count,
+            runtime_sum_ms, runtime_hist, mean_ms, p95_ms, first_seen, last_seen
+        )
+        SELECT b.fingerprint, b.sample_sql_hash, b.executions, b.errors, b.runtime_count,
+               b.runtime_sum_ms, b.runtime_hist,
+               b.runtime_sum_ms / NULLIF(b.runtime_count, 0),
+               qle.hist_quantile(b.runtime_hist, 0.95),
+               b.first_seen, b.last_seen
+        FROM (
+            SELECT q.fingerprint,
+                   (array_agg(q.sql_hash ORDER BY q.query_id DESC))[1] AS sample_sql_hash,
+                   COUNT(*) AS executions,
+                   COUNT(*) FILTER (WHERE q.status <> 'ok') AS errors,
+                   COUNT(q.runtime_ms) FILTER (WHERE q.status = 'ok') AS runtime_count,
+                   COALESCE(SUM(q.runtime_ms) FILTER (WHERE q.status = 'ok'), 0)::float8
+                       AS runtime_sum_ms,
+                   qle.runtime_hist(array_agg(q.runtime_ms) FILTER (WHERE q.status = 'ok'))
+                       AS runtime_hist,
+                   MIN(q.executed_at) AS first_seen,
+                   MAX(q.executed_at) AS last_seen
+            FROM qle.query q
+            WHERE q.query_id = ANY(%s::int[]) AND q.fingerprint IS NOT NULL
+            GROUP BY q.fingerprint
+            ORDER BY q.fingerprint
+        ) b
+        ON CONFLICT (fingerprint) DO UPDATE SET
+            sample_sql_hash = EXCLUDED.sample_sql_hash,
+            executions = s.executions + EXCLUDED.executions,
+            errors = s.errors + EXCLUDED.errors,
+            runtime_count = s.runtime_count + EXCLUDED.runtime_count,
+            runtime_sum_ms = s.runtime_sum_ms + EXCLUDED.runtime_sum_ms,
+            runtime_hist = qle.hist_add(s.runtime_hist, EXCLUDED.runtime_hist),
+            mean_ms = (s.runtime_sum_ms + EXCLUDED.runtime_sum_ms)
+                      / NULLIF(s.runtime_count + EXCLUDED.runtime_count, 0),
+            p95_ms = qle.hist_quantile(qle.hist_add(s.runtime_hist, EXCLUDED.runtime_hist), 0.95),
+            first_seen = LEAST(s.first_seen, EXCLUDED.first_seen),
+            last_seen = GREATEST(s.last_seen, EXCLUDED.last_seen)
+        """,
+        (list(query_ids),),
+    )
+
+
+def _insert_log_children(cur, records):
+    """Multi-row inserts of qle.query_table / qle.edge rows for already-inserted records."""
+    table_rows = [
+        (r["query_id"], r["executed_at"], t)
+        for r in records
+        if r.get("error_message") is None
+        for t in extract_table_names(r["sql_text"])
+    ]
+    if table_rows:
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO qle.query_table (query_id, executed_at, table_name) VALUES %s",
+            table_rows,
+            page_size=len(table_rows),
+        )
+
+    edge_rows = [
+        (pid, r["query_id"], r["executed_at"], r.get("edge_type", "derived"))
+        for r in records
+        for pid in r.get("parent_query_ids", [])
+    ] + [
+        (pid, r["query_id"], r["executed_at"], "inferred")
+        for r in records
+        for pid in r.get("inferred_parent_ids", [])
+    ] + [
+        (pid, r["query_id"], r["executed_at"], "rerun")
+        for r in records
+        for pid in r.get("rerun_of_ids", [])
+    ]
+    if edge_rows:
+        # Parents in this batch are already inserted; archived ones are kept
+        # in qle.archived_query
+        _check_parents(cur, [row[0] for row in edge_rows])
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO qle.edge (parent_query_id, child_query_id, child_executed_at, edge_type)
+            VALUES %s
+            """,
+            edge_rows,
+            page_size=len(edge_rows),
+        )
+
+    # Transitive closure: every query is its own ancestor at depth 0; then
+    # each record's parents are linked in query_id order, so a child logged
+    # in the same batch as its parent sees the parent's rows
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO qle.lineage_closure (ancestor_id, descendant_id, depth) VALUES %s",
+        [(r["query_id"], r["query_id"], 0) for r in records],
+        page_size=len(records),
+    )
+    for r in sorted(records, key=lambda r: r["query_id"]):
+        parents = (
+            r.get("parent_query_ids", [])
+            + r.get("inferred_parent_ids", [])
+            + r.get("rerun_of_ids", [])
+        )
+        if parents:
+            _link_closure(cur, parents, r["query_id"])
+
+
+def _check_parents(cur, parent_ids):
+    """
+    Raise ValueError if any of parent_ids is neither in qle.query nor kept in
+    qle.archived_query, rather than logging an edge to nothing.
+    """
+    with cur.connection.cursor() as check:
+        check.execute(
+            """
+            SELECT DISTINCT p
+            FROM unnest(%s::int[]) AS p
+            WHERE NOT EXISTS (SELECT 1 FROM qle.query q WHERE q.query_id = p)
+              AND NOT EXISTS (SELECT 1 FROM qle.archived_query a WHERE a.query_id = p)
+            ORDER BY p
+            """,
+            (list(parent_ids),),
+        )
+        missing = [row[0] for row in check.fetchall()]
+    if missing:
+        raise ValueError(f"Unknown parent query_id(s): {missing}")
+
+
+# An archived query keeps no closure rows of its own (it is nobody's
+# descendant any more), so it stands in for itself at depth 0
+_ANCESTOR_ROWS_SQL = """
+    SELECT ancestor_id, descendant_id, depth
+    FROM qle.lineage_closure
+    UNION ALL
+    SELECT query_id, query_id, 0
+    FROM qle.archived_query
+"""
+
+
+def _link_closure(cur, parent_ids, child_id):
+    """
+    Add closure rows for new edges parent -> child_id: every ancestor of a
+    parent becomes an ancestor of every descendant of the child, at the
+    shortest depth. Archived parents are linked as ancestors themselves.
+    """
+    cur.execute(
+        f"""
+        INSERT INTO qle.lineage_closure AS lc (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, MIN(a.depth + 1 + d.depth)
+        FROM ({_ANCESTOR_ROWS_SQL}) a
+        JOIN qle.lineage_closure d ON d.ancestor_id = %s
+        WHERE a.descendant_id = ANY(%s::int[])
+        GROUP BY a.ancestor_id, d.descendant_id
+        ON CONFLICT (ancestor_id, descendant_id) DO UPDATE
+            SET depth = LEAST(lc.depth, EXCLUDED.depth)
+        """,
+        (child_id, list(parent_ids)),
+    )
+
+
+def _link_new_closure(cur, staged_edges):
+    """
+    Set-based _link_closure for a batch of new queries: `staged_edges` is a
+    table of (child_id, parent_id) whose children are all new (no
+    descendants yet besides each other) and already have their depth-0 rows.
+    Paths are followed up through parents in the same batch, so the batch
+    can be linked in one statement whatever order it came in.
+    """
+    cur.execute(
+        f"""
+        INSERT INTO qle.lineage_closure AS lc (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE up(descendant_id, node, depth) AS (
+            SELECT child_id, parent_id, 1
+            FROM {staged_edges}
+            UNION
+            SELECT u.descendant_id, e.parent_id, u.depth + 1
+            FROM up u
+            JOIN {staged_edges} e ON e.child_id = u.node
+        )
+        SELECT a.ancestor_id, u.descendant_id, MIN(u.depth + a.depth)
+        FROM up u
+        JOIN ({_ANCESTOR_ROWS_SQL}) a ON a.descendant_id = u.node
+        GROUP BY a.ancestor_id, u.descendant_id
+        ON CONFLICT (ancestor_id, descendant_id) DO UPDATE
+            SET depth = LEAST(lc.depth, EXCLUDED.depth)
+        """
+    )
+
+
+def _with_partitions(records, write):
+    """
+    Run write(); if a record's executed_at has no partition yet (e.g. the
+    first query of a month), create the partitions it needs and retry once.
+    """
+    try:
+        return write()
+    except psycopg2.errors.CheckViolation:
+        times = [r["executed_at"] for r in records]
+        ensure_partitions(min(times), max(times))
+        return write()
+
+
+def _write_log_batch(records):
+    """Write-behind writer: one transaction, multi-row inserts, idempotent on query_id."""
+    _with_partitions(records, lambda: _write_log_rows(records))
+
+
+def _write_log_rows(records):
+    cols = ("query_id",) + QUERY_LOG_COLUMNS
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            _store_sql_texts(cur, records)
+            inserted = psycopg2.extras.execute_values(
+                cur,
+                f"""
+                INSERT INTO qle.query ({", ".join(cols)})
+                VALUES %s
+                ON CONFLICT (query_id, executed_at) DO NOTHING
+                RETURNING query_id
+                """,
+                [_log_values(r, cols) for r in records],
+                page_size=len(records),
+                fetch=True,
+            )
+            inserted = {row[0] for row in inserted}
+            _insert_log_children(cur, [r for r in records if r["query_id"] in inserted])
+            if inserted:
+                _update_fingerprint_stats(cur, inserted)
+        conn.commit()
+
+
+def _reserve_query_ids(n):
+    """Reserve a block of n query_id values from the qle.query sequence."""
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT nextval(pg_get_serial_sequence('qle.query', 'query_id'))
+                FROM generate_series(1, %s)
+                """,
+                (n,),
+            )
+            ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    return ids
+
+
+def _log_query(record):
+    """Log one execution (a _make_log_record dict) and return its query_id."""
+    # The index is read once: inference may be disabled meanwhile
+    index, signature = _infer_parents(record)
+    if _logger is not None:
+        query_id = _logger.submit(record)
+    else:
+        _with_partitions([record], lambda: _insert_log_row(record))
+        query_id = record["query_id"]
+    _graph_cache.note_added([query_id])
+    if signature is not None:
+        index.add(query_id, signature)
+    return query_id
+
+
+def _insert_log_row(record):
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            _store_sql_texts(cur, [record])
+            cur.execute(
+                f"""
+                INSERT INTO qle.query ({", ".join(QUERY_LOG_COLUMNS)})
+                VALUES ({", ".join(["%s"] * len(QUERY_LOG_COLUMNS))})
+                RETURNING query_id
+                """,
+                _log_values(record, QUERY_LOG_COLUMNS),
+            )
+            record["query_id"] = cur.fetchone()[0]
+            _insert_log_children(cur, [record])
+            _update_fingerprint_stats(cur, [record["query_id"]])
+        conn.commit()
+
+
+def enable_write_behind(**options):
+    """
+    Switch query logging to the asynchronous write-behind logger.
+    run_query then returns as soon as the log record is queued; options are
+    passed to qle_logger.WriteBehindLogger (batch_size, flush_interval,
+    id_block_size, journal_path for fsync'd durability, max_attempts before
+    a failing batch is dead-lettered, ...).
+    """
+    global _logger
+    disable_write_behind()
+    _logger = WriteBehindLogger(_write_log_batch, _reserve_query_ids, **options)
+    return _logger
+
+
+def disable_write_behind(timeout=None):
+    """Flush and stop the write-behind logger; logging becomes synchronous again."""
+    global _logger
+    logger, _logger = _logger, None
+    if logger is not None:
+        logger.close(timeout)
+
+
+def flush_log(timeout=LOG_FLUSH_TIMEOUT):
+    """
+    Wait until queued log records are in the database, at most `timeout`
+    seconds (None: no limit); False if some are still pending. Read APIs call
+    this before reading, so a slow or unreachable log database delays them
+    by LOG_FLUSH_TIMEOUT at most. No-op for synchronous logging.
+    """
+    if _logger is None:
+        return True
+    flushed = _logger.flush(timeout)
+    if not flushed:
+        _metrics.inc("qle_log_flush_timeouts_total")
+    return flushed
+
+
+def log_stats():
+    if _logger is None:
+        return {"mode": "sync"}
+    return dict(_logger.stats, mode="write-behind", pending=_logger.pending())
+
+
+def _ns_to_ms(ns):
+    return int(round(ns / 1e6))
+
+
+def _log_timed_run(record, timer, runtime_ns):
+    """
+    Store the phase timings (microseconds) on a log record, log it, and feed
+    the phase histograms. log_write is only in the metrics: it isn't known
+    until the row it would be stored in has been written.
+    """
+    record["runtime_us"] = runtime_ns // 1000
+    record["phase_us"] = timer.as_us()
+    with timer.phase("log_write"):
+        query_id = _log_query(record)
+    timer.add("total", timer.elapsed_ns())
+    _metrics.observe_phases("qle_query_phase_seconds", timer)
+    _metrics.inc("qle_queries_total", status=record["status"], cache_hit=record["cache_hit"])
+    return query_id
+
+
+def _run_query_streaming(
+    sql_text, parent_query_ids, page_size, statement_timeout_ms, job, capture_plan,
+    stream_owner=None,
+):
+    """
+    Streaming branch of run_query; returns (result, status), or None if the
+    statement can't be streamed.
+    """
+    _close_owner_stream(stream_owner)
+    close_idle_streams()
+    timer = PhaseTimer()
+    error_message = None
+    status = "ok"
+    stream = []
+    cols = []
+    row_count = None
+    with timer.phase("rewrite"):
+        exec_sql, views_used = _rewrite_for_views(sql_text)
+    try:
+        try:
+            stream = _open_stream(exec_sql, page_size, statement_timeout_ms, job, timer)
+        except (psycopg2.errors.FeatureNotSupported, psycopg2.errors.QueryCanceled):
+            raise
+        except psycopg2.Error:
+            if not views_used:
+                raise
+            # A pinned view may have been dropped meanwhile: run the original
+            exec_sql, views_used = sql_text, []
+            stream = _open_stream(exec_sql, page_size, statement_timeout_ms, job, timer)
+        cols = stream.cols
+        row_count = stream.row_count
+    except psycopg2.errors.FeatureNotSupported:
+        # e.g. data-modifying WITH: not allowed in DECLARE CURSOR
+        return None
+    except Exception as e:
+        error_message = str(e)
+        status = _failure_status(e, job)
+    # For streams, "fetch" is the first page only
+    runtime_ns = timer.phases_ns.get("execute", 0) + timer.phases_ns.get("fetch", 0)
+    runtime_ms = _ns_to_ms(runtime_ns)
+
+    with timer.phase("serialize"):
+        record = _make_log_record(
+            sql_text,
+            runtime_ms,
+            row_count,
+            error_message,
+            parent_query_ids,
+            status=status,
+            **_view_log_fields(views_used, runtime_ms),
+        )
+    query_id = _log_timed_run(record, timer, runtime_ns)
+
+    if error_message is None:
+        stream.query_id = query_id
+        _close_owner_stream(stream_owner, stream)
+        if stream.row_count is None:
+            _count_rows_in_background(stream)
+        if _snapshots is not None:
+            # One row past the limit is enough to know it doesn't fit
+            limit = _snapshots.max_rows + 1
+            _snapshot_in_background(
+                query_id, lambda: stream.batches(limit), stream.estimate_size
+            )
+        # Time to the first page says little about the query: only explicit requests
+        if capture_plan:
+            _capture_plan_in_background(query_id, exec_sql, statement_timeout_ms)
+    return (query_id, stream, cols, error_message), status
+
+
+# Automatic rewrite onto pinned materialized views: a statement whose
+# normalized text (literals kept) equals a pinned query's, or that contains
+# it as a parenthesized subquery / CTE body, is answered from the view.
+# View contents are as of the last pin/refresh of the view, so a view is only
+# used while its source tables' version vectors still match those recorded
+# then (views without tracked sources: for REFRESH_MAX_AGE seconds).
+REWRITE_ENABLED = True
+PINNED_INDEX_TTL = 30  # seconds before views pinned by other processes are seen
+
+_pinned_index = {"loaded_at": None, "by_hash": {}}
+_pinned_index_lock = threading.Lock()
+
+
+def _pinned_views_by_hash():
+    """normalized_hash of each pinned view's originating SQL -> view row."""
+    with _pinned_index_lock:
+        loaded_at = _pinned_index["loaded_at"]
+        if loaded_at is not None and time.monotonic() - loaded_at < PINNED_INDEX_TTL:
+            return _pinned_index["by_hash"]
+
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT pv.view_id,
+                       pv.view_name,
+                       q.query_id,
+                       s.sql_text,
+                       q.runtime_ms,
+                       pv.source_versions,
+                       EXTRACT(EPOCH FROM NOW() - COALESCE(pv.refreshed_at, pv.created_at))
+                           AS age_s
+                FROM qle.pinned_view pv
+                JOIN qle.query q ON q.query_id = pv.query_id
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                ORDER BY pv.view_id
+                """
+            )
+            rows = cur.fetchall()
+
+    by_hash = {}
+    now = time.monotonic()
+    for row in rows:
+        # Ages are kept relative to the local clock, so cached rows keep aging
+        row["refreshed_mono"] = now - float(row.pop("age_s"))
+        by_hash.setdefault(parse_sql(row["sql_text"]).normalized_hash, row)
+    with _pinned_index_lock:
+        _pinned_index["by_hash"] = by_hash
+        _pinned_index["loaded_at"] = time.monotonic()
+    return by_hash
+
+
+def invalidate_pinned_views():
+    with _pinned_index_lock:
+        _pinned_index["loaded_at"] = None
+
+
+def _fresh_view_ids(views):
+    """
+    view_ids of `views` whose source tables are unchanged since the view was
+    last pinned or refreshed (those without recorded versions: younger than
+    REFRESH_MAX_AGE).
+    """
+    tables = {row[0] for v in views for row in (v["source_versions"] or [])}
+    current = {}
+    if tables:
+        with pooled_conn("meta") as conn:
+            current = _table_version_map(conn, tables)
+            conn.rollback()
+    fresh = set()
+    for v in views:
+        recorded = v["source_versions"]
+        if not recorded:
+            if time.monotonic() - v["refreshed_mono"] < REFRESH_MAX_AGE:
+                fresh.add(v["view_id"])
+        elif all(
+            current.get(row[0]) is not None and list(current[row[0]]) == row
+            for row in recorded
+        ):
+            fresh.add(v["view_id"])
+    return fresh
+
+
+def _rewrite_for_views(sql_text):
+    """Return (sql_to_run, views_used); sql_text unchanged if no pinned view applies."""
+    if not REWRITE_ENABLED:
+        return sql_text, []
+    parsed = parse_sql(sql_text)
+    try:
+        index = _pinned_views_by_hash()
+    except psycopg2.Error:
+        return sql_text, []
+    if not index:
+        return sql_text, []
+
+    with _stale_lock:
+        stale = set(_stale_view_ids)
+    if stale:
+        index = {h: v for h, v in index.items() if v["view_id"] not in stale}
+
+    # Only views this statement could use are checked against current versions
+    hashes = {parsed.normalized_hash} | {h for _, _, h in parsed.subqueries}
+    candidates = [index[h] for h in hashes if h in index]
+    if not candidates:
+        return sql_text, []
+    try:
+        fresh = _fresh_view_ids(candidates)
+    except psycopg2.Error:
+        return sql_text, []
+    index = {h: v for h, v in index.items() if v["view_id"] in fresh}
+
+    view = index.get(parsed.normalized_hash)
+    # Rows come back in heap order, so a top-level ORDER BY must be re-run
+    if (
+        view is not None
+        and parsed.statement_type == "select"
+        and " order by " not in f" {parsed.normalized} "
+    ):
+        return f"SELECT * FROM {view['view_name']}", [view]
+
+    pieces = []
+    used = []
+    last_end = 0
+    # Outermost spans sort first; anything inside a replaced span is skipped
+    for start, end, h in sorted(parsed.subqueries, key=lambda s: (s[0], -s[1])):
+        if start < last_end:
+            continue
+        view = index.get(h)
+        if view is None:
+            continue
+        pieces.append(sql_text[last_end:start])
+        pieces.append(f"SELECT * FROM {view['view_name']}")
+        last_end = end
+        used.append(view)
+    if not used:
+        return sql_text, []
+    pieces.append(sql_text[last_end:])
+    return "".join(pieces), used
+
+
+def _view_log_fields(views_used, runtime_ms):
+    """served_by_view_id / est_saved_ms for a (possibly) rewritten execution."""
+    if not views_used:
+        return {}
+    original_ms = sum(v["runtime_ms"] or 0 for v in views_used)
+    return {
+        "served_by_view_id": views_used[0]["view_id"],
+        # Lower bound: the pinned queries' original runtimes minus what this run took
+        "est_saved_ms": max(0, original_ms - (runtime_ms or 0)),
+    }
+
+
+# Result cache: identical SELECTs re-run against unchanged tables are answered
+# from memory. Entries are validated against a version vector built from
+# pg_stat_user_tables modification counters and relfilenode (which changes on
+# TRUNCATE / rewrite). Those counters are published at transaction end and can
+# lag writes from other sessions by up to about a second; writes made through
+# run_query invalidate the affected tables immediately.
+RESULT_CACHE_ENABLED = True
+_result_cache = ResultCache()
+
+# Functions called are checked against pg_proc (qle_cache.FunctionVolatility)
+# before a lookup; what was found is kept for FUNCTION_VOLATILITY_TTL seconds.
+FUNCTION_VOLATILITY_TTL = 300
+_function_volatility = FunctionVolatility(FUNCTION_VOLATILITY_TTL)
+
+
+def _table_version_map(conn, tables):
+    """
+    name -> (name, relfilenode, n_tup_ins, n_tup_upd, n_tup_del) for each of
+    `tables`; None for names that aren't a plain table or materialized view.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT t.name,
+                   c.relkind,
+                   c.relfilenode,
+                   s.n_tup_ins,
+                   s.n_tup_upd,
+                   s.n_tup_del
+            FROM unnest(%s::text[]) AS t(name)
+            LEFT JOIN pg_class c ON c.oid = to_regclass(t.name)
+            LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+            ORDER BY t.name
+            """,
+            (list(tables),),
+        )
+        rows = cur.fetchall()
+    versions = {}
+    for name, relkind, filenode, n_ins, n_upd, n_del in rows:
+        if relkind in ("r", "m"):
+            versions[name] = (name, filenode, n_ins, n_upd, n_del)
+        else:
+            versions[name] = None
+    return versions
+
+
+def _table_versions(conn, tables):
+    """
+    Version vector of `tables`: a tuple of
+    (name, relfilenode, n_tup_ins, n_tup_upd, n_tup_del) sorted by name, or
+    None if some name isn't a plain table or materialized view.
+    """
+    versions = _table_version_map(conn, tables)
+    if any(v is None for v in versions.values()):
+        return None
+    return tuple(versions[name] for name in sorted(versions))
+
+
+def result_cache_info():
+    return _result_cache.info()
+
+
+def clear_result_cache():
+    _result_cache.clear()
+    _function_volatility.clear()
+
+
+# On-disk result snapshots (qle_snapshots.SnapshotStore), None while disabled.
+# Successful results are written in the background after run_query returns.
+SNAPSHOT_DIR = "qle_snapshots"
+_snapshots = None
+
+
+def enable_snapshots(root=None, **options):
+    """
+    Keep a memory-mappable copy of every successful result under `root`
+    (SNAPSHOT_DIR by default); options go to SnapshotStore (max_bytes quota,
+    max_rows per snapshot, page_size).
+    """
+    global _snapshots
+    _snapshots = SnapshotStore(root or SNAPSHOT_DIR, **options)
+    return _snapshots
+
+
+def disable_snapshots():
+    """Stop writing snapshots; the files already written are left on disk."""
+    global _snapshots
+    _snapshots = None
+
+
+def snapshot_stats():
+    if _snapshots is None:
+        return {"enabled": False}
+    return dict(_snapshots.info(), enabled=True)
+
+
+def get_result_snapshot(query_id: int):
+    """SnapshotReader over query_id's saved result (page(n) -> ColumnarResult), or None."""
+    if _snapshots is None:
+        return None
+    return _snapshots.open(query_id)
+
+
+def _snapshot_in_background(query_id, batches, estimate=None):
+    """
+    Write the snapshot of query_id from batches() on a daemon thread;
+    estimate() -> (rows, bytes) lets results that can't fit be skipped
+    before anything is read.
+    """
+    store = _snapshots
+
+    def work():
+        try:
+            expected_rows, expected_bytes = estimate() if estimate else (None, None)
+            store.write(query_id, batches(), expected_rows, expected_bytes)
+        except Exception:
+            # A snapshot is a convenience; the query itself already succeeded
+            pass
+
+    threading.Thread(target=work, name="qle-snapshot", daemon=True).start()
+
+
+def _snapshot_rows(query_id, rows, cols):
+    if not isinstance(rows, ColumnarResult):
+        rows = ColumnarResult.from_rows(rows, cols)
+    _snapshot_in_background(query_id, lambda: iter([rows]))
+
+
+def run_query(
+    sql_text: str,
+    parent_query_ids=None,
+    stream=False,
+    page_size=None,
+    statement_timeout_ms=None,
+    capture_plan=False,
+    stream_owner=None,
+):
+    """
+    Execute SQL, log it, and return (query_id, rows, cols, error_message).
+    rows is a ColumnarResult (typed column arrays, see qle_columnar) when
+    COLUMNAR_RESULTS is set, else a list of row dicts.
+    parent_query_ids: list[int] or None
+    statement_timeout_ms: per-query statement_timeout (STATEMENT_TIMEOUT_MS by default)
+    capture_plan: store an EXPLAIN ANALYZE plan in qle.query_plan afterwards
+        (also done for SELECTs slower than PLAN_CAPTURE_MIN_MS, if set)
+
+    The statement runs on a "user" pool connection and is committed there;
+    the log rows are written separately through the "meta" pool.
+
+    With stream=True, SELECT-like statements are run through a server-side
+    cursor and `rows` is a ResultStream holding only the current page
+    (page_size rows, STREAM_PAGE_SIZE by default, in the same form as rows). If the true row count is
+    not known from the first page, a background pass over the cursor fills
+    in qle.query.row_count. Other statements fall back to a normal fetch.
+    stream_owner (e.g. a UI session id): the owner's previous stream is
+    closed when it runs another query, returning its connection.
+
+    Non-streamed SELECTs may be answered from the result cache; the hit is
+    still logged as its own qle.query row with cache_hit = TRUE.
+
+    Statements matching a pinned view's query (whole, or as a subquery/CTE)
+    are transparently rewritten to read the view; qle.query records the
+    serving view and the estimated time saved.
+
+    Use submit_query() to run a statement in the background instead.
+    """
+    result, _ = _run_query(
+        sql_text,
+        parent_query_ids,
+        stream,
+        page_size,
+        statement_timeout_ms,
+        capture_plan=capture_plan,
+        stream_owner=stream_owner,
+    )
+    return result
+
+
+def _run_query(
+    sql_text,
+    parent_query_ids,
+    stream,
+    page_size,
+    statement_timeout_ms,
+    job=None,
+    capture_plan=False,
+    use_cache=True,
+    log_fields=None,
+    stream_owner=None,
+):
+    """
+    run_query's body; returns (result tuple, qle.query status).
+    use_cache=False always executes; log_fields are added to the log record
+    of a non-streamed run.
+    """
+    parent_query_ids = parent_query_ids or []
+
+    timer = PhaseTimer()
+    error_message = None
+    status = "ok"
+    rows = []
+    cols = []
+    row_count = None
+    runtime_ms = None
+
+    if stream and parse_sql(sql_text).statement_type in STREAMABLE_STATEMENTS:
+        result = _run_query_streaming(
+            sql_text,
+            parent_query_ids,
+            page_size or STREAM_PAGE_SIZE,
+            statement_timeout_ms,
+            job,
+            capture_plan,
+            stream_owner,
+        )
+        if result is not None:
+            return result
+    _close_owner_stream(stream_owner)
+    close_idle_streams()
+
+    parsed = parse_sql(sql_text)
+    cache_key = None
+    versions = None
+    cached = None
+
+    connect_start = time.perf_counter_ns()
+    with pooled_conn("user") as conn:
+        timer.add("connect", time.perf_counter_ns() - connect_start)
+        if use_cache and RESULT_CACHE_ENABLED and is_cacheable(parsed):
+            with timer.phase("cache_lookup"):
+                try:
+                    if not _function_volatility.calls_volatile(conn, parsed.functions):
+                        versions = _table_versions(conn, parsed.tables)
+                except psycopg2.Error:
+                    conn.rollback()
+                    versions = None
+                if versions is not None:
+                    cache_key = parsed.normalized_hash
+                    cached = _result_cache.get(cache_key, versions)
+
+        views_used = []
+        exec_sql = sql_text
+        if cached is not None:
+            rows, cols, row_count = cached.rows, cached.cols, cached.row_count
+        else:
+            with timer.phase("rewrite"):
+                exec_sql, views_used = _rewrite_for_views(sql_text)
+            if COLUMNAR_RESULTS:
+                cur = conn.cursor()
+            else:
+                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            execute_start = time.perf_counter_ns()
+            try:
+                try:
+                    _prepare_user_statement(conn, statement_timeout_ms, job)
+                    try:
+                        cur.execute(exec_sql)
+                    except psycopg2.errors.QueryCanceled:
+                        raise
+                    except psycopg2.Error:
+                        if not views_used:
+                            raise
+                        # A pinned view may have been dropped meanwhile: run the original
+                        conn.rollback()
+                        views_used = []
+                        _prepare_user_statement(conn, statement_timeout_ms, job)
+                        cur.execute(sql_text)
+                finally:
+                    if job is not None:
+                        job.detach()
+                    timer.add("execute", time.perf_counter_ns() - execute_start)
+
+                with timer.phase("fetch"):
+                    if cur.description is not None:
+                        if COLUMNAR_RESULTS:
+                            rows = ColumnarResult.from_cursor(cur)
+                        else:
+                            rows = cur.fetchall()
+                        cols = [d.name for d in cur.description]
+                        row_count = len(rows)
+                    else:
+                        row_count = cur.rowcount
+                with timer.phase("execute"):
+                    conn.commit()
+
+            except Exception as e:
+                # Statement failed, but we still log the attempt
+                conn.rollback()
+                error_message = str(e)
+                status = _failure_status(e, job)
+            cur.close()
+
+    if cached is not None:
+        runtime_ns = timer.phases_ns["cache_lookup"]
+    else:
+        runtime_ns = timer.phases_ns.get("execute", 0) + timer.phases_ns.get("fetch", 0)
+    runtime_ms = _ns_to_ms(runtime_ns)
+
+    with timer.phase("serialize"):
+        if cached is None and error_message is None:
+            if cache_key is not None:
+                # Versions were read before executing, so a concurrent write makes
+                # the entry stale rather than wrong
+                _result_cache.put(cache_key, versions, parsed.tables, rows, cols, runtime_ms)
+            elif parsed.statement_type != "select":
+                _result_cache.invalidate_tables(parsed.tables)
+                if parsed.statement_type in ("create", "alter", "drop"):
+                    # CREATE OR REPLACE FUNCTION may have changed a volatility
+                    _function_volatility.clear()
+
+        record = _make_log_record(
+            sql_text,
+            runtime_ms,
+            row_count,
+            error_message,
+            parent_query_ids,
+            cache_hit=cached is not None,
+            status=status,
+            **_view_log_fields(views_used, runtime_ms),
+            **(log_fields or {}),
+        )
+    query_id = _log_timed_run(record, timer, runtime_ns)
+
+    if _snapshots is not None and error_message is None and cols:
+        _snapshot_rows(query_id, rows, cols)
+
+    if cached is None and error_message is None:
+        auto = (
+            PLAN_CAPTURE_MIN_MS is not None
+            and parsed.statement_type in STREAMABLE_STATEMENTS
+            and runtime_ms >= PLAN_CAPTURE_MIN_MS
+        )
+        if capture_plan or auto:
+            _capture_plan_in_background(query_id, exec_sql, statement_timeout_ms)
+    return (query_id, rows, cols, error_message), status
+
+
+# Asynchronous execution: submit_query() returns a job id at once; the
+# statement runs on a worker thread and can be polled or cancelled.
+JOB_WORKERS = 4
+_jobs = None
+_jobs_lock = threading.Lock()
+
+
+def _cancel_backend(pid):
+    # Needs the meta role to be the user role's member (or pg_signal_backend)
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_cancel_backend(%s)", (pid,))
+
+
+def _run_job(job, **kwargs):
+    return _run_query(job.sql_text, job=job, **kwargs)
+
+
+def _job_runner():
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            _jobs = JobRunner(_run_job, _cancel_backend, max_workers=JOB_WORKERS)
+        return _jobs
+
+
+def submit_query(
+    sql_text: str,
+    parent_query_ids=None,
+    stream=False,
+    page_size=None,
+    statement_timeout_ms=None,
+    capture_plan=False,
+    stream_owner=None,
+):
+    """
+    Run a statement in the background like run_query and return its job id.
+    Poll with get_job(job_id).info(); the job's result is run_query's tuple
+    once it is done. Cancelled and timed-out runs are logged with
+    qle.query.status 'cancelled' / 'timeout'.
+    """
+    job = _job_runner().submit(
+        sql_text,
+        parent_query_ids=list(parent_query_ids or []),
+        stream=stream,
+        page_size=page_size,
+        statement_timeout_ms=statement_timeout_ms,
+        capture_plan=capture_plan,
+        stream_owner=stream_owner,
+    )
+    return job.job_id
+
+
+def get_job(job_id: int):
+    """The qle_jobs.QueryJob for job_id, or None once it has been pruned."""
+    return _job_runner().get(job_id)
+
+
+def cancel_query(job_id: int):
+    """Cancel a queued or running job via pg_cancel_backend; False if it already finished."""
+    job = get_job(job_id)
+    if job is None:
+        return False
+    return job.cancel()
+
+
+def list_jobs():
+    return [job.info() for job in _job_runner().jobs()]
+
+
+# Branch replay: re-run a query and everything derived from it, e.g. after
+# the underlying data changed. Each re-execution is logged as a new query
+# with a 'rerun' edge from the original and 'derived' edges from the
+# re-executions of its parents, so the replayed branch mirrors the original.
+REPLAY_STATEMENTS = STREAMABLE_STATEMENTS  # others (DDL/DML) are skipped by default
+REPLAY_SKIP_EDGE_TYPES = ("rerun", "export")  # edges not followed down the branch
+
+
+def _load_replay_branch(root_query_id):
+    """
+    ({query_id: row with sql_text, runtime_ms, status}, {query_id: [parent ids]})
+    for root_query_id and its descendants along qle.edge. Queries no longer
+    in qle.query (archived) have a None row.
+    """
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                WITH RECURSIVE branch(query_id) AS (
+                    SELECT %s::int
+                    UNION
+                    SELECT e.child_query_id
+                    FROM qle.edge e
+                    JOIN branch b ON e.parent_query_id = b.query_id
+                    WHERE e.edge_type <> ALL(%s::text[])
+                )
+                SELECT b.query_id, q.runtime_ms, q.status, s.sql_text
+                FROM branch b
+                LEFT JOIN qle.query q ON q.query_id = b.query_id
+                LEFT JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                """,
+                (root_query_id, list(REPLAY_SKIP_EDGE_TYPES)),
+            )
+            nodes = {
+                r["query_id"]: (r if r["sql_text"] is not None else None)
+                for r in cur.fetchall()
+            }
+            cur.execute(
+                """
+                SELECT parent_query_id, child_query_id
+                FROM qle.edge
+                WHERE child_query_id = ANY(%s::int[])
+                  AND edge_type <> ALL(%s::text[])
+                ORDER BY parent_query_id
+                """,
+                (list(nodes), list(REPLAY_SKIP_EDGE_TYPES)),
+            )
+            parents = {query_id: [] for query_id in nodes}
+            for r in cur.fetchall():
+                parents[r["child_query_id"]].append(r["parent_query_id"])
+    return nodes, parents
+
+
+def replay_branch(root_query_id: int, max_workers=None, statement_timeout_ms=None, statements=None):
+    """
+    Re-execute root_query_id and its descendants, parents before children.
+    Queries whose parents have all been replayed run concurrently, up to
+    max_workers at a time (the "user" pool's maxconn by default). Results
+    are never served from the result cache, so runtimes are comparable.
+
+    Only statement types in `statements` (REPLAY_STATEMENTS by default) run;
+    skipped queries' children keep the original query as their parent.
+
+    Returns {"root_query_id", "queries", "replayed", "skipped", "failed",
+    "original_total_ms", "rerun_total_ms", "wall_ms"}, where "queries" has
+    one dict per query in the branch (query_id, rerun_query_id, status,
+    original_status, original_runtime_ms, runtime_ms, ratio, error_message),
+    in query_id order.
+    """
+    if max_workers is None:
+        max_workers = POOL_CONFIG["user"]["maxconn"]
+    if statements is None:
+        statements = REPLAY_STATEMENTS
+
+    flush_log()
+    nodes, parents = _load_replay_branch(root_query_id)
+    if nodes.get(root_query_id) is None:
+        raise ValueError("Unknown query_id")
+
+    # Edges inside the branch decide the order; the root's own parents are outside it
+    waiting = {}
+    children = {query_id: [] for query_id in nodes}
+    for query_id in nodes:
+        inside = []
+        if query_id != root_query_id:
+            inside = [p for p in parents[query_id] if p in nodes]
+        waiting[query_id] = len(inside)
+        for p in inside:
+            children[p].append(query_id)
+
+    replayed = {}  # original query_id -> rerun query_id
+    results = {}
+
+    def replay_one(query_id):
+        node = nodes[query_id]
+        comparison = {
+            "query_id": query_id,
+            "rerun_query_id": None,
+            "status": "skipped",
+            "original_status": None if node is None else node["status"],
+            "original_runtime_ms": None if node is None else node["runtime_ms"],
+            "runtime_ms": None,
+            "ratio": None,
+            "error_message": None,
+        }
+        if node is None or parse_sql(node["sql_text"]).statement_type not in statements:
+            return comparison
+        (rerun_id, _, _, error_message), status = _run_query(
+            node["sql_text"],
+            # Parents re-executed in this replay stand in for the originals
+            [replayed.get(p, p) for p in parents[query_id]],
+            False,
+            None,
+            statement_timeout_ms,
+            use_cache=False,
+            log_fields={"rerun_of_ids": [query_id]},
+        )
+        comparison.update(rerun_query_id=rerun_id, status=status, error_message=error_message)
+        return comparison
+
+    start = time.perf_counter_ns()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="qle-replay") as pool:
+        pending = {pool.submit(replay_one, root_query_id): root_query_id}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=pending.get):
+                query_id = pending.pop(future)
+                results[query_id] = comparison = future.result()
+                if comparison["rerun_query_id"] is not None:
+                    replayed[query_id] = comparison["rerun_query_id"]
+                for child in children[query_id]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        pending[pool.submit(replay_one, child)] = child
+    wall_ms = _ns_to_ms(time.perf_counter_ns() - start)
+
+    queries = [results[query_id] for query_id in sorted(results)]
+    # Runtimes as logged, measured the same way as the originals'
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT query_id, runtime_ms FROM qle.query WHERE query_id = ANY(%s::int[])",
+                (list(replayed.values()),),
+            )
+            runtimes = dict(cur.fetchall())
+    for c in queries:
+        if c["status"] == "ok":
+            c["runtime_ms"] = runtimes.get(c["rerun_query_id"])
+            if c["runtime_ms"] is not None and c["original_runtime_ms"]:
+                c["ratio"] = c["runtime_ms"] / c["original_runtime_ms"]
+    compared = [
+        c
+        for c in queries
+        if c["runtime_ms"] is not None and c["original_runtime_ms"] is not None
+    ]
+    return {
+        "root_query_id": root_query_id,
+        "queries": queries,
+        "replayed": sum(c["rerun_query_id"] is not None for c in queries),
+        "skipped": sum(c["status"] == "skipped" for c in queries),
+        "failed": sum(c["status"] not in ("ok", "skipped") for c in queries),
+        "original_total_ms": sum(c["original_runtime_ms"] for c in compared),
+        "rerun_total_ms": sum(c["runtime_ms"] for c in compared),
+        "wall_ms": wall_ms,
+    }
+
+
+# Plan capture: EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) of what a logged query
+# ran, stored in qle.query_plan. The plan comes from a second execution in a
+# transaction that is always rolled back, so data-modifying statements leave
+# no trace, but buffer hits reflect a warmer cache than the original run.
+PLAN_CAPTURE_MIN_MS = None  # auto_explain-style: capture SELECTs at least this slow
+EXPLAINABLE_STATEMENTS = ("select", "insert", "update", "delete", "values", "table", "merge")
+
+
+def _explain_analyze(sql_text, statement_timeout_ms=None):
+    with pooled_conn("user") as conn:
+        try:
+            _prepare_user_statement(conn, statement_timeout_ms, None)
+            with conn.cursor() as cur:
+                cur.execute(
+                    "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+                    + _strip_trailing_semicolons(sql_text)
+                )
+                plan = cur.fetchone()[0]
+        finally:
+            # EXPLAIN ANALYZE really runs the statement: never keep its effects
+            conn.rollback()
+    return plan
+
+
+def _store_plan(query_id, plan):
+    summary = qle_plans.summarize(plan)
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO qle.query_plan
+                    (query_id, plan, planning_ms, execution_ms, total_cost,
+                     shared_hit_blocks, shared_read_blocks)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (query_id) DO UPDATE
+                    SET plan = EXCLUDED.plan,
+                        captured_at = NOW(),
+                        planning_ms = EXCLUDED.planning_ms,
+                        execution_ms = EXCLUDED.execution_ms,
+                        total_cost = EXCLUDED.total_cost,
+                        shared_hit_blocks = EXCLUDED.shared_hit_blocks,
+                        shared_read_blocks = EXCLUDED.shared_read_blocks
+                """,
+                (
+                    query_id,
+                    psycopg2.extras.Json(plan),
+                    summary["planning_ms"],
+                    summary["execution_ms"],
+                    summary["total_cost"],
+                    summary["shared_hit_blocks"],
+                    summary["shared_read_blocks"],
+                ),
+            )
+        conn.commit()
+    return summary
+
+
+def _capture_plan_in_background(query_id, sql_text, statement_timeout_ms=None):
+    if parse_sql(sql_text).statement_type not in EXPLAINABLE_STATEMENTS:
+        return
+
+    def work():
+        try:
+            _store_plan(query_id, _explain_analyze(sql_text, statement_timeout_ms))
+        except Exception:
+            # Plans are diagnostic; a failed capture (or a deleted query) leaves none
+            pass
+
+    threading.Thread(target=work, name="qle-plan-capture", daemon=True).start()
+
+
+def capture_query_plan(query_id: int, statement_timeout_ms=None):
+    """Re-run a logged query under EXPLAIN ANALYZE now, store and return the plan summary."""
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT s.sql_text
+                FROM qle.query q
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                WHERE q.query_id = %s
+                """,
+                (query_id,),
+            )
+            row = cur.fetchone()
+    if not row:
+        raise ValueError("Unknown query_id")
+    if parse_sql(row[0]).statement_type not in EXPLAINABLE_STATEMENTS:
+        raise ValueError("Statement can't be explained")
+    return _store_plan(query_id, _explain_analyze(row[0], statement_timeout_ms))
+
+
+@_metrics.timed("qle_read_seconds", api="query_plan")
+def get_query_plan(query_id: int):
+    """Stored plan row for query_id (plan, captured_at, timings, ...) plus its summary, or None."""
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute("SELECT * FROM qle.query_plan WHERE query_id = %s", (query_id,))
+            row = cur.fetchone()
+    if row is not None:
+        row["summary"] = qle_plans.summarize(row["plan"])
+    return row
+
+
+def get_plan_diff(parent_query_id: int, child_query_id: int, capture_missing=False):
+    """
+    Diff the plans of two queries linked by a qle.edge (see qle_plans.diff):
+    changed node types and access paths, row-estimate errors, buffer
+    hits/reads and the execution-time ratio. With capture_missing=True,
+    queries without a stored plan are explained first; otherwise a missing
+    plan raises ValueError.
+    """
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT edge_type
+                FROM qle.edge
+                WHERE parent_query_id = %s AND child_query_id = %s
+                """,
+                (parent_query_id, child_query_id),
+            )
+            edge = cur.fetchone()
+    if edge is None:
+        raise ValueError(f"Q{child_query_id} is not a child of Q{parent_query_id}")
+
+    plans = []
+    for query_id in (parent_query_id, child_query_id):
+        row = get_query_plan(query_id)
+        if row is None:
+            if not capture_missing:
+                raise ValueError(f"No plan captured for Q{query_id}")
+            capture_query_plan(query_id)
+            row = get_query_plan(query_id)
+        plans.append(row["plan"])
+
+    result = qle_plans.diff(plans[0], plans[1])
+    result.update(
+        parent_query_id=parent_query_id,
+        child_query_id=child_query_id,
+        edge_type=edge[0],
+    )
+    return result
+
+
+def get_branch_plan_regressions(root_query_id: int, min_slowdown=1.5):
+    """
+    Walk the lineage below root_query_id and diff every parent -> child edge
+    where both plans are stored; returns the diffs whose child is at least
+    min_slowdown times slower than its parent, worst first.
+    """
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT b.parent_query_id, b.child_query_id
+                FROM qle.lineage_closure c
+                JOIN qle.edge b ON b.parent_query_id = c.descendant_id
+                JOIN qle.query_plan pp ON pp.query_id = b.parent_query_id
+                JOIN qle.query_plan cp ON cp.query_id = b.child_query_id
+                WHERE c.ancestor_id = %s
+                  AND cp.execution_ms >= %s * pp.execution_ms
+                """,
+                (root_query_id, min_slowdown),
+            )
+            edges = cur.fetchall()
+
+    diffs = [get_plan_diff(parent, child) for parent, child in edges]
+    diffs.sort(key=lambda d: d["slowdown"] or 0, reverse=True)
+    return diffs
+
+
+@_metrics.timed("qle_read_seconds", api="history")
+def get_query_history(limit=50):
+    return get_query_history_page(limit=limit)
+
+
+@_metrics.timed("qle_read_seconds", api="history")
+def get_query_history_page(limit=50, before_query_id=None, after_query_id=None):
+    """
+    Keyset-paginated history, newest first, ordered by (executed_at, query_id).
+
+    before_query_id: return the page of queries older than this one
+    after_query_id:  return the page of queries newer than this one
+    Tables are aggregated only for the rows on the returned page.
+    """
+    if before_query_id is not None and after_query_id is not None:
+        raise ValueError("Pass before_query_id or after_query_id, not both")
+
+    # The separate executed_at bound lets the planner skip partitions past
+    # the cursor, which the row comparison alone doesn't
+    cursor_row = "(SELECT c.executed_at, c.query_id FROM qle.query c WHERE c.query_id = %s)"
+    cursor_at = "(SELECT c.executed_at FROM qle.query c WHERE c.query_id = %s)"
+    if before_query_id is not None:
+        where, order, params = (
+            f"WHERE (q.executed_at, q.query_id) < {cursor_row} AND q.executed_at <= {cursor_at}",
+            "DESC",
+            (before_query_id, before_query_id, limit),
+        )
+    elif after_query_id is not None:
+        where, order, params = (
+            f"WHERE (q.executed_at, q.query_id) > {cursor_row} AND q.executed_at >= {cursor_at}",
+            "ASC",
+            (after_query_id, after_query_id, limit),
+        )
+    else:
+        where, order, params = "", "DESC", (limit,)
+
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                f"""
+                WITH page AS (
+                    SELECT q.query_id,
+                           q.executed_at,
+                           q.runtime_ms,
+                           q.row_count,
+                           q.status,
+                           q.error_message
+                    FROM qle.query q
+                    {where}
+                    ORDER BY q.executed_at {order}, q.query_id {order}
+                    LIMIT %s
+                )
+                SELECT p.*,
+                       COALESCE(
+                         (SELECT array_agg(DISTINCT qt.table_name)
+                          FROM qle.query_table qt
+                          WHERE qt.query_id = p.query_id
+                            AND qt.executed_at = p.executed_at),
+                         '{{}}'
+                       ) AS tables
+                FROM page p
+                ORDER BY p.executed_at DESC, p.query_id DESC
+                """,
+                params,
+            )
+            rows = cur.fetchall()
+    return rows
+
+
+LINEAGE_GRAPH_MAX_NODES = 500
+
+
+def _load_graph_nodes(hwm, extra_ids, limit):
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            if hwm is None:
+                where, params = "", (limit,)
+            else:
+                where, params = (
+                    "WHERE q.query_id > %s OR q.query_id = ANY(%s::int[])",
+                    (hwm, list(extra_ids), limit),
+                )
+            cur.execute(
+                f"""
+                SELECT q.query_id,
+                       q.executed_at,
+                       q.runtime_ms,
+                       q.row_count,
+                       q.status,
+                       q.error_message IS NOT NULL AS failed
+                FROM qle.query q
+                {where}
+                ORDER BY q.query_id DESC
+                LIMIT %s
+                """,
+                params,
+            )
+            return cur.fetchall()
+
+
+def _load_graph_edges(child_ids):
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT parent_query_id, child_query_id, edge_type
+                FROM qle.edge
+                WHERE child_query_id = ANY(%s::int[])
+                """,
+                (list(child_ids),),
+            )
+            return cur.fetchall()
+
+
+# Shared by every Streamlit session in this process. Changes made through this
+# module are applied incrementally; deletions made by other processes are only
+# picked up after invalidate_lineage_graph().
+_graph_cache = LineageGraphCache(
+    _load_graph_nodes, _load_graph_edges, max_nodes=LINEAGE_GRAPH_MAX_NODES
+)
+
+
+@_metrics.timed("qle_read_seconds", api="lineage_graph")
+def get_lineage_digraph():
+    """Return (graph, version): the cached lineage DiGraph (frozen) after applying deltas."""
+    return _graph_cache.refresh()
+
+
+def invalidate_lineage_graph():
+    _graph_cache.invalidate()
+
+
+@_metrics.timed("qle_read_seconds", api="lineage_graph")
+def get_lineage_graph():
+    """Return (nodes, edges) for visualization."""
+    G, _ = get_lineage_digraph()
+    nodes = [dict(data) for _, data in sorted(G.nodes(data=True), reverse=True)]
+    edges = [
+        {"parent_query_id": p, "child_query_id": c, "edge_type": d.get("edge_type")}
+        for p, c, d in G.edges(data=True)
+    ]
+    return nodes, edges
+
+
+# Ancestry queries answered from qle.lineage_closure (one indexed lookup,
+# no recursive walk). Depths are shortest-path hop counts.
+
+
+@_metrics.timed("qle_read_seconds", api="ancestry")
+def get_ancestors(query_id: int, max_depth=None):
+    """Ancestors of query_id as dicts (query_id, depth, executed_at, status), nearest first."""
+    return _closure_lookup("descendant_id", "ancestor_id", query_id, max_depth)
+
+
+@_metrics.timed("qle_read_seconds", api="ancestry")
+def get_descendants(query_id: int, max_depth=None):
+    """Descendants of query_id as dicts (query_id, depth, executed_at, status), nearest first."""
+    return _closure_lookup("ancestor_id", "descendant_id", query_id, max_depth)
+
+
+def _closure_lookup(from_col, to_col, query_id, max_depth):
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                f"""
+                SELECT c.{to_col} AS query_id,
+                       c.depth,
+                       COALESCE(q.executed_at, a.executed_at) AS executed_at,
+                       COALESCE(q.status, 'archived') AS status
+                FROM qle.lineage_closure c
+                LEFT JOIN qle.query q ON q.query_id = c.{to_col}
+                LEFT JOIN qle.archived_query a ON a.query_id = c.{to_col}
+                WHERE c.{from_col} = %s
+                  AND c.depth > 0
+                  AND (%s::int IS NULL OR c.depth <= %s::int)
+                ORDER BY c.depth, c.{to_col}
+                """,
+                (query_id, max_depth, max_depth),
+            )
+            return cur.fetchall()
+
+
+@_metrics.timed("qle_read_seconds", api="ancestry")
+def get_common_ancestors(query_ids, lowest_only=False):
+    """
+    Queries that are ancestors (or the query itself) of every id in query_ids,
+    as dicts (query_id, max_depth). lowest_only=True keeps only the lowest
+    common ancestors: those with no other common ancestor below them.
+    """
+    query_ids = sorted(set(query_ids))
+    if not query_ids:
+        return []
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                """
+                WITH common AS (
+                    SELECT c.ancestor_id AS query_id, MAX(c.depth) AS max_depth
+                    FROM qle.lineage_closure c
+                    WHERE c.descendant_id = ANY(%(ids)s::int[])
+                    GROUP BY c.ancestor_id
+                    HAVING COUNT(*) = %(n)s
+                )
+                SELECT cm.query_id, cm.max_depth
+                FROM common cm
+                WHERE NOT %(lowest)s
+                   OR NOT EXISTS (
+                        SELECT 1
+                        FROM qle.lineage_closure c
+                        JOIN common below ON below.query_id = c.descendant_id
+                        WHERE c.ancestor_id = cm.query_id AND c.depth > 0
+                   )
+                ORDER BY cm.max_depth, cm.query_id
+                """,
+                {"ids": query_ids, "n": len(query_ids), "lowest": lowest_only},
+            )
+            return cur.fetchall()
+
+
+@_metrics.timed("qle_read_seconds", api="ancestry")
+def get_neighborhood(query_id: int, k: int = 1, directed: bool = True):
+    """
+    Queries within k hops of query_id plus the edges among them: (nodes, edges).
+
+    directed=True: ancestors and descendants up to depth k (closure lookups).
+    directed=False: any path of k edges ignoring direction, so siblings and
+    cousins are included; expanded k times over the indexed edge endpoints.
+    """
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            if directed:
+                cur.execute(
+                    """
+                    SELECT c.descendant_id AS query_id, c.depth AS hops
+                    FROM qle.lineage_closure c
+                    WHERE c.ancestor_id = %(id)s AND c.depth <= %(k)s
+                    UNION
+                    SELECT c.ancestor_id, c.depth
+                    FROM qle.lineage_closure c
+                    WHERE c.descendant_id = %(id)s AND c.depth BETWEEN 1 AND %(k)s
+                    """,
+                    {"id": query_id, "k": k},
+                )
+            else:
+                cur.execute(
+                    """
+                    WITH RECURSIVE hood(query_id, hops) AS (
+                        SELECT %(id)s::int, 0
+                        UNION
+                        SELECT CASE WHEN e.parent_query_id = h.query_id
+                                    THEN e.child_query_id
+                                    ELSE e.parent_query_id END,
+                               h.hops + 1
+                        FROM hood h
+                        JOIN qle.edge e
+                          ON h.query_id IN (e.parent_query_id, e.child_query_id)
+                        WHERE h.hops < %(k)s
+                    )
+                    SELECT query_id, MIN(hops) AS hops
+                    FROM hood
+                    GROUP BY query_id
+                    """,
+                    {"id": query_id, "k": k},
+                )
+            hops = {r["query_id"]: r["hops"] for r in cur.fetchall()}
+            if not hops:
+                return [], []
+            ids = sorted(hops)
+            cur.execute(
+                """
+                SELECT q.query_id, q.executed_at, q.runtime_ms, q.status
+                FROM qle.query q
+                WHERE q.query_id = ANY(%s::int[])
+                ORDER BY q.query_id
+                """,
+                (ids,),
+            )
+            nodes = [dict(r, hops=hops[r["query_id"]]) for r in cur.fetchall()]
+            cur.execute(
+                """
+                SELECT e.parent_query_id, e.child_query_id, e.edge_type
+                FROM qle.edge e
+                WHERE e.child_query_id = ANY(%(ids)s::int[])
+                  AND e.parent_query_id = ANY(%(ids)s::int[])
+                """,
+                {"ids": ids},
+            )
+            edges = cur.fetchall()
+    return nodes, edges
+
+
+@_metrics.timed("qle_read_seconds", api="ancestry")
+def get_branch_tables(query_id: int):
+    """Base tables referenced anywhere in the branch rooted at query_id, with query counts."""
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT qt.table_name, COUNT(DISTINCT qt.query_id) AS queries
+                FROM qle.lineage_closure c
+                JOIN qle.query_table qt ON qt.query_id = c.descendant_id
+                WHERE c.ancestor_id = %s
+                GROUP BY qt.table_name
+                ORDER BY queries DESC, qt.table_name
+                """,
+                (query_id,),
+            )
+            return cur.fetchall()
+
+
+# Automatic parent inference: queries logged without parents (typed by
+# hand, or ingested) get 'inferred' edges to the most similar earlier
+# queries. Similarity is MinHash over SQL token shingles; candidates come
+# from an LSH index of recent queries, so a lookup doesn't scan the history.
+INFERENCE_THRESHOLD = 0.7  # minimum estimated Jaccard similarity of shingle sets
+INFERENCE_NUM_PERM = 128  # MinHash functions per signature
+INFERENCE_INDEX_SIZE = 100_000  # most recent successful queries kept indexed
+INFERENCE_MAX_PARENTS = 1  # parents proposed per query
+
+# {"hasher", "index", "max_parents"} while inference is enabled, else None
+_inference = None
+
+
+def enable_lineage_inference(threshold=None, num_perm=None, index_size=None, max_parents=None):
+    """
+    Index the most recent successful queries and start proposing parents
+    for queries logged without any. Building the index signs every
+    indexed statement once; queries logged afterwards are added as they go.
+    """
+    global _inference
+    hasher = MinHasher(num_perm or INFERENCE_NUM_PERM)
+    index = LSHIndex(
+        threshold=threshold or INFERENCE_THRESHOLD,
+        num_perm=hasher.num_perm,
+        max_entries=index_size or INFERENCE_INDEX_SIZE,
+    )
+    flush_log()
+    with pooled_conn("meta") as conn:
+        # Oldest first, so the index evicts in the same order later on
+        with conn.cursor(name="qle_inference_index") as cur:
+            cur.itersize = 5000
+            cur.execute(
+                """
+                SELECT recent.query_id, s.sql_text
+                FROM (
+                    SELECT query_id, sql_hash
+                    FROM qle.query
+                    WHERE status = 'ok'
+                    ORDER BY query_id DESC
+                    LIMIT %s
+                ) recent
+                JOIN qle.sql_text s ON s.sql_hash = recent.sql_hash
+                ORDER BY recent.query_id
+                """,
+                (index.max_entries,),
+            )
+            for query_id, sql_text in cur:
+                index.add(query_id, hasher.signature_of(sql_text))
+        conn.rollback()
+    _inference = {
+        "hasher": hasher,
+        "index": index,
+        "max_parents": max_parents or INFERENCE_MAX_PARENTS,
+    }
+
+
+def disable_lineage_inference():
+    global _inference
+    _inference = None
+
+
+def inference_stats():
+    inference = _inference
+    if inference is None:
+        return {"enabled": False}
+    return dict(inference["index"].info(), enabled=True, max_parents=inference["max_parents"])
+
+
+def _infer_parents(record):
+    """
+    Sign a successful record for the index; if it has no parents, propose
+    some (record["inferred_parent_ids"]). Returns (index, signature), or
+    (None, None) while inference is off.
+    """
+    inference = _inference
+    if inference is None or record["status"] != "ok":
+        return None, None
+    index = inference["index"]
+    signature = inference["hasher"].signature_of(record["sql_text"])
+    if not record["parent_query_ids"] and not record.get("rerun_of_ids"):
+        # Only checked against the log when the index has something to offer
+        candidates = index.similar(signature)
+        if candidates:
+            usable = _usable_parents([query_id for query_id, _ in candidates], record["sql_hash"])
+            record["inferred_parent_ids"] = [
+                query_id for query_id, _ in candidates if query_id in usable
+            ][: inference["max_parents"]]
+    return index, signature
+
+
+def _usable_parents(candidates, sql_hash):
+    """
+    The candidates that can still be proposed as parents of a new query
+    with this text: logged (or still queued for writing, or kept in
+    qle.archived_query), and not rejected as a parent of an earlier run of
+    the same statement.
+    """
+    # Before the lookup: a record written meanwhile is then seen either way
+    queued = _logger.queued_ids() if _logger is not None else set()
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT p,
+                       EXISTS (SELECT 1 FROM qle.query q WHERE q.query_id = p)
+                    OR EXISTS (SELECT 1 FROM qle.archived_query a WHERE a.query_id = p),
+                       EXISTS (
+                           SELECT 1
+                           FROM qle.inference_rejection r
+                           JOIN qle.query c ON c.query_id = r.child_query_id
+                           WHERE r.parent_query_id = p AND c.sql_hash = %s
+                       )
+                FROM unnest(%s::int[]) AS p
+                """,
+                (sql_hash, list(candidates)),
+            )
+            rows = cur.fetchall()
+        conn.rollback()
+    return {p for p, present, rejected in rows if (present or p in queued) and not rejected}
+
+
+def infer_lineage(query_ids=None, apply=True):
+    """
+    Propose parents for queries that have none: those in query_ids, or by
+    default every such query in the index. Parents are always older than
+    their child, and pairs rejected before are not proposed again.
+    Returns [{"parent_query_id", "child_query_id", "similarity"}]; with
+    apply=True they are stored as 'inferred' edges.
+    """
+    inference = _inference
+    if inference is None:
+        raise RuntimeError("Lineage inference is not enabled")
+    hasher, index = inference["hasher"], inference["index"]
+    flush_log()
+    with pooled_conn("meta") as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        try:
+            cur.execute(
+                """
+                SELECT q.query_id, q.executed_at, s.sql_text
+                FROM qle.query q
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                WHERE q.status = 'ok'
+                  AND q.query_id = ANY(%s::int[])
+                  AND NOT EXISTS (
+                      SELECT 1 FROM qle.edge e WHERE e.child_query_id = q.query_id
+                  )
+                ORDER BY q.query_id
+                """,
+                (sorted(query_ids) if query_ids is not None else index.keys(),),
+            )
+            roots = cur.fetchall()
+            cur.execute(
+                """
+                SELECT parent_query_id, child_query_id
+                FROM qle.inference_rejection
+                WHERE child_query_id = ANY(%s::int[])
+                """,
+                ([r["query_id"] for r in roots],),
+            )
+            rejected = {(r["parent_query_id"], r["child_query_id"]) for r in cur.fetchall()}
+
+            proposals = []
+            for root in roots:
+                child = root["query_id"]
+                signature = index.signature(child)
+                if signature is None:
+                    signature = hasher.signature_of(root["sql_text"])
+                for parent, score in index.similar(
+                    signature,
+                    limit=inference["max_parents"],
+                    accept=lambda p: p < child and (p, child) not in rejected,
+                ):
+                    proposals.append(
+                        {
+                            "parent_query_id": parent,
+                            "child_query_id": child,
+                            "child_executed_at": root["executed_at"],
+                            "similarity": round(score, 3),
+                        }
+                    )
+
+            if apply and proposals:
+                _check_parents(cur, [p["parent_query_id"] for p in proposals])
+                psycopg2.extras.execute_values(
+                    cur,
+                    """
+                    INSERT INTO qle.edge (parent_query_id, child_query_id, child_executed_at, edge_type)
+                    SELECT v.parent_id, v.child_id, v.child_executed_at, 'inferred'
+                    FROM (VALUES %s) AS v(parent_id, child_id, child_executed_at)
+                    """,
+                    [
+                        (p["parent_query_id"], p["child_query_id"], p["child_executed_at"])
+                        for p in proposals
+                    ],
+                )
+                # Children in id order: a proposal's parent may itself have
+                # just been linked
+                by_child = {}
+                for p in proposals:
+                    by_child.setdefault(p["child_query_id"], []).append(p["parent_query_id"])
+                for child in sorted(by_child):
+                    _link_closure(cur, by_child[child], child)
+                conn.commit()
+            else:
+                conn.rollback()
+        except Exception as e:
+            conn.rollback()
+            cur.close()
+            raise e
+        cur.close()
+
+    if apply and proposals:
+        _graph_cache.note_added(sorted({p["child_query_id"] for p in proposals}))
+    for p in proposals:
+        del p["child_executed_at"]
+    return proposals
+
+
+def confirm_inferred_edge(parent_query_id: int, child_query_id: int):
+    """Keep an inferred edge as an ordinary 'derived' one."""
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE qle.edge
+                SET edge_type = 'derived'
+                WHERE parent_query_id = %s AND child_query_id = %s AND edge_type = 'inferred'
+                """,
+                (parent_query_id, child_query_id),
+            )
+            updated = cur.rowcount
+        conn.commit()
+    if updated:
+        _graph_cache.note_added([child_query_id])
+    return bool(updated)
+
+
+def reject_inferred_edge(parent_query_id: int, child_query_id: int):
+    """Remove an inferred edge; infer_lineage won't propose the pair again."""
+    with pooled_conn("meta") as conn:
+        cur = conn.cursor()
+
+        try:
+            cur.execute(
+                """
+                DELETE FROM qle.edge
+                WHERE parent_query_id = %s AND child_query_id = %s AND edge_type = 'inferred'
+                """,
+                (parent_query_id, child_query_id),
+            )
+            removed = cur.rowcount
+            if removed:
+                cur.execute(
+                    """
+                    INSERT INTO qle.inference_rejection (parent_query_id, child_query_id)
+                    VALUES (%s, %s)
+                    ON CONFLICT DO NOTHING
+                    """,
+                    (parent_query_id, child_query_id),
+                )
+                # The child's subtree may have reached ancestors only through this edge
+                cur.execute(
+                    "SELECT descendant_id FROM qle.lineage_closure WHERE ancestor_id = %s",
+                    (child_query_id,),
+                )
+                _repair_closure(cur, [r[0] for r in cur.fetchall()])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            cur.close()
+            raise e
+        cur.close()
+    if removed:
+        # Edge removals aren't applied incrementally
+        _graph_cache.invalidate()
+    return bool(removed)
+
+
+# Orderings accepted by get_fingerprint_stats
+_FINGERPRINT_ORDER = {
+    "total": "f.runtime_sum_ms DESC",
+    "p95": "f.p95_ms DESC NULLS LAST",
+    "mean": "f.mean_ms DESC NULLS LAST",
+    "executions": "f.executions DESC",
+    "last_seen": "f.last_seen DESC",
+}
+
+
+@_metrics.timed("qle_read_seconds", api="fingerprint_stats")
+def get_fingerprint_stats(order_by="total", limit=50, min_executions=1, fingerprint=None):
+    """
+    Per-statement-shape aggregates from qle.fingerprint_stats: executions,
+    errors, mean / p95 runtime of successful runs (p95 to within one
+    histogram bucket, ~19%), total runtime, first / last seen and a sample
+    text. order_by: "total", "p95", "mean", "executions" or "last_seen".
+    Counts cover every execution logged since the last clear_history().
+    """
+    if order_by not in _FINGERPRINT_ORDER:
+        raise ValueError(f"order_by must be one of {sorted(_FINGERPRINT_ORDER)}")
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                f"""
+                SELECT f.fingerprint,
+                       f.executions,
+                       f.errors,
+                       f.mean_ms,
+                       f.p95_ms,
+                       f.runtime_sum_ms AS total_ms,
+                       f.first_seen,
+                       f.last_seen,
+                       s.sql_text AS sample_sql
+                FROM qle.fingerprint_stats f
+                JOIN qle.sql_text s ON s.sql_hash = f.sample_sql_hash
+                WHERE f.executions >= %s
+                  AND (%s::text IS NULL OR f.fingerprint = %s::text)
+                ORDER BY {_FINGERPRINT_ORDER[order_by]}
+                LIMIT %s
+                """,
+                (min_executions, fingerprint, fingerprint, limit),
+            )
+            return cur.fetchall()
+
+
+@_metrics.timed("qle_read_seconds", api="query_details")
+def get_query_details(query_id: int):
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT q.*, s.sql_text
+                FROM qle.query q
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                WHERE q.query_id = %s
+                """,
+                (query_id,),
+            )
+            q = cur.fetchone()
+
+            cur.execute(
+                """
+                SELECT table_name
+                FROM qle.query_table
+                WHERE query_id = %s
+                """,
+                (query_id,),
+            )
+            tables = [r["table_name"] for r in cur.fetchall()]
+
+            # Get pinned view if any
+            cur.execute(
+                """
+                SELECT pv.*
+                FROM qle.pinned_view pv
+                JOIN qle.query q2 ON q2.pinned_view_id = pv.view_id
+                WHERE q2.query_id = %s
+                """,
+                (query_id,),
+            )
+            pv = cur.fetchone()
+
+    return q, tables, pv
+
+
+def pin_query_as_view(query_id: int, pinned_by: str = "user"):
+    """
+    Create a materialized view from the query's SQL and log it.
+    pinned_by: "user" for manual pins, "advisor" for qle_advisor's auto-pins.
+    """
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            # Get SQL text
+            cur.execute(
+                """
+                SELECT s.sql_text
+                FROM qle.query q
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                WHERE q.query_id = %s
+                """,
+                (query_id,),
+            )
+            row = cur.fetchone()
+            if not row:
+                raise ValueError("Unknown query_id")
+            sql_text = row["sql_text"]
+
+            view_name = f"qle_view_{query_id}"
+
+            # Source versions are read before the view is filled, so a write
+            # racing with it shows up as staleness rather than being missed
+            source_versions = _source_versions(cur, sql_text)
+
+            # Create materialized view; re-pinning refreshes an existing one so
+            # its contents match the versions recorded below
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (view_name,))
+            if cur.fetchone()["present"]:
+                cur.execute(f"REFRESH MATERIALIZED VIEW {view_name}")
+            else:
+                cur.execute(f"CREATE MATERIALIZED VIEW {view_name} AS {sql_text};")
+
+            # Measure storage
+            cur.execute(
+                "SELECT pg_relation_size(%s::regclass) AS bytes",
+                (view_name,),
+            )
+            storage_bytes = cur.fetchone()["bytes"]
+
+            # Insert into pinned_view
+            cur.execute(
+                """
+                INSERT INTO qle.pinned_view
+                    (query_id, view_name, storage_bytes, pinned_by, source_versions)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (view_name) DO UPDATE
+                    SET storage_bytes = EXCLUDED.storage_bytes,
+                        source_versions = EXCLUDED.source_versions,
+                        refreshed_at = NOW()
+                RETURNING view_id
+                """,
+                (query_id, view_name, storage_bytes, pinned_by, source_versions),
+            )
+            view_id = cur.fetchone()["view_id"]
+
+            # Update qle.query
+            cur.execute(
+                """
+                UPDATE qle.query
+                SET pinned_view_id = %s
+                WHERE query_id = %s
+                """,
+                (view_id, query_id),
+            )
+
+        conn.commit()
+    invalidate_pinned_views()
+    return view_id, view_name, storage_bytes
+
+
+@_metrics.timed("qle_read_seconds", api="pinned_views")
+def list_pinned_views():
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT pv.view_id,
+                       pv.view_name,
+                       pv.storage_bytes,
+                       pv.created_at,
+                       pv.pinned_by,
+                       pv.refreshed_at,
+                       pv.refresh_ms,
+                       pv.refresh_concurrently,
+                       q.query_id,
+                       q.executed_at,
+                       s.sql_text
+                FROM qle.pinned_view pv
+                JOIN qle.query q ON q.query_id = pv.query_id
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                ORDER BY pv.created_at DESC
+                """
+            )
+            rows = cur.fetchall()
+    return rows
+
+
+@_metrics.timed("qle_read_seconds", api="preview_view")
+def preview_view(view_name: str, limit: int = 50):
+    """Return (rows, cols) from the materialized view."""
+    with pooled_conn("user") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(f"SELECT * FROM {view_name} LIMIT %s;", (limit,))
+            rows = cur.fetchall()
+            cols = [d.name for d in cur.description]
+    return rows, cols
+
+
+def _drop_pinned_view(cur, view_id, view_name):
+    # Drop the actual materialized view in the database
+    cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view_name} CASCADE;")
+
+    # Clear pinned_view_id from any queries pointing to this view
+    cur.execute(
+        """
+        UPDATE qle.query
+        SET pinned_view_id = NULL
+        WHERE pinned_view_id = %s
+        """,
+        (view_id,),
+    )
+
+    # Delete the pinned_view metadata row
+    cur.execute(
+        """
+        DELETE FROM qle.pinned_view
+        WHERE view_id = %s
+        """,
+        (view_id,),
+    )
 
 
-def get_conn():
-    return psycopg2.connect(DSN)
+def _drop_pinned_views(cur, views):
+    """_drop_pinned_view for many (view_id, view_name) rows, one statement per step."""
+    names = ", ".join(v["view_name"] for v in views)
+    view_ids = [v["view_id"] for v in views]
+    cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {names} CASCADE;")
+    cur.execute(
+        """
+        UPDATE qle.query
+        SET pinned_view_id = NULL
+        WHERE pinned_view_id = ANY(%s::int[])
+        """,
+        (view_ids,),
+    )
+    cur.execute(
+        """
+        DELETE FROM qle.pinned_view
+        WHERE view_id = ANY(%s::int[])
+        """,
+        (view_ids,),
+    )
 
 
-# Naive table name extractor for FROM / JOIN clauses
-TABLE_REGEX = re.compile(
-    r"\bFROM\s+([a-zA-Z0-9_\.]+)|\bJOIN\s+([a-zA-Z0-9_\.]+)",
-    re.IGNORECASE,
-)
+def unpin_view(view_id: int):
+    """Drop a pinned materialized view and its metadata; the originating query stays."""
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                "SELECT view_name FROM qle.pinned_view WHERE view_id = %s", (view_id,)
+            )
+            row = cur.fetchone()
+            if not row:
+                raise ValueError("Unknown view_id")
+            _drop_pinned_view(cur, view_id, row["view_name"])
+        conn.commit()
+    invalidate_pinned_views()
 
 
-def extract_table_names(sql_text: str):
-    tables = set()
-    for m in TABLE_REGEX.finditer(sql_text):
-        t1, t2 = m.groups()
-        t = t1 or t2
-        if t:
-            tables.add(t.strip())
-    return sorted(tables)
+# Streaming export: COPY (...) TO STDOUT writes the result straight to the
+# destination in EXPORT_CHUNK_BYTES pieces, so memory use doesn't depend on
+# the result size. Each export is logged as a child of its source query.
+EXPORT_DIR = "qle_exports"  # where exports without an explicit destination go
+EXPORT_FORMATS = ("csv", "binary")
+EXPORT_COMPRESSION = (None, "gzip")
+EXPORT_CHUNK_BYTES = 1 << 16
+EXPORT_GZIP_LEVEL = 6
 
 
-def run_query(sql_text: str, parent_query_ids=None):
-    """
-    Execute SQL, log it, and return (query_id, rows, cols, error_message).
-    parent_query_ids: list[int] or None
-    """
-    parent_query_ids = parent_query_ids or []
-    conn = get_conn()
-    conn.autocommit = False
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+class _CountingWriter:
+    """Binary file-like wrapper that counts the bytes written through it."""
 
-    start = time.time()
-    error_message = None
-    rows = []
-    cols = []
-    row_count = None
-    runtime_ms = None
+    def __init__(self, f):
+        self._f = f
+        self.bytes = 0
 
-    try:
-        cur.execute(sql_text)
-        runtime_ms = int((time.time() - start) * 1000)
+    def write(self, data):
+        self._f.write(data)
+        self.bytes += len(data)
+        return len(data)
 
-        if cur.description is not None:
-            rows = cur.fetchall()
-            cols = [d.name for d in cur.description]
-            row_count = len(rows)
-        else:
-            row_count = cur.rowcount
+    def flush(self):
+        if hasattr(self._f, "flush"):
+            self._f.flush()
 
-    except Exception as e:
-        # Statement failed, but we still log the attempt
-        conn.rollback()
-        error_message = str(e)
-        runtime_ms = int((time.time() - start) * 1000)
 
-    # Log into qle.query
-    cur.execute(
-        """
-        INSERT INTO qle.query (sql_text, runtime_ms, row_count, error_message)
-        VALUES (%s, %s, %s, %s)
-        RETURNING query_id
-        """,
-        (sql_text, runtime_ms, row_count, error_message),
-    )
-    query_id = cur.fetchone()["query_id"]
+def export_query(query_id: int, dest=None, fmt="csv", compression=None, statement_timeout_ms=None):
+    """
+    Re-run a logged SELECT and stream its result to dest with COPY.
 
-    # Log tables if execution succeeded
-    if error_message is None:
-        tables = extract_table_names(sql_text)
-        for t in tables:
+    dest: a path, a binary file-like object (anything with write(), e.g. an
+          HTTP response), or None for a new file under EXPORT_DIR
+    fmt: "csv" (with a header row) or "binary" (Postgres binary COPY format)
+    compression: None or "gzip"
+    Returns {"query_id" (of the logged export), "path", "rows", "bytes", "runtime_ms"}.
+    """
+    flush_log()
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
-                INSERT INTO qle.query_table (query_id, table_name)
-                VALUES (%s, %s)
+                SELECT s.sql_text
+                FROM qle.query q
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                WHERE q.query_id = %s
                 """,
-                (query_id, t),
+                (query_id,),
             )
+            row = cur.fetchone()
+    if not row:
+        raise ValueError("Unknown query_id")
+    if parse_sql(row[0]).statement_type not in STREAMABLE_STATEMENTS:
+        # COPY would run a data-modifying statement again
+        raise ValueError("Only SELECT / VALUES / TABLE queries can be exported")
+    return _export(
+        _strip_trailing_semicolons(row[0]),
+        query_id,
+        f"q{query_id}",
+        dest,
+        fmt,
+        compression,
+        statement_timeout_ms,
+    )
 
-    # Log lineage edges
-    for pid in parent_query_ids:
-        cur.execute(
-            """
-            INSERT INTO qle.edge (parent_query_id, child_query_id, edge_type)
-            VALUES (%s, %s, %s)
-            """,
-            (pid, query_id, "derived"),
-        )
 
-    conn.commit()
-    cur.close()
-    conn.close()
-    return query_id, rows, cols, error_message
+def export_view(view_id: int, dest=None, fmt="csv", compression=None, statement_timeout_ms=None):
+    """Stream a pinned view's contents to dest; see export_query. Logged under the view's query."""
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT view_name, query_id FROM qle.pinned_view WHERE view_id = %s",
+                (view_id,),
+            )
+            row = cur.fetchone()
+    if not row:
+        raise ValueError("Unknown view_id")
+    view_name, query_id = row
+    return _export(
+        f"SELECT * FROM {view_name}",
+        query_id,
+        view_name,
+        dest,
+        fmt,
+        compression,
+        statement_timeout_ms,
+    )
 
 
-def get_query_history(limit=50):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(
-        """
-        SELECT q.query_id,
-               q.executed_at,
-               q.runtime_ms,
-               q.row_count,
-               q.error_message,
-               COALESCE(
-                 array_agg(DISTINCT qt.table_name)
-                 FILTER (WHERE qt.table_name IS NOT NULL),
-                 '{}'
-               ) AS tables
-        FROM qle.query q
-        LEFT JOIN qle.query_table qt ON q.query_id = qt.query_id
-        GROUP BY q.query_id
-        ORDER BY q.executed_at DESC
-        LIMIT %s
-        """,
-        (limit,),
+def _export(select_sql, parent_id, label, dest, fmt, compression, statement_timeout_ms):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"fmt must be one of {EXPORT_FORMATS}")
+    if compression not in EXPORT_COMPRESSION:
+        raise ValueError(f"compression must be one of {EXPORT_COMPRESSION}")
+    options = "FORMAT csv, HEADER" if fmt == "csv" else "FORMAT binary"
+    copy_sql = f"COPY ({select_sql}) TO STDOUT WITH ({options})"
+
+    if dest is None:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        ext = (".csv" if fmt == "csv" else ".bin") + (".gz" if compression else "")
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        dest = os.path.join(EXPORT_DIR, f"{label}-{stamp}{ext}")
+    path = None
+    if isinstance(dest, (str, os.PathLike)):
+        # Written under a temporary name, so a failed export leaves nothing behind
+        path = os.fspath(dest)
+        f = open(path + ".tmp", "wb")
+    else:
+        f = dest
+    counter = _CountingWriter(f)
+
+    error, rows = None, None
+    start = time.perf_counter_ns()
+    try:
+        out = counter
+        if compression == "gzip":
+            out = gzip.GzipFile(fileobj=counter, mode="wb", compresslevel=EXPORT_GZIP_LEVEL)
+        with pooled_conn("user") as conn:
+            try:
+                _prepare_user_statement(conn, statement_timeout_ms, None)
+                with conn.cursor() as cur:
+                    cur.copy_expert(copy_sql, out, size=EXPORT_CHUNK_BYTES)
+                    rows = cur.rowcount
+            finally:
+                conn.rollback()
+        if out is not counter:
+            out.close()  # writes the gzip trailer; leaves f open
+    except Exception as e:
+        error = e
+    finally:
+        if path is not None:
+            f.close()
+            if error is None:
+                os.replace(path + ".tmp", path)
+            else:
+                os.remove(path + ".tmp")
+    runtime_ns = time.perf_counter_ns() - start
+
+    record = _make_log_record(
+        copy_sql,
+        _ns_to_ms(runtime_ns),
+        rows,
+        None if error is None else str(error),
+        [parent_id],
+        status="ok" if error is None else _failure_status(error),
+        edge_type="export",
+        runtime_us=runtime_ns // 1000,
     )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
+    export_id = _log_query(record)
+    if error is not None:
+        raise error
+    return {
+        "query_id": export_id,
+        "path": path,
+        "rows": rows,
+        "bytes": counter.bytes,
+        "runtime_ms": record["runtime_ms"],
+    }
 
 
-def get_lineage_graph():
-    """Return (nodes, edges) for visualization."""
-    nodes = get_query_history(limit=500)
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT * FROM qle.edge")
-    edges = cur.fetchall()
-    cur.close()
-    conn.close()
-    return nodes, edges
+# Background refresh of pinned views. Staleness is judged against the same
+# version vectors as the result cache, recorded in qle.pinned_view.source_versions
+# at pin / refresh time. Views over sources without counters (e.g. plain views)
+# are treated as stale once REFRESH_MAX_AGE seconds old.
+REFRESH_INTERVAL = 30.0  # seconds between staleness checks
+REFRESH_MAX_AGE = 3600.0
+REFRESH_LOCK_TIMEOUT_MS = 5000  # give up rather than queue behind (and block) readers
 
+_refresher = None
+_stale_view_ids = set()
+_stale_lock = threading.Lock()
 
-def get_query_details(query_id: int):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    cur.execute("SELECT * FROM qle.query WHERE query_id = %s", (query_id,))
-    q = cur.fetchone()
+def _source_versions(cur, sql_text):
+    """Version vector of a view's source tables as a JSON value, or None if untracked."""
+    tables = parse_sql(sql_text).tables
+    if not tables:
+        return None
+    versions = _table_versions(cur.connection, tables)
+    if versions is None:
+        return None
+    return psycopg2.extras.Json([list(v) for v in versions])
+
+
+@_metrics.timed("qle_read_seconds", api="stale_views")
+def get_stale_views():
+    """
+    Pinned views whose source tables changed since their last pin/refresh,
+    oldest first: list of dicts with view_id, view_name, changed_tables
+    (None when staleness is judged by age only) and refreshed_at.
+    """
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=_TimedRealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT pv.view_id,
+                       pv.view_name,
+                       pv.source_versions,
+                       COALESCE(pv.refreshed_at, pv.created_at) AS refreshed_at,
+                       EXTRACT(EPOCH FROM NOW() - COALESCE(pv.refreshed_at, pv.created_at))
+                           AS age_s,
+                       s.sql_text
+                FROM qle.pinned_view pv
+                JOIN qle.query q ON q.query_id = pv.query_id
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                ORDER BY refreshed_at
+                """
+            )
+            views = cur.fetchall()
+            tables = set()
+            for v in views:
+                tables.update(parse_sql(v["sql_text"]).tables)
+            current = _table_version_map(conn, tables) if tables else {}
+
+    stale = []
+    for v in views:
+        names = parse_sql(v["sql_text"]).tables
+        now_versions = [current.get(n) for n in names]
+        if not names or any(x is None for x in now_versions):
+            if v["age_s"] >= REFRESH_MAX_AGE:
+                stale.append(dict(v, changed_tables=None))
+            continue
+        recorded = {row[0]: row for row in (v["source_versions"] or [])}
+        changed = [n for n in names if recorded.get(n) != list(current[n])]
+        if changed:
+            stale.append(dict(v, changed_tables=changed))
+    for v in stale:
+        del v["sql_text"], v["source_versions"], v["age_s"]
+    return stale
+
 
+def _ensure_unique_index(cur, view_name):
+    """
+    Make sure the view has the unique index REFRESH ... CONCURRENTLY needs,
+    building one over all columns if necessary. Returns False if that isn't
+    possible (duplicate rows, columns without a btree opclass, ...).
+    """
     cur.execute(
         """
-        SELECT table_name
-        FROM qle.query_table
-        WHERE query_id = %s
+        SELECT 1
+        FROM pg_index i
+        WHERE i.indrelid = %s::regclass
+          AND i.indisunique
+          AND i.indpred IS NULL
+          AND 0 <> ALL (i.indkey)
         """,
-        (query_id,),
+        (view_name,),
     )
-    tables = [r["table_name"] for r in cur.fetchall()]
-
-    # Get pinned view if any
+    if cur.fetchone():
+        return True
     cur.execute(
         """
-        SELECT pv.*
-        FROM qle.pinned_view pv
-        JOIN qle.query q2 ON q2.pinned_view_id = pv.view_id
-        WHERE q2.query_id = %s
+        SELECT quote_ident(attname)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
         """,
-        (query_id,),
+        (view_name,),
     )
-    pv = cur.fetchone()
+    cols = [row[0] for row in cur.fetchall()]
+    cur.execute("SAVEPOINT qle_unique_index")
+    try:
+        cur.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {view_name}_row_key "
+            f"ON {view_name} ({', '.join(cols)})"
+        )
+    except psycopg2.errors.LockNotAvailable:
+        raise
+    except psycopg2.Error:
+        cur.execute("ROLLBACK TO SAVEPOINT qle_unique_index")
+        return False
+    cur.execute("RELEASE SAVEPOINT qle_unique_index")
+    return True
 
-    cur.close()
-    conn.close()
-    return q, tables, pv
 
+def refresh_pinned_view(view_id: int, concurrently: bool = True):
+    """
+    Refresh one pinned view on the "refresh" pool and record refreshed_at,
+    refresh_ms, the new storage_bytes and source versions. Uses
+    REFRESH ... CONCURRENTLY (readers aren't blocked) when the view has or
+    can get a unique index, a plain REFRESH otherwise.
+    Returns the updated qle.pinned_view row, or None if the view is gone.
+    """
+    with pooled_conn("refresh") as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            try:
+                cur.execute(
+                    """
+                    SELECT pv.view_name, pv.refresh_concurrently, s.sql_text
+                    FROM qle.pinned_view pv
+                    JOIN qle.query q ON q.query_id = pv.query_id
+                    JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                    WHERE pv.view_id = %s
+                    """,
+                    (view_id,),
+                )
+                row = cur.fetchone()
+                if not row:
+                    return None
+                view_name = row["view_name"]
+                cur.execute("SET LOCAL lock_timeout = %s", (REFRESH_LOCK_TIMEOUT_MS,))
 
-def pin_query_as_view(query_id: int):
-    """Create a materialized view from the query's SQL and log it."""
-    conn = get_conn()
-    conn.autocommit = False
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+                # NULL = not tried yet; FALSE = this view can't be refreshed concurrently
+                use_concurrent = concurrently and row["refresh_concurrently"] is not False
+                if use_concurrent:
+                    with conn.cursor() as plain_cur:
+                        use_concurrent = _ensure_unique_index(plain_cur, view_name)
+                source_versions = _source_versions(cur, row["sql_text"])
 
-    # Get SQL text
-    cur.execute("SELECT sql_text FROM qle.query WHERE query_id = %s", (query_id,))
-    row = cur.fetchone()
-    if not row:
-        cur.close()
-        conn.close()
-        raise ValueError("Unknown query_id")
-    sql_text = row["sql_text"]
+                start = time.perf_counter()
+                if use_concurrent:
+                    cur.execute("SAVEPOINT qle_refresh")
+                    try:
+                        cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view_name}")
+                    except psycopg2.errors.LockNotAvailable:
+                        raise
+                    except psycopg2.Error:
+                        # e.g. duplicate rows containing NULLs
+                        cur.execute("ROLLBACK TO SAVEPOINT qle_refresh")
+                        use_concurrent = False
+                if not use_concurrent:
+                    cur.execute(f"REFRESH MATERIALIZED VIEW {view_name}")
+                refresh_ms = int((time.perf_counter() - start) * 1000)
 
-    view_name = f"qle_view_{query_id}"
+                cur.execute(
+                    """
+                    UPDATE qle.pinned_view
+                    SET storage_bytes = pg_relation_size(view_name::regclass),
+                        refreshed_at = NOW(),
+                        refresh_ms = %s,
+                        refresh_concurrently = %s,
+                        source_versions = %s
+                    WHERE view_id = %s
+                    RETURNING view_id, view_name, storage_bytes, refreshed_at,
+                              refresh_ms, refresh_concurrently
+                    """,
+                    (
+                        refresh_ms,
+                        use_concurrent if concurrently else row["refresh_concurrently"],
+                        source_versions,
+                        view_id,
+                    ),
+                )
+                updated = cur.fetchone()
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
 
-    # Create materialized view
-    cur.execute(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {view_name} AS {sql_text};")
+    with _stale_lock:
+        _stale_view_ids.discard(view_id)
+    _result_cache.invalidate_tables([view_name])
+    invalidate_pinned_views()  # the rewrite index holds the old source versions
+    return updated
 
-    # Measure storage
-    cur.execute(
-        "SELECT pg_relation_size(%s::regclass) AS bytes",
-        (view_name,),
-    )
-    storage_bytes = cur.fetchone()["bytes"]
 
-    # Insert into pinned_view
-    cur.execute(
-        """
-        INSERT INTO qle.pinned_view (query_id, view_name, storage_bytes)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (view_name) DO UPDATE
-            SET storage_bytes = EXCLUDED.storage_bytes
-        RETURNING view_id
-        """,
-        (query_id, view_name, storage_bytes),
-    )
-    view_id = cur.fetchone()["view_id"]
+def _find_stale_for_refresh():
+    stale = [v["view_id"] for v in get_stale_views()]
+    with _stale_lock:
+        _stale_view_ids.clear()
+        _stale_view_ids.update(stale)
+    return stale
 
-    # Update qle.query
-    cur.execute(
-        """
-        UPDATE qle.query
-        SET pinned_view_id = %s
-        WHERE query_id = %s
-        """,
-        (view_id, query_id),
-    )
 
-    conn.commit()
-    cur.close()
-    conn.close()
-    return view_id, view_name, storage_bytes
+def _user_pool_busy():
+    pool = _pools.get("user")
+    if pool is None:
+        return False
+    s = pool.stats()
+    return s["in_use"] >= s["maxconn"]
 
 
-def list_pinned_views():
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(
-        """
-        SELECT pv.view_id,
-               pv.view_name,
-               pv.storage_bytes,
-               pv.created_at,
-               q.query_id,
-               q.executed_at,
-               q.sql_text
-        FROM qle.pinned_view pv
-        JOIN qle.query q ON q.query_id = pv.query_id
-        ORDER BY pv.created_at DESC
-        """
+def start_refresh_scheduler(**options):
+    """
+    Start refreshing stale pinned views in the background. Options go to
+    qle_refresh.RefreshScheduler (interval, max_concurrent); max_concurrent
+    defaults to the "refresh" pool's maxconn.
+    """
+    global _refresher
+    stop_refresh_scheduler()
+    options.setdefault("interval", REFRESH_INTERVAL)
+    options.setdefault("max_concurrent", POOL_CONFIG["refresh"]["maxconn"])
+    _refresher = RefreshScheduler(
+        _find_stale_for_refresh, refresh_pinned_view, busy=_user_pool_busy, **options
     )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
+    return _refresher
 
 
-def preview_view(view_name: str, limit: int = 50):
-    """Return (rows, cols) from the materialized view."""
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(f"SELECT * FROM {view_name} LIMIT %s;", (limit,))
-    rows = cur.fetchall()
-    cols = [d.name for d in cur.description]
-    cur.close()
-    conn.close()
-    return rows, cols
+def stop_refresh_scheduler(timeout=None):
+    global _refresher
+    refresher, _refresher = _refresher, None
+    if refresher is not None:
+        refresher.close(timeout)
+    with _stale_lock:
+        _stale_view_ids.clear()
+
+
+def refresh_stats():
+    if _refresher is None:
+        return {"running": False}
+    return dict(
+        _refresher.stats,
+        running=True,
+        in_flight=_refresher.in_flight(),
+        last_error=str(_refresher.last_error) if _refresher.last_error else None,
+    )
 
 
 def delete_query(query_id: int):
@@ -274,91 +3157,232 @@ def delete_query(query_id: int):
     If the query has a pinned materialized view, drop that view and delete the pinned_view row.
     If, after deletion, qle.query is empty, reset the query_id and view_id sequences to start at 1.
     """
-    conn = get_conn()
-    conn.autocommit = False
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    delete_queries([query_id])
 
-    try:
-        # Find any pinned view associated with this query
-        cur.execute(
-            """
-            SELECT pv.view_id, pv.view_name
-            FROM qle.pinned_view pv
-            WHERE pv.query_id = %s
-            """,
-            (query_id,),
-        )
-        pv = cur.fetchone()
 
-        if pv:
-            view_name = pv["view_name"]
+def delete_subtree(query_id: int):
+    """Delete a query and every query derived from it (its qle.edge descendants)."""
+    return delete_queries([query_id], include_descendants=True)
+
+
+def delete_queries(query_ids, include_descendants=False):
+    """
+    Delete a set of queries in one transaction and return the ids deleted.
+
+    With include_descendants=True, every query derived from one of them is
+    deleted too. Their pinned views are dropped with a single DROP
+    statement; sequences are reset if nothing is left afterwards.
+    """
+    ids = sorted(set(query_ids))
+    if not ids:
+        return []
+    flush_log()
+    with pooled_conn("meta") as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-            # Drop the actual materialized view in the database
-            cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view_name} CASCADE;")
+        try:
+            if include_descendants:
+                cur.execute(
+                    """
+                    SELECT DISTINCT descendant_id
+                    FROM qle.lineage_closure
+                    WHERE ancestor_id = ANY(%s::int[])
+                    """,
+                    (ids,),
+                )
+                ids = sorted(set(ids) | {r["descendant_id"] for r in cur.fetchall()})
 
-            # Clear pinned_view_id from any queries pointing to this view
             cur.execute(
                 """
-                UPDATE qle.query
-                SET pinned_view_id = NULL
-                WHERE pinned_view_id = %s
+                SELECT pv.view_id, pv.view_name
+                FROM qle.pinned_view pv
+                WHERE pv.query_id = ANY(%s::int[])
                 """,
-                (pv["view_id"],),
+                (ids,),
             )
+            views = cur.fetchall()
+            if views:
+                _drop_pinned_views(cur, views)
 
-            # Delete the pinned_view metadata row
+            # Surviving descendants: their closure rows may describe paths
+            # through deleted queries
             cur.execute(
                 """
-                DELETE FROM qle.pinned_view
-                WHERE view_id = %s
+                SELECT DISTINCT descendant_id
+                FROM qle.lineage_closure
+                WHERE ancestor_id = ANY(%(ids)s::int[])
+                  AND NOT descendant_id = ANY(%(ids)s::int[])
                 """,
-                (pv["view_id"],),
+                {"ids": ids},
             )
+            below = [r["descendant_id"] for r in cur.fetchall()]
 
-        # Delete the query row itself.
-        # qle.query_table and qle.edge should have ON DELETE CASCADE on their FKs,
-        # so associated rows will be removed automatically.
-        cur.execute(
-            """
-            DELETE FROM qle.query
-            WHERE query_id = %s
-            """,
-            (query_id,),
-        )
-
-        # Check if qle.query is now empty; if so, reset sequences
-        cur.execute("SELECT COUNT(*) AS cnt FROM qle.query;")
-        cnt = cur.fetchone()["cnt"]
-
-        if cnt == 0:
-            # Reset query_id and view_id sequences so next insert starts at 1
+            # qle.query_table rows and the queries' own (child-side) edges
+            # cascade; the rest has no FK on qle.query and is removed here
+            cur.execute(
+                """
+                DELETE FROM qle.query
+                WHERE query_id = ANY(%s::int[])
+                RETURNING query_id, sql_hash
+                """,
+                (ids,),
+            )
+            rows = cur.fetchall()
+            deleted = sorted(r["query_id"] for r in rows)
+            cur.execute(
+                "DELETE FROM qle.edge WHERE parent_query_id = ANY(%s::int[])", (ids,)
+            )
             cur.execute(
                 """
-                SELECT setval(
-                    pg_get_serial_sequence('qle.query', 'query_id'),
-                    1,
-                    false
-                );
+                DELETE FROM qle.lineage_closure
+                WHERE ancestor_id = ANY(%(ids)s::int[])
+                   OR descendant_id = ANY(%(ids)s::int[])
+                """,
+                {"ids": ids},
+            )
+            cur.execute(
+                "DELETE FROM qle.query_plan WHERE query_id = ANY(%s::int[])", (ids,)
+            )
+            cur.execute(
                 """
+                DELETE FROM qle.inference_rejection
+                WHERE parent_query_id = ANY(%(ids)s::int[])
+                   OR child_query_id = ANY(%(ids)s::int[])
+                """,
+                {"ids": ids},
             )
+            if below:
+                _repair_closure(cur, below)
+            _purge_sql_texts(cur, sorted({r["sql_hash"] for r in rows}))
+
+            # If nothing refers to any query_id any more (archived queries and
+            # their closure rows included), reset sequences
             cur.execute(
                 """
-                SELECT setval(
-                    pg_get_serial_sequence('qle.pinned_view', 'view_id'),
-                    1,
-                    false
-                );
+                SELECT EXISTS (SELECT 1 FROM qle.query)
+                    OR EXISTS (SELECT 1 FROM qle.archived_query)
+                    OR EXISTS (SELECT 1 FROM qle.lineage_closure) AS any_left
                 """
             )
+            empty = not cur.fetchone()["any_left"]
+            if empty:
+                # Reset query_id and view_id sequences so next insert starts at 1
+                _reset_sequences(cur)
 
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            cur.close()
+            raise e
         cur.close()
-        conn.close()
-        raise e
-    cur.close()
-    conn.close()
+
+    if views:
+        invalidate_pinned_views()
+    inference = _inference
+    if empty:
+        # Ids restart below the cache's high-water mark
+        _graph_cache.invalidate()
+        if _snapshots is not None:
+            _snapshots.clear()
+        if inference is not None:
+            inference["index"].clear()
+    else:
+        _graph_cache.note_deleted(deleted)
+        if _snapshots is not None:
+            _snapshots.delete(deleted)
+        if inference is not None:
+            for query_id in deleted:
+                inference["index"].remove(query_id)
+    return deleted
+
+
+def _purge_sql_texts(cur, hashes):
+    """Drop texts among `hashes` that no query (or stats sample) uses any more."""
+    if not hashes:
+        return
+    cur.execute(
+        """
+        DELETE FROM qle.sql_text t
+        WHERE t.sql_hash = ANY(%s::text[])
+          AND NOT EXISTS (SELECT 1 FROM qle.query q WHERE q.sql_hash = t.sql_hash)
+          AND NOT EXISTS (
+              SELECT 1 FROM qle.fingerprint_stats f WHERE f.sample_sql_hash = t.sql_hash
+          )
+        """,
+        (hashes,),
+    )
+
+
+def _repair_closure(cur, below):
+    """
+    Recompute the ancestor rows of `below`, the surviving descendants of
+    deleted queries. Walking up qle.edge from each of them through other
+    members of `below` reaches either members (direct rows) or queries
+    outside the set, whose own ancestor rows are still valid and are
+    joined in.
+    """
+    cur.execute(
+        """
+        DELETE FROM qle.lineage_closure
+        WHERE descendant_id = ANY(%(below)s::int[])
+          AND depth > 0
+        """,
+        {"below": below},
+    )
+    cur.execute(
+        f"""
+        INSERT INTO qle.lineage_closure AS lc (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE up(descendant_id, node, depth) AS (
+            SELECT d, d, 0
+            FROM unnest(%(below)s::int[]) AS d
+            UNION
+            SELECT u.descendant_id, e.parent_query_id, u.depth + 1
+            FROM up u
+            JOIN qle.edge e ON e.child_query_id = u.node
+            WHERE u.node = ANY(%(below)s::int[])
+        ),
+        reach(ancestor_id, descendant_id, depth) AS (
+            SELECT c.ancestor_id, u.descendant_id, u.depth + c.depth
+            FROM up u
+            JOIN ({_ANCESTOR_ROWS_SQL}) c ON c.descendant_id = u.node
+            WHERE NOT u.node = ANY(%(below)s::int[])
+            UNION ALL
+            SELECT u.node, u.descendant_id, u.depth
+            FROM up u
+            WHERE u.node = ANY(%(below)s::int[]) AND u.depth > 0
+        )
+        SELECT ancestor_id, descendant_id, MIN(depth)
+        FROM reach
+        GROUP BY ancestor_id, descendant_id
+        ON CONFLICT (ancestor_id, descendant_id) DO UPDATE
+            SET depth = LEAST(lc.depth, EXCLUDED.depth)
+        """,
+        {"below": below},
+    )
+
+
+def _reset_sequences(cur):
+    # Ids pre-reserved by the write-behind logger would collide after a reset
+    if _logger is not None:
+        _logger.reset_reservations()
+    cur.execute(
+        """
+        SELECT setval(
+            pg_get_serial_sequence('qle.query', 'query_id'),
+            1,
+            false
+        );
+        """
+    )
+    cur.execute(
+        """
+        SELECT setval(
+            pg_get_serial_sequence('qle.pinned_view', 'view_id'),
+            1,
+            false
+        );
+        """
+    )
 
 
 def clear_history():
@@ -367,52 +3391,280 @@ def clear_history():
     Also resets SERIAL/identity counters so query_id starts back at 1.
     Does NOT touch underlying IMDB tables.
     """
-    conn = get_conn()
-    conn.autocommit = False
-    cur = conn.cursor()
+    # Let queued log records land first so nothing reappears after the TRUNCATE
+    flush_log()
+    with pooled_conn("meta") as conn:
+        cur = conn.cursor()
 
-    try:
-        # 1) Drop all pinned materialized views first
-        cur.execute("SELECT view_name FROM qle.pinned_view;")
-        for (view_name,) in cur.fetchall():
-            cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view_name} CASCADE;")
+        try:
+            # 1) Drop all pinned materialized views first
+            cur.execute("SELECT view_name FROM qle.pinned_view;")
+            for (view_name,) in cur.fetchall():
+                cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view_name} CASCADE;")
 
-        # 2) Truncate metadata tables
-        cur.execute(
-            """
-            TRUNCATE qle.edge,
-                     qle.query_table,
-                     qle.pinned_view,
-                     qle.query
-            CASCADE;
-            """
-        )
+            # 2) Truncate metadata tables
+            cur.execute(
+                """
+                TRUNCATE qle.edge,
+                         qle.lineage_closure,
+                         qle.archived_query,
+                         qle.ingest_checkpoint,
+                         qle.ingest_key,
+                         qle.inference_rejection,
+                         qle.fingerprint_stats,
+                         qle.sql_text,
+                         qle.query_plan,
+                         qle.query_table,
+                         qle.pinned_view,
+                         qle.query
+                CASCADE;
+                """
+            )
 
-        # 3) Explicitly reset sequences for query_id and view_id
-        cur.execute(
-            """
-            SELECT setval(
-                pg_get_serial_sequence('qle.query', 'query_id'),
-                1,
-                false
-            );
-            """
-        )
-        cur.execute(
-            """
-            SELECT setval(
-                pg_get_serial_sequence('qle.pinned_view', 'view_id'),
-                1,
-                false
-            );
-            """
-        )
+            # 3) Explicitly reset sequences for query_id and view_id
+            _reset_sequences(cur)
 
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            cur.close()
+            raise e
+        cur.close()
+    _graph_cache.invalidate()
+    invalidate_pinned_views()
+    # Ids restart at 1: old snapshots and signatures would show up under new queries
+    if _snapshots is not None:
+        _snapshots.clear()
+    # Functions may have been dropped or redefined along with the history
+    _function_volatility.clear()
+    inference = _inference
+    if inference is not None:
+        inference["index"].clear()
+
+
+# Time partitioning of the query log: qle.query, qle.query_table and qle.edge
+# are split into UTC months (qle.ensure_partitions in data.sql). Retention
+# archives whole months to gzip'd CSV files and drops them; queries in them
+# that still have descendants in the log are kept in qle.archived_query,
+# together with their edges and closure rows, so lineage crossing the
+# retention boundary survives.
+PARTITION_AHEAD_MONTHS = 1  # empty partitions kept ready ahead of now
+RETENTION_DAYS = None  # default age for apply_retention(); None = keep everything
+ARCHIVE_DIR = "qle_archive"
+RETENTION_LOCK_TIMEOUT_MS = 5000
+
+_PARTITION_NAME = re.compile(r"^query_p(\d{4})(\d{2})$")
+
+
+def ensure_partitions(start=None, end=None):
+    """
+    Create the monthly partitions covering [start, end]; by default from now
+    to PARTITION_AHEAD_MONTHS ahead. Returns how many tables were created.
+    """
+    now = datetime.now(timezone.utc)
+    start = start or now
+    end = end or now + timedelta(days=31 * PARTITION_AHEAD_MONTHS)
+    with pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            try:
+                cur.execute("SELECT qle.ensure_partitions(%s, %s)", (start, end))
+                created = cur.fetchone()[0]
+                conn.commit()
+            except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+                # Another session created them first
+                conn.rollback()
+                created = 0
+    return created
+
+
+def _partition_month(name):
+    m = _PARTITION_NAME.match(name)
+    start = datetime(int(m.group(1)), int(m.group(2)), 1, tzinfo=timezone.utc)
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return start, end
+
+
+def list_partitions():
+    """Monthly partitions of the query log, oldest first: name, month bounds, rows (estimate), bytes."""
+    with pooled_conn("meta") as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT c.relname AS partition,
+                       GREATEST(c.reltuples, 0)::bigint AS est_rows,
+                       pg_total_relation_size(c.oid)
+                         + COALESCE(pg_total_relation_size(
+                               to_regclass('qle.query_table' || substr(c.relname, 6))), 0)
+                         + COALESCE(pg_total_relation_size(
+                               to_regclass('qle.edge' || substr(c.relname, 6))), 0) AS bytes
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'qle.query'::regclass
+                """
+            )
+            rows = [r for r in cur.fetchall() if _PARTITION_NAME.match(r["partition"])]
+    for r in rows:
+        r["starts_at"], r["ends_at"] = _partition_month(r["partition"])
+    return sorted(rows, key=lambda r: r["starts_at"])
+
+
+def apply_retention(max_age_days=None, archive_dir=None, dry_run=False):
+    """
+    Archive and drop every month of the query log that ended more than
+    max_age_days (RETENTION_DAYS by default) ago.
+
+    Each month is handled in its own transaction: its qle.query,
+    qle.query_table and qle.edge partitions (plus the queries' plans) are
+    written to <archive_dir>/<table>_pYYYYMM.csv.gz, then detached and
+    dropped. Months holding a pinned view's query are skipped. Returns a
+    report with the months archived and skipped.
+    """
+    if max_age_days is None:
+        max_age_days = RETENTION_DAYS
+    if max_age_days is None:
+        raise ValueError("No retention age: pass max_age_days or set RETENTION_DAYS")
+    archive_dir = archive_dir or ARCHIVE_DIR
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+
+    flush_log()
+    ensure_partitions()
+    report = {"cutoff": cutoff, "dry_run": dry_run, "archived": [], "skipped": []}
+    for part in list_partitions():
+        if part["ends_at"] > cutoff:
+            continue
+        if dry_run:
+            report["archived"].append(part)
+            continue
+        try:
+            result = _archive_partition(part["partition"], archive_dir)
+        except psycopg2.errors.LockNotAvailable:
+            report["skipped"].append(dict(part, reason="busy"))
+            continue
+        if result is None:
+            report["skipped"].append(dict(part, reason="holds pinned views"))
+        else:
+            report["archived"].append(dict(part, **result))
+
+    if report["archived"] and not dry_run:
+        _graph_cache.invalidate()
+    return report
+
+
+def _archive_partition(name, archive_dir):
+    """Archive, detach and drop one month; None if it holds a pinned view's query."""
+    suffix = name[len("query"):]  # "_pYYYYMM"
+    os.makedirs(archive_dir, exist_ok=True)
+    sources = {t: f"qle.{t}{suffix}" for t in ("query", "query_table", "edge")}
+    # Archives are self-contained: the query rows carry their text
+    sources["query"] = (
+        f"(SELECT q.*, s.sql_text FROM qle.{name} q "
+        f"JOIN qle.sql_text s ON s.sql_hash = q.sql_hash)"
+    )
+    sources["query_plan"] = (
+        f"(SELECT p.* FROM qle.query_plan p JOIN qle.{name} q ON q.query_id = p.query_id)"
+    )
+    written = {}
+    with pooled_conn("meta") as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SET LOCAL lock_timeout = %s", (int(RETENTION_LOCK_TIMEOUT_MS),))
+            cur.execute(
+                f"""
+                SELECT EXISTS (
+                    SELECT 1
+                    FROM qle.pinned_view pv
+                    JOIN qle.{name} q ON q.query_id = pv.query_id
+                )
+                """
+            )
+            if cur.fetchone()[0]:
+                conn.rollback()
+                cur.close()
+                return None
+            cur.execute(f"SELECT query_id, sql_hash FROM qle.{name}")
+            rows = cur.fetchall()
+            ids = [row[0] for row in rows]
+            hashes = sorted({row[1] for row in rows})
+
+            for table, source in sources.items():
+                path = os.path.join(archive_dir, f"{table}{suffix}.csv.gz")
+                written[path] = path + ".tmp"
+                with gzip.open(written[path], "wb") as f:
+                    cur.copy_expert(f"COPY {source} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+
+            # Queries with descendants in later months stay resolvable
+            cur.execute(
+                f"""
+                INSERT INTO qle.archived_query (query_id, executed_at, sql_text, status, archive)
+                SELECT q.query_id, q.executed_at, s.sql_text, q.status, %s
+                FROM qle.{name} q
+                JOIN qle.sql_text s ON s.sql_hash = q.sql_hash
+                WHERE EXISTS (
+                    SELECT 1
+                    FROM qle.lineage_closure c
+                    WHERE c.ancestor_id = q.query_id
+                      AND c.depth > 0
+                      AND NOT EXISTS (
+                          SELECT 1 FROM qle.{name} d WHERE d.query_id = c.descendant_id
+                      )
+                )
+                ON CONFLICT (query_id) DO NOTHING
+                """,
+                (name,),
+            )
+            kept = cur.rowcount
+            # Closure rows *from* archived queries to survivors are kept
+            cur.execute(
+                f"""
+                DELETE FROM qle.lineage_closure c
+                USING qle.{name} q
+                WHERE c.descendant_id = q.query_id
+                """
+            )
+            cur.execute(
+                f"""
+                DELETE FROM qle.query_plan p
+                USING qle.{name} q
+                WHERE p.query_id = q.query_id
+                """
+            )
+            # Earlier stubs whose last live descendant is in this month
+            cur.execute(
+                """
+                DELETE FROM qle.archived_query a
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM qle.lineage_closure c
+                    WHERE c.ancestor_id = a.query_id AND c.depth > 0
+                )
+                """
+            )
+
+            # Referencing tables first: a detached query partition must not
+            # be referenced by rows still attached
+            for table in ("edge", "query_table", "query"):
+                cur.execute(f"ALTER TABLE qle.{table} DETACH PARTITION qle.{table}{suffix}")
+                cur.execute(f"DROP TABLE qle.{table}{suffix}")
+            _purge_sql_texts(cur, hashes)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            cur.close()
+            for tmp in written.values():
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            raise e
         cur.close()
-        conn.close()
-        raise e
-    cur.close()
-    conn.close()
+
+    for path, tmp in written.items():
+        os.replace(tmp, path)
+    if _snapshots is not None:
+        _snapshots.delete(ids)
+    inference = _inference
+    if inference is not None:
+        for query_id in ids:
+            inference["index"].remove(query_id)
+    return {"queries": len(ids), "kept_for_lineage": kept, "files": sorted(written)}
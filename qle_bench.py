@@ -0,0 +1,376 @@
+# qle_bench.py
+"""
+Workload benchmark for the QLE backend.
+
+For each history size it clears qle.*, loads a synthetic lineage workload
+through the backend's own log writer, then times the functions the UI
+calls (logging a run, history pages, the lineage graph and its layout,
+ancestry and details lookups). Results are written as JSON; --compare
+checks them against an earlier run and exits non-zero on regressions.
+
+Run it against a scratch database: it DELETES all QLE metadata.
+
+    python qle_bench.py --dsn "dbname=imdb_bench ..." --sizes 1k,10k --reset --out bench.json
+    python qle_bench.py --sizes 1k --reset --compare bench.json
+"""
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import qle_backend as qle
+
+# Table names used when the database has no public tables (IMDB / JOB schema)
+IMDB_TABLES = (
+    "title", "name", "cast_info", "movie_info", "movie_info_idx", "movie_companies",
+    "company_name", "company_type", "keyword", "movie_keyword", "kind_type",
+    "info_type", "role_type", "char_name", "aka_title", "aka_name", "person_info",
+    "complete_cast", "comp_cast_type", "link_type", "movie_link",
+)
+
+WORKLOAD = {
+    "root_share": 0.1,  # share of queries that start a new exploration
+    "continue_share": 0.6,  # ... that refine the previous query (else backtrack)
+    "merge_share": 0.03,  # ... that have a second parent
+    "backtrack_window": 50,  # how far back a backtrack may go
+    "error_share": 0.03,
+    "days": 90,  # history spread over this many days (several partitions)
+    "batch_size": 1000,  # records per log-writer batch while populating
+}
+
+# Calls per benchmarked function (graph builds are much heavier)
+DEFAULT_ITERATIONS = 200
+HEAVY_ITERATIONS = 20
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    if text.endswith("k"):
+        return int(float(text[:-1]) * 1000)
+    return int(text)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+
+def summarize(samples_ns, wall_ns, peak_alloc=None, units=None):
+    ms = sorted(ns / 1e6 for ns in samples_ns)
+    out = {
+        "calls": len(ms),
+        "throughput_per_s": round(len(ms) / (wall_ns / 1e9), 2) if wall_ns else None,
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else None,
+        "p50_ms": round(percentile(ms, 50), 3) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 3) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 3) if ms else None,
+        "max_ms": round(ms[-1], 3) if ms else None,
+        "peak_alloc_bytes": peak_alloc,
+    }
+    if units is not None:
+        out["units_per_s"] = round(units / (wall_ns / 1e9), 2) if wall_ns else None
+    return out
+
+
+def measure(fn, iterations, setup=None):
+    """Time `iterations` calls (setup() runs untimed before each), then one call under tracemalloc."""
+    samples = []
+    wall = 0
+    for _ in range(iterations):
+        args = setup() if setup else ()
+        start = time.perf_counter_ns()
+        fn(*args)
+        elapsed = time.perf_counter_ns() - start
+        samples.append(elapsed)
+        wall += elapsed
+    args = setup() if setup else ()
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return summarize(samples, wall, peak)
+
+
+class WorkloadGenerator:
+    """Synthetic exploration sessions: roots, refinements, backtracks and merges."""
+
+    def __init__(self, tables, seed, cfg, total):
+        self.tables = list(tables)
+        self.rng = random.Random(seed)
+        self.cfg = cfg
+        self.start = datetime.now(timezone.utc) - timedelta(days=cfg["days"])
+        self.step = timedelta(days=cfg["days"]) / max(total, 1)
+        self.ids = []  # every query_id generated so far, oldest first
+        self.tables_of = {}
+
+    def _sql(self, tables):
+        rng = self.rng
+        aliases = [f"t{i}" for i in range(len(tables))]
+        joins = " AND ".join(
+            f"{aliases[0]}.id = {a}.id" for a in aliases[1:]
+        ) or "TRUE"
+        return (
+            f"SELECT {aliases[0]}.id FROM "
+            + ", ".join(f"{t} {a}" for t, a in zip(tables, aliases))
+            + f" WHERE {joins} AND {aliases[0]}.id < {rng.randint(1, 10_000_000)}"
+        )
+
+    def _refine(self, tables):
+        rng = self.rng
+        tables = list(tables)
+        r = rng.random()
+        if r < 0.4 and len(tables) < 6:
+            tables.append(rng.choice(self.tables))
+        elif r < 0.6 and len(tables) > 1:
+            tables.pop(rng.randrange(len(tables)))
+        return tables
+
+    def records(self, new_ids):
+        """Log records (as _make_log_record builds them) for the next query ids, oldest first."""
+        rng, cfg = self.rng, self.cfg
+        ids, tables_of = self.ids, self.tables_of
+        out = []
+        for qid in new_ids:
+            i = len(ids)
+            ids.append(qid)
+            parents = []
+            if i and rng.random() >= cfg["root_share"]:
+                if rng.random() < cfg["continue_share"]:
+                    parent = ids[i - 1]
+                else:
+                    parent = ids[max(0, i - rng.randint(1, cfg["backtrack_window"]))]
+                parents.append(parent)
+                if i > 1 and rng.random() < cfg["merge_share"]:
+                    other = ids[rng.randrange(0, i)]
+                    if other != parent:
+                        parents.append(other)
+            if parents:
+                tables = self._refine(tables_of[parents[0]])
+            else:
+                tables = rng.sample(self.tables, rng.randint(1, min(3, len(self.tables))))
+            tables_of[qid] = tables
+            failed = rng.random() < cfg["error_share"]
+            runtime_ms = int(rng.lognormvariate(3.0, 1.5))
+            record = qle._make_log_record(
+                self._sql(tables),
+                runtime_ms,
+                None if failed else rng.randint(0, 100_000),
+                "synthetic error" if failed else None,
+                parents,
+                status="error" if failed else "ok",
+            )
+            record["query_id"] = qid
+            record["executed_at"] = self.start + self.step * i
+            out.append(record)
+        return out
+
+
+def database_tables():
+    with qle.pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT table_name
+                FROM information_schema.tables
+                WHERE table_schema = 'public' AND table_type = 'BASE TABLE'
+                ORDER BY table_name
+                """
+            )
+            return [row[0] for row in cur.fetchall()] or list(IMDB_TABLES)
+
+
+def populate(n, gen):
+    """Load n synthetic queries through the write-behind batch writer; returns its timings."""
+    batch_size = WORKLOAD["batch_size"]
+    samples = []
+    wall = 0
+    done = 0
+    while done < n:
+        count = min(batch_size, n - done)
+        records = gen.records(qle._reserve_query_ids(count))
+        start = time.perf_counter_ns()
+        qle._write_log_batch(records)
+        elapsed = time.perf_counter_ns() - start
+        samples.append(elapsed)
+        wall += elapsed
+        done += count
+    qle.invalidate_lineage_graph()
+    return summarize(samples, wall, units=n), gen.ids
+
+
+def _app_graph_build(mode):
+    """What app.py does for the lineage panel: cached graph, layout, draw."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
+    import qle_layout
+
+    def build():
+        G, version = qle.get_lineage_digraph()
+        pos = qle_layout.layout(G, version, mode=mode)
+        fig, ax = plt.subplots()
+        nx.draw(G, pos, with_labels=True, ax=ax, arrows=True)
+        plt.close(fig)
+
+    return build
+
+
+def run_size(n, args, tables):
+    print(f"[{n}] clearing and populating ...", file=sys.stderr)
+    qle.clear_history()
+    gen = WorkloadGenerator(tables, args.seed, WORKLOAD, n)
+    populate_stats, ids = populate(n, gen)
+    rng = random.Random(args.seed + n)
+    it, heavy = args.iterations, max(1, min(HEAVY_ITERATIONS, args.iterations // 10))
+
+    def random_id():
+        return (rng.choice(ids),)
+
+    results = {"log_batch_write": populate_stats}
+    sql_gen = WorkloadGenerator(tables, args.seed + 1, WORKLOAD, 1)
+
+    def query_args():
+        return (sql_gen._sql(rng.sample(tables, rng.randint(1, min(3, len(tables))))) + " AND FALSE", [rng.choice(ids)])
+
+    print(f"[{n}] timing ...", file=sys.stderr)
+    results["run_query_sync"] = measure(
+        lambda sql, parents: qle.run_query(sql, parent_query_ids=parents), it, query_args
+    )
+    qle.enable_write_behind()
+    try:
+        results["run_query_write_behind"] = measure(
+            lambda sql, parents: qle.run_query(sql, parent_query_ids=parents), it, query_args
+        )
+    finally:
+        qle.disable_write_behind()
+
+    results["get_query_history"] = measure(qle.get_query_history, it)
+    results["get_query_history_page_deep"] = measure(
+        lambda qid: qle.get_query_history_page(before_query_id=qid), it, random_id
+    )
+    results["get_lineage_graph_cold"] = measure(
+        qle.get_lineage_graph, heavy, lambda: (qle.invalidate_lineage_graph(), ())[1]
+    )
+    results["get_lineage_graph_warm"] = measure(qle.get_lineage_graph, it)
+    results["get_ancestors"] = measure(qle.get_ancestors, it, random_id)
+    results["get_descendants"] = measure(qle.get_descendants, it, random_id)
+    results["get_query_details"] = measure(qle.get_query_details, it, random_id)
+    try:
+        for mode in ("incremental", "hierarchical"):
+            results[f"app_graph_build_{mode}"] = measure(_app_graph_build(mode), heavy)
+    except ImportError as e:
+        print(f"[{n}] skipping app graph build: {e}", file=sys.stderr)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _server_version():
+    with qle.pooled_conn("meta") as conn:
+        return conn.server_version
+
+
+def compare(current, baseline, threshold):
+    """Print per-function p95 / throughput ratios; return the list of regressions."""
+    regressions = []
+    for size, funcs in current["results"].items():
+        base_funcs = baseline.get("results", {}).get(size)
+        if not base_funcs:
+            continue
+        print(f"\n{size} queries (baseline {baseline['meta'].get('git_commit')})")
+        for name, cur in funcs.items():
+            base = base_funcs.get(name)
+            if not base or not base.get("p95_ms") or cur.get("p95_ms") is None:
+                continue
+            ratio = cur["p95_ms"] / base["p95_ms"]
+            flag = ""
+            if ratio > threshold:
+                flag = "  REGRESSION"
+                regressions.append((size, name, ratio))
+            print(
+                f"  {name:32s} p95 {base['p95_ms']:9.3f} -> {cur['p95_ms']:9.3f} ms "
+                f"(x{ratio:.2f}){flag}"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--dsn", help="database to benchmark (default: qle_backend.DSN)")
+    parser.add_argument("--sizes", default="1k,10k,100k", help="history sizes, e.g. 1k,10k")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write results JSON here")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument(
+        "--threshold", type=float, default=1.2, help="p95 ratio counted as a regression"
+    )
+    parser.add_argument(
+        "--reset", action="store_true", help="allow clearing a non-empty QLE history"
+    )
+    args = parser.parse_args(argv)
+
+    if args.dsn:
+        qle.configure_pools(meta={"dsn": args.dsn}, user={"dsn": args.dsn})
+    if qle.get_query_history(limit=1) and not args.reset:
+        parser.error("QLE history is not empty; pass --reset to clear it (scratch databases only)")
+
+    tables = database_tables()
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()]
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "server_version": _server_version(),
+            "seed": args.seed,
+            "iterations": args.iterations,
+            "workload": WORKLOAD,
+            "tables": len(tables),
+        },
+        "results": {},
+    }
+    for n in sizes:
+        report["results"][str(n)] = run_size(n, args, tables)
+    qle.clear_history()
+    # ru_maxrss is KiB on Linux
+    report["meta"]["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    text = json.dumps(report, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
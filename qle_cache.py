@@ -0,0 +1,206 @@
+# qle_cache.py
+import collections
+import threading
+import time
+
+# Calls / clauses whose results differ between identical executions. Other
+# functions are looked up in pg_proc (provolatile = 'v'); see FunctionVolatility.
+VOLATILE_FUNCTIONS = {
+    "random", "now", "clock_timestamp", "statement_timestamp", "timeofday",
+    "transaction_timestamp", "nextval", "setval", "currval", "lastval",
+    "gen_random_uuid", "uuid_generate_v4", "pg_sleep", "txid_current",
+    "pg_current_xact_id", "pg_backend_pid",
+}
+VOLATILE_KEYWORDS = (
+    "current_timestamp", "current_date", "current_time", "localtime",
+    "localtimestamp", "current_user", "session_user", "into", "for update",
+    "for share", "for no key update", "for key share", "tablesample",
+)
+# Unqualified names qle_sql reports as calls that aren't in pg_proc: SQL
+# special forms, type names taking a modifier (CAST(x AS decimal(10, 2)))
+# and TABLESAMPLE methods. None of them is volatile by itself.
+SQL_SPECIAL_FORMS = {
+    "coalesce", "nullif", "greatest", "least", "cast", "treat", "row", "array",
+    "extract", "overlay", "position", "substring", "trim", "collation",
+    "grouping", "cube", "rollup", "xmlconcat", "xmlelement", "xmlexists",
+    "xmlforest", "xmlparse", "xmlpi", "xmlroot", "xmlserialize",
+    "decimal", "dec", "char", "character", "varying", "nchar", "float",
+    "system", "bernoulli",
+}
+
+
+def function_name(name):
+    """Unqualified, unquoted lower-case name: pg_catalog.random -> random."""
+    return name.rsplit(".", 1)[-1].strip('"').lower()
+
+
+def is_cacheable(parsed):
+    """Static checks on a qle_sql.ParsedSQL; FunctionVolatility still has to clear its calls."""
+    if parsed.statement_type != "select" or not parsed.tables:
+        return False
+    if VOLATILE_FUNCTIONS.intersection(function_name(f) for f in parsed.functions):
+        return False
+    text = f" {parsed.normalized} "
+    keywords = VOLATILE_KEYWORDS
+    if text.count(" tablesample ") == text.count(" repeatable "):
+        # Every sample is seeded: the same rows while the table is unchanged
+        keywords = tuple(kw for kw in keywords if kw != "tablesample")
+    return not any(f" {kw} " in text for kw in keywords)
+
+
+class FunctionVolatility:
+    """
+    Whether function names are VOLATILE according to pg_proc (any overload,
+    in any schema), remembered for `ttl` seconds so a function redefined
+    outside QLE is looked up again eventually. A name that isn't a known
+    function at all counts as volatile.
+    """
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._known = {}  # unqualified name -> (volatile?, looked up at)
+
+    def calls_volatile(self, conn, functions):
+        """True if any of `functions` (as reported by qle_sql) may be volatile."""
+        names = {
+            function_name(f)
+            for f in functions
+            if "." in f or f.lower() not in SQL_SPECIAL_FORMS
+        }
+        now = time.monotonic()
+        with self._lock:
+            unknown = [
+                n
+                for n in names
+                if n not in self._known or now - self._known[n][1] > self.ttl
+            ]
+        if unknown:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT n.name, bool_or(p.provolatile = 'v')
+                    FROM unnest(%s::text[]) AS n(name)
+                    LEFT JOIN pg_proc p ON p.proname = n.name
+                    GROUP BY n.name
+                    """,
+                    (sorted(unknown),),
+                )
+                found = {name: volatile is not False for name, volatile in cur.fetchall()}
+            with self._lock:
+                for name in unknown:
+                    self._known[name] = (found.get(name, True), now)
+        with self._lock:
+            # Cleared meanwhile: volatile until looked up again
+            return any(self._known.get(n, (True,))[0] for n in names)
+
+    def clear(self):
+        with self._lock:
+            self._known.clear()
+
+
+CacheEntry = collections.namedtuple(
+    "CacheEntry", "rows cols row_count runtime_ms versions tables created_at"
+)
+
+
+class ResultCache:
+    """
+    In-memory query result cache with version-vector validation.
+
+    Each entry remembers the version vector of the tables it read (see
+    qle_backend._table_versions); a lookup with a different vector is a
+    miss and drops the entry. Size is bounded by entry count and total rows.
+    Eviction is cost-aware: among the `eviction_sample` least recently used
+    entries, the one that was cheapest to compute per row (runtime_ms / rows)
+    goes first, so expensive results outlive cheap ones of the same age.
+    """
+
+    def __init__(
+        self, max_entries=256, max_rows=500_000, max_entry_rows=100_000, eviction_sample=8
+    ):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.max_entry_rows = max_entry_rows
+        self.eviction_sample = eviction_sample
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._rows = 0
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "puts": 0, "evictions": 0}
+
+    def get(self, key, versions):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry.versions != versions:
+                self._remove(key)
+                self.stats["stale"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key, versions, tables, rows, cols, runtime_ms):
+        """Store a result; silently skipped if it is larger than max_entry_rows."""
+        if len(rows) > self.max_entry_rows:
+            return False
+        entry = CacheEntry(
+            rows=rows,
+            cols=cols,
+            row_count=len(rows),
+            runtime_ms=runtime_ms or 0,
+            versions=versions,
+            tables=frozenset(tables),
+            created_at=time.time(),
+        )
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._rows += entry.row_count
+            self.stats["puts"] += 1
+            while len(self._entries) > self.max_entries or (
+                self._rows > self.max_rows and len(self._entries) > 1
+            ):
+                self._evict_one(protect=key)
+        return True
+
+    def invalidate_tables(self, tables):
+        """Drop every entry that read any of `tables`."""
+        tables = set(tables)
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.tables & tables]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), rows=self._rows)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._rows -= entry.row_count
+
+    def _evict_one(self, protect):
+        candidates = []
+        for key in self._entries:
+            if key != protect:
+                candidates.append(key)
+            if len(candidates) >= self.eviction_sample:
+                break
+        if not candidates:
+            return
+
+        def cost_per_row(key):
+            entry = self._entries[key]
+            return entry.runtime_ms / max(entry.row_count, 1)
+
+        self._remove(min(candidates, key=cost_per_row))
+        self.stats["evictions"] += 1
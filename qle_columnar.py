@@ -0,0 +1,234 @@
+# qle_columnar.py
+"""
+Column-oriented query results.
+
+A ColumnarResult holds one typed NumPy array per result column instead of
+one dict per row: integers, floats, booleans and timestamps are stored
+unboxed, NULLs in a separate mask, and only text / numeric / other values
+stay Python objects. Cursor batches are decoded straight into the arrays,
+and to_pandas() wraps them without copying.
+"""
+from datetime import timezone
+
+import numpy as np
+
+# Rows fetched from the cursor per batch while decoding
+DEFAULT_BATCH_ROWS = 10_000
+
+# Postgres type OIDs (cursor.description type_code) -> column kind
+_PG_KINDS = {
+    16: "bool",
+    20: "int",  # int8
+    21: "int",  # int2
+    23: "int",  # int4
+    26: "int",  # oid
+    700: "float",  # float4
+    701: "float",  # float8
+    1114: "timestamp",
+    1184: "timestamptz",
+}
+
+_DTYPES = {
+    "bool": np.bool_,
+    "int": np.int64,
+    "float": np.float64,
+    "timestamp": "datetime64[us]",
+    "timestamptz": "datetime64[us]",
+    "object": object,
+}
+
+_FILL = {"bool": False, "int": 0, "float": np.nan}
+
+
+def _decode(kind, values):
+    """One column of a batch -> (array, mask or None)."""
+    n = len(values)
+    mask = None
+    if any(v is None for v in values):
+        mask = np.fromiter((v is None for v in values), dtype=np.bool_, count=n)
+    if kind in _FILL:
+        fill = _FILL[kind]
+        data = np.fromiter(
+            (fill if v is None else v for v in values), dtype=_DTYPES[kind], count=n
+        )
+    elif kind == "timestamp":
+        data = np.array(
+            [np.datetime64("NaT") if v is None else v for v in values],
+            dtype="datetime64[us]",
+        )
+    elif kind == "timestamptz":
+        # Stored as naive UTC; to_pandas() puts the zone back
+        data = np.array(
+            [
+                np.datetime64("NaT")
+                if v is None
+                else v.astimezone(timezone.utc).replace(tzinfo=None)
+                for v in values
+            ],
+            dtype="datetime64[us]",
+        )
+    else:
+        data = np.empty(n, dtype=object)
+        data[:] = values
+    return data, mask
+
+
+class ColumnarResult:
+    """
+    A query result as typed column arrays.
+
+    Behaves like the list of row dicts it replaces (len(), indexing and
+    iteration yield {column: value} dicts) so existing callers keep
+    working, but page through it with slice() and render it with
+    to_pandas(), which never materializes rows.
+    """
+
+    def __init__(self, cols, kinds, arrays, masks):
+        self.cols = list(cols)
+        self.kinds = list(kinds)
+        self._arrays = arrays
+        self._masks = masks
+        self._frame = None
+
+    @classmethod
+    def from_cursor(cls, cur, batch_rows=DEFAULT_BATCH_ROWS):
+        """Drain a (tuple-returning) cursor batch by batch into column arrays."""
+        cols = [d.name for d in cur.description]
+        kinds = [_PG_KINDS.get(d.type_code, "object") for d in cur.description]
+        chunks = [[] for _ in cols]
+        mask_chunks = [[] for _ in cols]
+        while True:
+            batch = cur.fetchmany(batch_rows)
+            if not batch:
+                break
+            cls._append_batch(batch, kinds, chunks, mask_chunks)
+        return cls._build(cols, kinds, chunks, mask_chunks)
+
+    @classmethod
+    def from_rows(cls, rows, cols, type_codes=None):
+        """Build from tuples (or dicts keyed by column) already fetched."""
+        if type_codes is None:
+            kinds = ["object"] * len(cols)
+        else:
+            kinds = [_PG_KINDS.get(t, "object") for t in type_codes]
+        rows = [tuple(r[c] for c in cols) if isinstance(r, dict) else r for r in rows]
+        chunks = [[] for _ in cols]
+        mask_chunks = [[] for _ in cols]
+        if rows:
+            cls._append_batch(rows, kinds, chunks, mask_chunks)
+        return cls._build(cols, kinds, chunks, mask_chunks)
+
+    @staticmethod
+    def _append_batch(batch, kinds, chunks, mask_chunks):
+        n = len(batch)
+        for j, values in enumerate(zip(*batch)):
+            data, mask = _decode(kinds[j], values)
+            chunks[j].append(data)
+            mask_chunks[j].append(mask if mask is not None else n)
+
+    @classmethod
+    def _build(cls, cols, kinds, chunks, mask_chunks):
+        arrays, masks = [], []
+        for kind, parts, mparts in zip(kinds, chunks, mask_chunks):
+            if not parts:
+                arrays.append(np.empty(0, dtype=_DTYPES[kind]))
+                masks.append(None)
+                continue
+            arrays.append(parts[0] if len(parts) == 1 else np.concatenate(parts))
+            # An int in mparts is the length of a batch that had no NULLs
+            if all(isinstance(m, int) for m in mparts):
+                masks.append(None)
+            else:
+                masks.append(
+                    np.concatenate(
+                        [np.zeros(m, dtype=np.bool_) if isinstance(m, int) else m for m in mparts]
+                    )
+                )
+        return cls(cols, kinds, arrays, masks)
+
+    # ----- list-of-dicts compatibility -----
+
+    def __len__(self):
+        return len(self._arrays[0]) if self._arrays else 0
+
+    @property
+    def row_count(self):
+        return len(self)
+
+    def _value(self, j, i):
+        mask = self._masks[j]
+        if mask is not None and mask[i]:
+            return None
+        value = self._arrays[j][i]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("ColumnarResult slices must be contiguous")
+            return self.slice(start, stop)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return {c: self._value(j, i) for j, c in enumerate(self.cols)}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # ----- columnar access -----
+
+    def column(self, name):
+        """The raw array of one column (NULL slots hold a fill value; see mask())."""
+        return self._arrays[self.cols.index(name)]
+
+    def mask(self, name):
+        """Boolean NULL mask of one column, or None if it has no NULLs."""
+        return self._masks[self.cols.index(name)]
+
+    def parts(self):
+        """(name, kind, array, mask or None) for every column, in order."""
+        return list(zip(self.cols, self.kinds, self._arrays, self._masks))
+
+    def slice(self, start, stop):
+        """Rows [start, stop) as a new ColumnarResult sharing this one's memory."""
+        return ColumnarResult(
+            self.cols,
+            self.kinds,
+            [a[start:stop] for a in self._arrays],
+            [m[start:stop] if m is not None else None for m in self._masks],
+        )
+
+    @property
+    def nbytes(self):
+        """Bytes held by the column buffers (object columns count their pointers only)."""
+        return sum(a.nbytes for a in self._arrays) + sum(
+            m.nbytes for m in self._masks if m is not None
+        )
+
+    def to_pandas(self):
+        """
+        A DataFrame over the column arrays. Numeric, boolean and timestamp
+        columns are wrapped, not copied; the frame is built once and reused.
+        """
+        if self._frame is not None:
+            return self._frame
+        import pandas as pd
+
+        data = {}
+        for col, kind, array, mask in zip(self.cols, self.kinds, self._arrays, self._masks):
+            if mask is not None and kind == "int":
+                data[col] = pd.arrays.IntegerArray(array, mask)
+            elif mask is not None and kind == "bool":
+                data[col] = pd.arrays.BooleanArray(array, mask)
+            elif kind == "timestamptz":
+                data[col] = pd.DatetimeIndex(array).tz_localize("UTC")
+            else:
+                data[col] = array
+        # copy=False also skips consolidating same-typed columns into one block
+        self._frame = pd.DataFrame(data, columns=self.cols, copy=False)
+        return self._frame
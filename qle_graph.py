@@ -0,0 +1,127 @@
+# qle_graph.py
+import threading
+
+import networkx as nx
+
+
+class LineageGraphCache:
+    """
+    Process-wide lineage graph, kept in sync with qle.* by applying deltas.
+
+    The graph holds the `max_nodes` most recent queries (by query_id) and the
+    edges between them. refresh() only asks the database for queries above
+    the high-water mark (plus ids explicitly noted as added), and drops ids
+    noted as deleted, so its cost follows the size of the change rather than
+    the size of the history.
+
+    Each refresh that changes something publishes a new frozen DiGraph and
+    bumps `version`; readers can hold on to a graph without locking. The
+    delta is loaded without holding the lock, and one refresh runs at a
+    time: a refresh() called meanwhile returns the current graph at once.
+
+    load_nodes(hwm, extra_ids, limit) -> node dicts (with "query_id")
+        newer than hwm (all if hwm is None) or listed in extra_ids
+    load_edges(child_ids) -> edge dicts (parent_query_id, child_query_id, edge_type)
+    """
+
+    def __init__(self, load_nodes, load_edges, max_nodes=500):
+        self._load_nodes = load_nodes
+        self._load_edges = load_edges
+        self.max_nodes = max_nodes
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.graph = nx.freeze(nx.DiGraph())
+        self.version = 0
+        self._hwm = None  # highest query_id loaded; None = needs a full load
+        self._added = set()  # noted ids that may sit below the high-water mark
+        self._deleted = set()
+        self._generation = 0  # bumped by invalidate()
+
+    def note_added(self, query_ids):
+        with self._lock:
+            self._added.update(query_ids)
+            self._deleted.difference_update(query_ids)
+
+    def note_deleted(self, query_ids):
+        with self._lock:
+            self._deleted.update(query_ids)
+            self._added.difference_update(query_ids)
+
+    def invalidate(self):
+        """Drop everything; the next refresh() reloads from scratch."""
+        with self._lock:
+            self._hwm = None
+            self._added.clear()
+            self._deleted.clear()
+            self._generation += 1
+
+    def refresh(self):
+        """Apply pending changes and return (graph, version)."""
+        if not self._refresh_lock.acquire(blocking=False):
+            # Another thread is loading a delta: serve the current snapshot
+            with self._lock:
+                return self.graph, self.version
+        try:
+            while True:
+                result = self._refresh()
+                if result is not None:
+                    return result
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self):
+        """One refresh; None if invalidate() was called while loading."""
+        with self._lock:
+            generation = self._generation
+            full = self._hwm is None
+            hwm = self._hwm
+            noted = set(self._added)
+            added = set() if full else noted
+            deleted = set(self._deleted)
+            base = self.graph
+
+        # Database round trips without the lock: note_*() and readers
+        # aren't held up by them
+        nodes = self._load_nodes(hwm, sorted(added), self.max_nodes)
+        if not full and not nodes and not deleted:
+            with self._lock:
+                return self.graph, self.version
+
+        G = nx.DiGraph() if full else nx.DiGraph(base)
+        G.remove_nodes_from(deleted)
+
+        new_ids = []
+        for n in nodes:
+            qid = n["query_id"]
+            if qid in deleted:
+                continue
+            G.add_node(qid, **n)
+            new_ids.append(qid)
+        if new_ids:
+            for e in self._load_edges(new_ids):
+                # Edges to queries outside the window are left out
+                if e["parent_query_id"] in G and e["child_query_id"] in G:
+                    G.add_edge(
+                        e["parent_query_id"],
+                        e["child_query_id"],
+                        edge_type=e["edge_type"],
+                    )
+
+        excess = G.number_of_nodes() - self.max_nodes
+        if excess > 0:
+            G.remove_nodes_from(sorted(G.nodes)[:excess])
+
+        with self._lock:
+            if self._generation != generation:
+                # What was loaded may predate the invalidation
+                return None
+            # Ids noted while loading stay pending for the next refresh
+            self._added -= noted if full else set(new_ids)
+            self._deleted -= deleted
+            if G.number_of_nodes():
+                self._hwm = max(max(G.nodes), self._hwm or 0)
+            else:
+                self._hwm = self._hwm or 0
+            self.graph = nx.freeze(G)
+            self.version += 1
+            return self.graph, self.version
@@ -0,0 +1,651 @@
+# qle_ingest.py
+"""
+Bulk ingestion of query logs recorded outside QLE.
+
+Reads a Postgres CSV log (log_destination = 'csvlog'), a pg_stat_statements
+snapshot exported as CSV, or a JSONL file, and loads the statements into
+qle.query / qle.query_table / qle.edge / qle.lineage_closure with COPY.
+
+The source is read as a stream and cut into chunks; worker processes parse
+each chunk (fingerprint and referenced tables) while the main process loads
+earlier ones, with a fixed number of chunks in flight so memory stays
+bounded whatever the file size. Every chunk is committed together with the
+source's checkpoint in qle.ingest_checkpoint, so an interrupted run picks up
+exactly where the last commit left off.
+
+    python qle_ingest.py /var/log/postgresql/postgresql.csv
+    python qle_ingest.py notebook_queries.jsonl --workers 8
+"""
+import argparse
+import collections
+import csv
+import gzip
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone
+
+import qle_backend as qle
+from qle_sql import content_hash, parse_sql
+
+FORMATS = ("csvlog", "pgss", "jsonl")
+
+# Source records per chunk handed to a worker / loaded in one transaction
+INGEST_CHUNK_SIZE = 5000
+
+# Chunks parsed ahead of the loader, per worker
+INGEST_CHUNKS_IN_FLIGHT = 2
+
+# Session-control statements that say nothing about lineage
+INGEST_SKIP_STATEMENTS = frozenset(
+    {
+        "begin", "start", "commit", "end", "rollback", "savepoint", "release",
+        "set", "reset", "show", "discard", "deallocate", "listen", "unlisten",
+    }
+)
+
+# External ids remembered in memory for parent lookups; older ones are
+# looked up in qle.ingest_key
+INGEST_ID_WINDOW = 200_000
+
+# csvlog columns used (their positions are the same in every server version)
+_CSV_LOG_TIME, _CSV_DATABASE, _CSV_SESSION = 0, 2, 5
+_CSV_SEVERITY, _CSV_MESSAGE, _CSV_QUERY = 11, 13, 19
+
+_DURATION = re.compile(
+    r"^duration: ([0-9.]+) ms(?:\s+(?:statement|execute [^:]*): (.*))?$", re.DOTALL
+)
+_STATEMENT = re.compile(r"^(?:statement|execute [^:]*): (.*)$", re.DOTALL)
+
+_CANCEL_STATUS = {
+    "canceling statement due to statement timeout": "timeout",
+    "canceling statement due to user request": "cancelled",
+}
+
+# Sessions with a statement still waiting for its duration line
+_MAX_PENDING_SESSIONS = 10_000
+
+_QUERY_COLUMNS = (
+    "query_id",
+    "executed_at",
+    "sql_hash",
+    "fingerprint",
+    "runtime_ms",
+    "runtime_us",
+    "row_count",
+    "error_message",
+    "status",
+)
+
+
+def _record(executed_at, sql_text, runtime_ms=None, row_count=None, error_message=None,
+            status=None, external_id=None, parent_ids=()):
+    if isinstance(executed_at, datetime):
+        executed_at = executed_at.isoformat()
+    return {
+        "executed_at": executed_at,  # text; Postgres parses it (as UTC if it has no zone)
+        "sql_text": sql_text.replace("\x00", ""),
+        "runtime_ms": None if runtime_ms is None else round(runtime_ms),
+        "runtime_us": None if runtime_ms is None else round(runtime_ms * 1000),
+        "row_count": row_count,
+        "error_message": error_message,
+        "status": status or ("ok" if error_message is None else "error"),
+        "external_id": None if external_id is None else str(external_id),
+        "parent_ids": [str(p) for p in parent_ids],
+    }
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace", newline="")
+    return open(path, encoding="utf-8", errors="replace", newline="")
+
+
+# ----- sources: each yields _record dicts, in the same order on every read -----
+
+
+def read_csvlog(path, database=None):
+    """
+    Statements from a Postgres CSV log. Understands log_statement output
+    ("statement: ..."), log_min_duration_statement ("duration: .. ms
+    statement: ..."), bare log_duration lines (attached to the session's
+    last statement) and ERROR lines carrying the failed statement.
+    """
+    pending = collections.OrderedDict()  # session_id -> record awaiting its duration
+    with _open(path) as f:
+        for row in csv.reader(f):
+            if len(row) <= _CSV_QUERY:
+                continue
+            if database is not None and row[_CSV_DATABASE] != database:
+                continue
+            session, severity = row[_CSV_SESSION], row[_CSV_SEVERITY]
+            message, logged_at = row[_CSV_MESSAGE], row[_CSV_LOG_TIME]
+
+            if severity == "LOG":
+                m = _DURATION.match(message)
+                if m is not None:
+                    ms = float(m.group(1))
+                    if m.group(2) is not None:
+                        if session in pending:
+                            yield pending.pop(session)
+                        yield _record(logged_at, m.group(2), runtime_ms=ms)
+                    elif session in pending:
+                        record = pending.pop(session)
+                        record["runtime_ms"], record["runtime_us"] = round(ms), round(ms * 1000)
+                        yield record
+                    continue
+                m = _STATEMENT.match(message)
+                if m is not None:
+                    if session in pending:
+                        yield pending.pop(session)
+                    pending[session] = _record(logged_at, m.group(1))
+                    if len(pending) > _MAX_PENDING_SESSIONS:
+                        yield pending.popitem(last=False)[1]
+            elif severity in ("ERROR", "FATAL") and row[_CSV_QUERY]:
+                failed = pending.pop(session, None)
+                if failed is not None and failed["sql_text"] != row[_CSV_QUERY]:
+                    yield failed
+                    failed = None
+                if failed is None:
+                    failed = _record(logged_at, row[_CSV_QUERY])
+                failed["error_message"] = message
+                failed["status"] = _CANCEL_STATUS.get(message, "error")
+                yield failed
+    yield from pending.values()
+
+
+def read_pgss(path, snapshot_at=None):
+    """
+    One record per statement in a pg_stat_statements snapshot, e.g. from
+    \\copy (SELECT * FROM pg_stat_statements) TO 'pgss.csv' CSV HEADER.
+    Runtime and row count are per-call means; executed_at is snapshot_at
+    (default: the file's modification time).
+    """
+    if snapshot_at is None:
+        snapshot_at = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+    with _open(path) as f:
+        for row in csv.DictReader(f):
+            sql_text = row.get("query") or ""
+            if not sql_text or sql_text == "<insufficient privilege>":
+                continue
+            calls = int(row.get("calls") or 0)
+            mean = row.get("mean_exec_time") or row.get("mean_time")
+            total = row.get("total_exec_time") or row.get("total_time")
+            if mean:
+                runtime_ms = float(mean)
+            elif total and calls:
+                runtime_ms = float(total) / calls
+            else:
+                runtime_ms = None
+            rows = row.get("rows")
+            row_count = int(rows) // calls if rows and calls else None
+            yield _record(snapshot_at, sql_text, runtime_ms=runtime_ms, row_count=row_count)
+
+
+def read_jsonl(path):
+    """
+    One statement per line: {"sql": ..., "executed_at": ISO text or epoch
+    seconds, "runtime_ms", "row_count", "error", "status", "id",
+    "parent_ids": [ids of earlier lines]}. Only "sql" is required.
+    """
+    now = datetime.now(timezone.utc)
+    with _open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            sql_text = obj.get("sql") or obj.get("sql_text") or obj.get("query")
+            if not sql_text:
+                continue
+            executed_at = obj.get("executed_at", now)
+            if isinstance(executed_at, (int, float)):
+                executed_at = datetime.fromtimestamp(executed_at, timezone.utc)
+            yield _record(
+                executed_at,
+                sql_text,
+                runtime_ms=obj.get("runtime_ms"),
+                row_count=obj.get("row_count"),
+                error_message=obj.get("error") or obj.get("error_message"),
+                status=obj.get("status"),
+                external_id=obj.get("id"),
+                parent_ids=obj.get("parent_ids") or (),
+            )
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith((".jsonl", ".ndjson", ".json")):
+        return "jsonl"
+    with _open(path) as f:
+        header = next(csv.reader(f), [])
+    if "query" in header and "calls" in header:
+        return "pgss"
+    return "csvlog"
+
+
+def _read(path, fmt, database=None, snapshot_at=None):
+    if fmt == "csvlog":
+        return read_csvlog(path, database=database)
+    if fmt == "pgss":
+        return read_pgss(path, snapshot_at=snapshot_at)
+    if fmt == "jsonl":
+        return read_jsonl(path)
+    raise ValueError(f"Unknown format {fmt!r}; expected one of {FORMATS}")
+
+
+# ----- worker side -----
+
+
+def _prepare_chunk(sql_texts):
+    """
+    Runs in a worker process: (sql_hash, fingerprint, tables) per
+    statement, or None for statements that aren't worth logging.
+    """
+    out = []
+    for sql_text in sql_texts:
+        parsed = parse_sql(sql_text)
+        if parsed.statement_type in INGEST_SKIP_STATEMENTS:
+            out.append(None)
+        else:
+            out.append((content_hash(sql_text), parsed.fingerprint_hash, parsed.tables))
+    return out
+
+
+# ----- loader -----
+
+
+def _copy_value(v):
+    if v is None:
+        return "\\N"
+    return (
+        str(v)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_rows(cur, table, cols, rows):
+    """COPY rows (tuples) into table in text format; returns how many."""
+    rows = list(rows)
+    if not rows:
+        return 0
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_value(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(cols)}) FROM STDIN", buf)
+    return len(rows)
+
+
+class _Loader:
+    """Loads prepared chunks for one source; remembers recent external ids."""
+
+    def __init__(self, source, stats):
+        self.source = source
+        self.stats = stats
+        self._ids = collections.OrderedDict()  # external_id -> query_id, oldest first
+        self._months = set()  # (year, month) partitions known to exist
+
+    def _ensure_partitions(self, times):
+        with qle.pooled_conn("meta") as conn:
+            with conn.cursor() as cur:
+                cur.execute("SET TIME ZONE 'UTC'")
+                cur.execute(
+                    "SELECT MIN(t), MAX(t) FROM unnest(%s::timestamptz[]) AS t", (times,)
+                )
+                lo, hi = cur.fetchone()
+            conn.rollback()
+        months = {(lo.year, lo.month), (hi.year, hi.month)}
+        if not months <= self._months:
+            qle.ensure_partitions(lo, hi)
+            self._months |= months
+
+    def _resolve(self, cur, external_ids):
+        """query ids for external ids of this source that aren't in the window."""
+        if not external_ids:
+            return {}
+        # Parents archived by retention still resolve (see qle.archived_query)
+        cur.execute(
+            """
+            SELECT k.external_id, k.query_id
+            FROM qle.ingest_key k
+            WHERE k.source = %s
+              AND k.external_id = ANY(%s)
+              AND (
+                  EXISTS (
+                      SELECT 1 FROM qle.query q
+                      WHERE q.query_id = k.query_id AND q.executed_at = k.executed_at
+                  )
+                  OR EXISTS (SELECT 1 FROM qle.archived_query a WHERE a.query_id = k.query_id)
+              )
+            """,
+            (self.source, list(external_ids)),
+        )
+        return dict(cur.fetchall())
+
+    def load(self, records, prepared, position):
+        """Load one chunk and advance the checkpoint to position, atomically."""
+        keep = [(r, p) for r, p in zip(records, prepared) if p is not None]
+        self.stats["skipped"] += len(records) - len(keep)
+        ids = qle._reserve_query_ids(len(keep)) if keep else []
+        if keep:
+            self._ensure_partitions([r["executed_at"] for r, _ in keep])
+
+        with qle.pooled_conn("meta") as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("SET LOCAL TIME ZONE 'UTC'")
+                cur.execute(
+                    "SELECT position FROM qle.ingest_checkpoint WHERE source = %s FOR UPDATE",
+                    (self.source,),
+                )
+                row = cur.fetchone()
+                if row is not None and row[0] >= position:
+                    # Another run already loaded this chunk
+                    conn.rollback()
+                    cur.close()
+                    return
+
+                # Parents named by external id: earlier in this chunk, in the
+                # in-memory window, or (after a restart) in qle.ingest_key
+                local = {}
+                for (r, _), query_id in zip(keep, ids):
+                    if r["external_id"] is not None:
+                        local[r["external_id"]] = query_id
+                missing = {
+                    p
+                    for r, _ in keep
+                    for p in r["parent_ids"]
+                    if p not in local and p not in self._ids
+                }
+                found = self._resolve(cur, missing)
+
+                query_rows, table_rows, edge_rows, key_rows = [], [], [], []
+                texts = {}
+                for (r, (sql_hash, fingerprint, tables)), query_id in zip(keep, ids):
+                    at = r["executed_at"]
+                    texts[sql_hash] = r["sql_text"]
+                    query_rows.append(
+                        (query_id, at, sql_hash, fingerprint, r["runtime_ms"],
+                         r["runtime_us"], r["row_count"], r["error_message"], r["status"])
+                    )
+                    if r["error_message"] is None:
+                        table_rows.extend((query_id, at, t) for t in tables)
+                    parents = []
+                    for p in r["parent_ids"]:
+                        parent_id = local.get(p)
+                        if parent_id is None:
+                            parent_id = self._ids.get(p)
+                        if parent_id is None:
+                            parent_id = found.get(p)
+                        if parent_id is None or parent_id >= query_id:
+                            self.stats["unresolved_parents"] += 1
+                            continue
+                        parents.append(parent_id)
+                    edge_rows.extend((p, query_id, at, "derived") for p in parents)
+                    if r["external_id"] is not None:
+                        key_rows.append((self.source, r["external_id"], query_id, at))
+
+                if texts:
+                    # Most texts are usually known already: stage, then add the new ones
+                    cur.execute(
+                        "CREATE TEMP TABLE IF NOT EXISTS qle_ingest_text_tmp "
+                        "(LIKE qle.sql_text) ON COMMIT DELETE ROWS"
+                    )
+                    _copy_rows(cur, "qle_ingest_text_tmp", ("sql_hash", "sql_text"), texts.items())
+                    cur.execute(
+                        """
+                        INSERT INTO qle.sql_text (sql_hash, sql_text)
+                        SELECT sql_hash, sql_text FROM qle_ingest_text_tmp
+                        ORDER BY sql_hash
+                        ON CONFLICT (sql_hash) DO NOTHING
+                        """
+                    )
+                _copy_rows(cur, "qle.query", _QUERY_COLUMNS, query_rows)
+                _copy_rows(cur, "qle.query_table", ("query_id", "executed_at", "table_name"), table_rows)
+                _copy_rows(
+                    cur,
+                    "qle.edge",
+                    ("parent_query_id", "child_query_id", "child_executed_at", "edge_type"),
+                    edge_rows,
+                )
+                _copy_rows(
+                    cur,
+                    "qle.lineage_closure",
+                    ("ancestor_id", "descendant_id", "depth"),
+                    [(query_id, query_id, 0) for query_id in ids],
+                )
+                if edge_rows:
+                    # The whole chunk's closure rows in one statement
+                    cur.execute(
+                        "CREATE TEMP TABLE IF NOT EXISTS qle_ingest_edge_tmp "
+                        "(child_id INTEGER, parent_id INTEGER) ON COMMIT DELETE ROWS"
+                    )
+                    _copy_rows(
+                        cur,
+                        "qle_ingest_edge_tmp",
+                        ("child_id", "parent_id"),
+                        [(child, parent) for parent, child, _, _ in edge_rows],
+                    )
+                    cur.execute("ANALYZE qle_ingest_edge_tmp")
+                    qle._link_new_closure(cur, "qle_ingest_edge_tmp")
+                if ids:
+                    qle._update_fingerprint_stats(cur, ids)
+                if key_rows:
+                    # A re-used external id points at its latest statement
+                    cur.execute(
+                        "CREATE TEMP TABLE IF NOT EXISTS qle_ingest_key_tmp "
+                        "(LIKE qle.ingest_key) ON COMMIT DELETE ROWS"
+                    )
+                    _copy_rows(
+                        cur,
+                        "qle_ingest_key_tmp",
+                        ("source", "external_id", "query_id", "executed_at"),
+                        key_rows,
+                    )
+                    cur.execute(
+                        """
+                        INSERT INTO qle.ingest_key AS k
+                        SELECT DISTINCT ON (source, external_id) *
+                        FROM qle_ingest_key_tmp
+                        ORDER BY source, external_id, query_id DESC
+                        ON CONFLICT (source, external_id) DO UPDATE
+                            SET query_id = EXCLUDED.query_id,
+                                executed_at = EXCLUDED.executed_at
+                        """
+                    )
+                cur.execute(
+                    """
+                    INSERT INTO qle.ingest_checkpoint (source, position, loaded, updated_at)
+                    VALUES (%s, %s, %s, NOW())
+                    ON CONFLICT (source) DO UPDATE
+                        SET position = EXCLUDED.position,
+                            loaded = qle.ingest_checkpoint.loaded + EXCLUDED.loaded,
+                            updated_at = NOW()
+                    """,
+                    (self.source, position, len(query_rows)),
+                )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                cur.close()
+                raise e
+            cur.close()
+
+        for _, external_id, query_id, _ in key_rows:
+            self._ids[external_id] = query_id
+            self._ids.move_to_end(external_id)
+        while len(self._ids) > INGEST_ID_WINDOW:
+            self._ids.popitem(last=False)
+
+        self.stats["queries"] += len(query_rows)
+        self.stats["tables"] += len(table_rows)
+        self.stats["edges"] += len(edge_rows)
+
+
+# ----- driver -----
+
+
+def default_source(path, fmt):
+    return f"{fmt}:{os.path.abspath(path)}"
+
+
+def get_checkpoint(source):
+    """(position, loaded) recorded for source, or None if it was never ingested."""
+    with qle.pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT position, loaded FROM qle.ingest_checkpoint WHERE source = %s",
+                (source,),
+            )
+            row = cur.fetchone()
+        conn.rollback()
+    return tuple(row) if row else None
+
+
+def reset_checkpoint(source):
+    """Forget how far source was loaded (its queries stay); the next run starts over."""
+    with qle.pooled_conn("meta") as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM qle.ingest_checkpoint WHERE source = %s", (source,))
+            cur.execute("DELETE FROM qle.ingest_key WHERE source = %s", (source,))
+        conn.commit()
+
+
+def _chunks(records, size, start):
+    """(records, position after them) for consecutive chunks of the source."""
+    position = start
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        position += len(chunk)
+        yield chunk, position
+
+
+def ingest(path, fmt=None, source=None, workers=None, chunk_size=INGEST_CHUNK_SIZE,
+           database=None, snapshot_at=None, progress=None):
+    """
+    Stream path into the lineage store, resuming from source's checkpoint.
+
+    fmt:         "csvlog", "pgss" or "jsonl" (default: guessed from the file)
+    source:      checkpoint key (default: format + absolute path)
+    workers:     parser processes (default: CPUs - 1; 0 parses in-process)
+    database:    csvlog only: keep statements run against this database
+    snapshot_at: pgss only: timestamp to log the statements at
+    progress:    called with the running stats dict after every chunk
+    Returns stats: read, skipped, queries, tables, edges, unresolved_parents,
+    seconds and statements_per_minute.
+    """
+    fmt = fmt or detect_format(path)
+    source = source or default_source(path, fmt)
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) - 1)
+    checkpoint = get_checkpoint(source)
+    start = checkpoint[0] if checkpoint else 0
+
+    stats = {
+        "source": source,
+        "resumed_at": start,
+        "read": 0,
+        "skipped": 0,
+        "queries": 0,
+        "tables": 0,
+        "edges": 0,
+        "unresolved_parents": 0,
+    }
+    loader = _Loader(source, stats)
+    records = _read(path, fmt, database=database, snapshot_at=snapshot_at)
+    # Records before the checkpoint were loaded by an earlier run
+    records = itertools.islice(records, start, None)
+    started = time.perf_counter()
+
+    def finish(chunk, position, prepared):
+        loader.load(chunk, prepared, position)
+        stats["read"] += len(chunk)
+        if progress is not None:
+            progress(stats)
+
+    chunks = _chunks(records, chunk_size, start)
+    if workers == 0:
+        for chunk, position in chunks:
+            finish(chunk, position, _prepare_chunk([r["sql_text"] for r in chunk]))
+    else:
+        # Keep a fixed number of chunks in flight and load them in source
+        # order, so the checkpoint only ever moves past fully loaded chunks
+        with multiprocessing.Pool(workers) as pool:
+            in_flight = collections.deque()
+            for chunk, position in chunks:
+                in_flight.append(
+                    (chunk, position,
+                     pool.apply_async(_prepare_chunk, ([r["sql_text"] for r in chunk],)))
+                )
+                if len(in_flight) >= workers * INGEST_CHUNKS_IN_FLIGHT:
+                    chunk, position, result = in_flight.popleft()
+                    finish(chunk, position, result.get())
+            while in_flight:
+                chunk, position, result = in_flight.popleft()
+                finish(chunk, position, result.get())
+
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    stats["statements_per_minute"] = (
+        round(stats["read"] * 60 / stats["seconds"]) if stats["seconds"] else None
+    )
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("path", help="CSV log, pg_stat_statements CSV or JSONL file (.gz ok)")
+    parser.add_argument("--format", choices=FORMATS, help="default: guessed from the file")
+    parser.add_argument("--source", help="checkpoint key (default: format + absolute path)")
+    parser.add_argument("--workers", type=int, help="parser processes (0 = in-process)")
+    parser.add_argument("--chunk-size", type=int, default=INGEST_CHUNK_SIZE)
+    parser.add_argument("--database", help="csvlog: only statements run in this database")
+    parser.add_argument(
+        "--snapshot-at", help="pgss: ISO timestamp of the snapshot (default: file mtime)"
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore the checkpoint and read from the start"
+    )
+    parser.add_argument("--dsn", help="default: qle_backend.DSN")
+    args = parser.parse_args(argv)
+
+    if args.dsn:
+        qle.configure_pools(meta={"dsn": args.dsn}, user={"dsn": args.dsn})
+    fmt = args.format or detect_format(args.path)
+    source = args.source or default_source(args.path, fmt)
+    if args.restart:
+        reset_checkpoint(source)
+
+    def progress(stats):
+        print(
+            f"{stats['resumed_at'] + stats['read']} records, {stats['queries']} queries loaded",
+            file=sys.stderr,
+        )
+
+    stats = ingest(
+        args.path,
+        fmt=fmt,
+        source=source,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        database=args.database,
+        snapshot_at=datetime.fromisoformat(args.snapshot_at) if args.snapshot_at else None,
+        progress=progress,
+    )
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
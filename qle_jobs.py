@@ -0,0 +1,160 @@
+# qle_jobs.py
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Job states; the last four are final
+JOB_STATES = ("queued", "running", "ok", "error", "cancelled", "timeout")
+
+
+class JobCancelled(Exception):
+    """Raised in the worker when a job was cancelled before its statement started."""
+
+
+class QueryJob:
+    """
+    One statement submitted for asynchronous execution.
+
+    The worker reports the Postgres backend pid it is running on with
+    attach() / detach(); cancel() calls `cancel_backend(pid)` only while a
+    pid is attached, under the same lock, so a cancel can never hit a
+    connection that has already gone back to the pool.
+    """
+
+    def __init__(self, job_id, sql_text, cancel_backend):
+        self.job_id = job_id
+        self.sql_text = sql_text
+        self._cancel_backend = cancel_backend
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.status = "queued"
+        self.pid = None
+        self.cancel_requested = False
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None  # run_query's (query_id, rows, cols, error_message)
+        self.exception = None
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def elapsed(self):
+        """Seconds spent running so far (or in total, once finished)."""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def attach(self, pid):
+        """Called by the worker just before executing; False if already cancelled."""
+        with self._lock:
+            if self.cancel_requested:
+                return False
+            self.pid = pid
+            return True
+
+    def detach(self):
+        with self._lock:
+            self.pid = None
+
+    def cancel(self):
+        """Request cancellation; the running statement is cancelled server-side."""
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self.cancel_requested = True
+            if self.pid is not None:
+                self._cancel_backend(self.pid)
+        return True
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def info(self):
+        query_id = self.result[0] if self.result else None
+        error_message = self.result[3] if self.result else None
+        if self.exception is not None:
+            error_message = str(self.exception)
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "query_id": query_id,
+            "elapsed_s": round(self.elapsed(), 3),
+            "queued_s": round(
+                (self.started_at or time.monotonic()) - self.submitted_at, 3
+            ),
+            "cancel_requested": self.cancel_requested,
+            "error_message": error_message,
+            "sql_text": self.sql_text,
+        }
+
+    def _finish(self, status):
+        self.finished_at = time.monotonic()
+        self.status = status
+        self._done.set()
+
+
+class JobRunner:
+    """
+    Runs statements on a small thread pool so callers can poll instead of block.
+
+    `run(job)` executes job.sql_text and returns run_query's tuple plus a
+    status (one of "ok", "error", "cancelled", "timeout"); finished jobs are
+    kept for `retention` seconds so their results can still be collected.
+    """
+
+    def __init__(self, run, cancel_backend, max_workers=4, retention=600.0):
+        self._run = run
+        self._cancel_backend = cancel_backend
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="qle-job"
+        )
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, sql_text, **kwargs):
+        self._prune()
+        job = QueryJob(next(self._ids), sql_text, self._cancel_backend)
+        with self._lock:
+            self._jobs[job.job_id] = job
+        self._executor.submit(self._work, job, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.job_id)
+
+    def shutdown(self, cancel_running=True):
+        if cancel_running:
+            for job in self.jobs():
+                job.cancel()
+        self._executor.shutdown(wait=True)
+
+    def _work(self, job, kwargs):
+        job.started_at = time.monotonic()
+        job.status = "running"
+        status = "error"
+        try:
+            job.result, status = self._run(job, **kwargs)
+        except Exception as e:
+            job.exception = e
+        finally:
+            job._finish(status)
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.retention
+        with self._lock:
+            for job_id in [
+                j.job_id
+                for j in self._jobs.values()
+                if j.done and j.finished_at < cutoff
+            ]:
+                del self._jobs[job_id]
@@ -0,0 +1,159 @@
+# qle_layout.py
+import math
+import threading
+
+import networkx as nx
+
+LAYOUT_MODES = ("incremental", "hierarchical")
+
+
+def hierarchical_layout(G, spacing=1.0):
+    """
+    Layered DAG layout in O(V + E) (plus a per-layer sort).
+
+    Each node sits one level below its deepest parent; within a level nodes
+    are ordered by the mean x of their parents so children stay under their
+    parents. Falls back to node order if G has a cycle.
+    """
+    try:
+        order = list(nx.topological_sort(G))
+    except nx.NetworkXUnfeasible:
+        order = sorted(G.nodes)
+
+    depth = {}
+    for n in order:
+        parents = [p for p in G.predecessors(n) if p in depth]
+        depth[n] = max((depth[p] + 1 for p in parents), default=0)
+
+    layers = {}
+    for n in order:
+        layers.setdefault(depth[n], []).append(n)
+
+    pos = {}
+    for d in sorted(layers):
+        layer = layers[d]
+
+        def barycenter(n):
+            xs = [pos[p][0] for p in G.predecessors(n) if p in pos]
+            return (sum(xs) / len(xs) if xs else math.inf, n)
+
+        layer.sort(key=barycenter)
+        offset = (len(layer) - 1) / 2.0
+        for i, n in enumerate(layer):
+            pos[n] = ((i - offset) * spacing, -d * spacing)
+    return pos
+
+
+class LayoutCache:
+    """
+    Node positions cached per graph version.
+
+    "incremental": the first layout is a spring layout; afterwards existing
+    nodes keep their positions, new nodes are placed just below their
+    parents (roots to the right of the drawing) and only the new nodes and
+    their direct neighbours get a few spring iterations. Cost per new query
+    stays roughly constant instead of re-running the O(n^2) layout.
+
+    "hierarchical": hierarchical_layout(), recomputed when the version changes.
+    """
+
+    def __init__(self, spacing=1.0, refine_iterations=10, initial_spring_max_nodes=300):
+        self.spacing = spacing
+        self.refine_iterations = refine_iterations
+        # Above this size the very first layout is hierarchical rather than spring
+        self.initial_spring_max_nodes = initial_spring_max_nodes
+        self._lock = threading.Lock()
+        self._pos = {}
+        self._cached = {}  # mode -> (version, positions)
+
+    def layout(self, G, version, mode="incremental"):
+        if mode not in LAYOUT_MODES:
+            raise ValueError(f"Unknown layout mode: {mode}")
+        with self._lock:
+            cached = self._cached.get(mode)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            if mode == "hierarchical":
+                pos = hierarchical_layout(G, self.spacing)
+            else:
+                pos = self._incremental(G)
+            self._cached[mode] = (version, pos)
+            return pos
+
+    def reset(self):
+        with self._lock:
+            self._pos = {}
+            self._cached = {}
+
+    def _incremental(self, G):
+        pos = {n: xy for n, xy in self._pos.items() if n in G}
+        new_nodes = [n for n in G.nodes if n not in pos]
+
+        if not pos and new_nodes:
+            n = len(new_nodes)
+            if n <= self.initial_spring_max_nodes:
+                scale = max(1.0, math.sqrt(n)) * self.spacing
+                pos = nx.spring_layout(G, seed=42, scale=scale)
+                pos = {k: (float(v[0]), float(v[1])) for k, v in pos.items()}
+            else:
+                pos = hierarchical_layout(G, self.spacing)
+            self._pos = pos
+            return dict(pos)
+
+        if new_nodes:
+            try:
+                new_nodes = list(nx.topological_sort(G.subgraph(new_nodes)))
+            except nx.NetworkXUnfeasible:
+                new_nodes.sort()
+
+            right = max((xy[0] for xy in pos.values()), default=0.0)
+            children_placed = {}
+            for n in new_nodes:
+                parents = [p for p in G.predecessors(n) if p in pos]
+                if parents:
+                    px = sum(pos[p][0] for p in parents) / len(parents)
+                    py = sum(pos[p][1] for p in parents) / len(parents)
+                    first = parents[0]
+                    if first not in children_placed:
+                        children_placed[first] = sum(
+                            1 for c in G.successors(first) if c in pos
+                        )
+                    k = children_placed[first]
+                    children_placed[first] = k + 1
+                    # Fan siblings out alternately left/right of the parent
+                    shift = ((k + 1) // 2) * (1 if k % 2 else -1) * self.spacing
+                    pos[n] = (px + shift, py - self.spacing)
+                else:
+                    right += self.spacing
+                    pos[n] = (right, 0.0)
+
+            if self.refine_iterations:
+                neighbours = set()
+                for n in new_nodes:
+                    neighbours.update(G.predecessors(n))
+                    neighbours.update(G.successors(n))
+                neighbours.difference_update(new_nodes)
+                local = G.subgraph(set(new_nodes) | neighbours)
+                if neighbours:
+                    refined = nx.spring_layout(
+                        local,
+                        pos={k: pos[k] for k in local},
+                        fixed=list(neighbours),
+                        iterations=self.refine_iterations,
+                        k=self.spacing,
+                        seed=42,
+                    )
+                    for k in new_nodes:
+                        pos[k] = (float(refined[k][0]), float(refined[k][1]))
+
+        self._pos = pos
+        return dict(pos)
+
+
+# Shared by every Streamlit session in this process, like the lineage graph cache
+_default_cache = LayoutCache()
+
+
+def layout(G, version, mode="incremental"):
+    """Positions for G from the process-wide layout cache."""
+    return _default_cache.layout(G, version, mode)
@@ -0,0 +1,279 @@
+# qle_logger.py
+import atexit
+import collections
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+
+class WriteBehindLogger:
+    """
+    In-process write-behind queue for query log records.
+
+    submit() assigns a query_id from a block of pre-reserved sequence values
+    and returns immediately; a background thread hands queued records to
+    `write_batch(records)` in batches. If `journal_path` is set, every record
+    is appended to a local journal and fsync'd before submit() returns, so
+    records that were acknowledged but not yet written survive a crash and
+    are replayed on the next start. `write_batch` must therefore be
+    idempotent on query_id.
+
+    A batch that still fails after `max_attempts` tries is written record by
+    record, and the records that fail on their own are dead-lettered: appended
+    to `dead_letter_path` (journal format; journal_path + ".dead" by default)
+    or, without a journal, kept in `dead_letters`. They count as written, so
+    one bad record or a database outage can't block flush() forever.
+    """
+
+    def __init__(
+        self,
+        write_batch,
+        reserve_ids,
+        batch_size=200,
+        flush_interval=0.2,
+        id_block_size=100,
+        journal_path=None,
+        max_queue=10000,
+        retry_interval=1.0,
+        max_attempts=5,
+        dead_letter_path=None,
+        shutdown_timeout=10.0,
+    ):
+        self._write_batch = write_batch
+        self._reserve_ids = reserve_ids
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.id_block_size = id_block_size
+        self.journal_path = journal_path
+        self.max_queue = max_queue
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        if dead_letter_path is None and journal_path:
+            dead_letter_path = journal_path + ".dead"
+        self.dead_letter_path = dead_letter_path
+        self.dead_letters = collections.deque(maxlen=max_queue)
+        self.shutdown_timeout = shutdown_timeout
+
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._ids = collections.deque()
+        self._id_generation = 0  # bumped by reset_reservations()
+        self._submitted = 0
+        self._written = 0
+        self._closed = False
+        self.last_error = None
+        self.stats = {
+            "submitted": 0,
+            "written": 0,
+            "batches": 0,
+            "failures": 0,
+            "dead_lettered": 0,
+        }
+
+        self._journal = None
+        if journal_path:
+            self._replay_journal()
+            self._journal = open(journal_path, "a", encoding="utf-8")
+
+        self._thread = threading.Thread(
+            target=self._run, name="qle-write-behind", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self._close_at_exit)
+
+    # --- producer side -------------------------------------------------
+
+    def submit(self, record):
+        """Queue a log record (dict) and return the query_id assigned to it."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind logger is closed")
+            while len(self._queue) >= self.max_queue:
+                # Back-pressure: don't let the queue grow without bound
+                self._cond.wait()
+            query_id = self._ids.popleft() if self._ids else None
+            generation = self._id_generation
+
+        if query_id is None:
+            # A database round trip: done outside the lock so other submit()
+            # calls and the writer aren't held up by it
+            block = list(self._reserve_ids(self.id_block_size))
+            query_id = block.pop(0)
+            with self._cond:
+                if generation == self._id_generation:
+                    self._ids.extend(block)
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind logger is closed")
+            record = dict(record, query_id=query_id)
+
+            if self._journal is not None:
+                self._journal.write(json.dumps(record, default=_json_default) + "\n")
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+
+            self._queue.append(record)
+            self._submitted += 1
+            self.stats["submitted"] += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return record["query_id"]
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far is written. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            target = self._submitted
+            self._cond.notify_all()
+            while self._written < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def pending(self):
+        with self._cond:
+            return self._submitted - self._written
+
+    def queued_ids(self):
+        """query_ids submitted but not written yet."""
+        with self._cond:
+            return {record["query_id"] for record in self._queue}
+
+    def reset_reservations(self):
+        """Forget unused reserved ids (call after the query_id sequence is reset)."""
+        with self._cond:
+            self._ids.clear()
+            self._id_generation += 1
+
+    def close(self, timeout=None):
+        """Flush outstanding records, stop the writer thread and fsync the journal."""
+        with self._cond:
+            if self._closed:
+                return
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._journal is not None:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+            self._journal = None
+        atexit.unregister(self._close_at_exit)
+
+    def _close_at_exit(self):
+        # Bounded so a dead database can't hang interpreter shutdown; anything
+        # still unwritten stays in the journal for the next start.
+        self.close(self.shutdown_timeout)
+
+    # --- writer side ---------------------------------------------------
+
+    def _run(self):
+        attempts = 0
+        while True:
+            with self._cond:
+                if not self._queue and not self._closed:
+                    self._cond.wait(self.flush_interval)
+                if not self._queue:
+                    if self._closed:
+                        return
+                    continue
+                if len(self._queue) < self.batch_size and not self._closed:
+                    # Give a burst a moment to accumulate into one batch
+                    self._cond.wait(self.flush_interval)
+                batch = [
+                    self._queue[i] for i in range(min(self.batch_size, len(self._queue)))
+                ]
+
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                attempts += 1
+                with self._cond:
+                    self.last_error = e
+                    self.stats["failures"] += 1
+                if attempts < self.max_attempts:
+                    time.sleep(self.retry_interval)
+                    continue
+                failed = self._write_singly(batch)
+            else:
+                failed = []
+            attempts = 0
+
+            with self._cond:
+                for _ in batch:
+                    self._queue.popleft()
+                self._written += len(batch)
+                self.stats["written"] += len(batch) - len(failed)
+                self.stats["batches"] += 1
+                if not failed:
+                    self.last_error = None
+                if not self._queue and self._journal is not None:
+                    # Everything acknowledged is now in the database
+                    self._journal.truncate(0)
+                    self._journal.seek(0)
+                self._cond.notify_all()
+
+    def _write_singly(self, batch):
+        """Write a repeatedly failing batch one record at a time; dead-letter the failures."""
+        failed = []
+        for record in batch:
+            try:
+                self._write_batch([record])
+            except Exception as e:
+                with self._cond:
+                    self.last_error = e
+                failed.append(record)
+        if failed:
+            with self._cond:
+                self._dead_letter(failed)
+        return failed
+
+    def _dead_letter(self, records):
+        """Called with the lock held."""
+        self.stats["dead_lettered"] += len(records)
+        if self.dead_letter_path is None:
+            self.dead_letters.extend(records)
+            return
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, default=_json_default) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding="utf-8") as f:
+            records = []
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(_decode_record(json.loads(line)))
+                except ValueError:
+                    # Torn final line from a crash mid-write: it was never acknowledged
+                    break
+        for i in range(0, len(records), self.batch_size):
+            self._write_batch(records[i : i + self.batch_size])
+        os.truncate(self.journal_path, 0)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot journal value of type {type(value).__name__}")
+
+
+def _decode_record(record):
+    for key, value in record.items():
+        if isinstance(value, dict) and "__datetime__" in value:
+            record[key] = datetime.fromisoformat(value["__datetime__"])
+    return record
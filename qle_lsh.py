@@ -0,0 +1,192 @@
+# qle_lsh.py
+"""
+MinHash signatures and a banded LSH index over SQL statements.
+
+A statement is reduced to the set of its k-token shingles (identifiers
+folded, literals replaced by ?), and that set to a MinHash signature whose
+agreement rate with another signature estimates their Jaccard similarity.
+The index cuts signatures into bands and hashes each band to a bucket, so
+a lookup only compares against statements sharing at least one bucket
+instead of against every indexed statement.
+"""
+import collections
+import threading
+import zlib
+
+import numpy as np
+
+from qle_sql import tokenize
+
+DEFAULT_NUM_PERM = 128
+DEFAULT_SHINGLE_SIZE = 3
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def shingles(sql_text, k=DEFAULT_SHINGLE_SIZE):
+    """32-bit hashes of the statement's k-token shingles."""
+    words = []
+    for tok in tokenize(sql_text):
+        if tok.kind in ("string", "number", "param"):
+            words.append("?")
+        elif tok.kind == "ident":
+            words.append(tok.value.lower())
+        elif tok.value != ";":
+            words.append(tok.value)
+    if len(words) <= k:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {
+        zlib.crc32(" ".join(words[i : i + k]).encode("utf-8"))
+        for i in range(len(words) - k + 1)
+    }
+
+
+class MinHasher:
+    """num_perm universal hash functions; signature() of a shingle set."""
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, seed=1):
+        self.num_perm = num_perm
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 61, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 61, size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes):
+        hv = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+        if not len(hv):
+            return np.full(self.num_perm, _MAX_HASH, dtype=np.uint32)
+        # uint64 products wrap around; the family stays universal enough
+        with np.errstate(over="ignore"):
+            phv = (np.outer(hv, self._a) + self._b) % _MERSENNE_PRIME & _MAX_HASH
+        return phv.min(axis=0).astype(np.uint32)
+
+    def signature_of(self, sql_text, k=DEFAULT_SHINGLE_SIZE):
+        return self.signature(shingles(sql_text, k))
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.count_nonzero(sig_a == sig_b)) / len(sig_a)
+
+
+def choose_bands(threshold, num_perm):
+    """
+    (bands, rows) with bands * rows <= num_perm whose S-curve midpoint,
+    (1 / bands) ** (1 / rows), is closest to threshold.
+    """
+    best = None
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        midpoint = (1.0 / bands) ** (1.0 / rows)
+        error = abs(midpoint - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class LSHIndex:
+    """
+    Signatures keyed by id, at most `max_entries` (the oldest added are
+    evicted first). similar() returns the ids whose estimated similarity
+    to a signature is at least `threshold`, checking only band-bucket
+    collisions.
+    """
+
+    def __init__(self, threshold=0.7, num_perm=DEFAULT_NUM_PERM, max_entries=100_000):
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError("threshold must be in (0, 1]")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.max_entries = max_entries
+        self.bands, self.rows = choose_bands(threshold, num_perm)
+        self._lock = threading.Lock()
+        self._buckets = [collections.defaultdict(set) for _ in range(self.bands)]
+        self._signatures = collections.OrderedDict()  # id -> signature, oldest first
+        self.stats = {"lookups": 0, "candidates": 0, "evictions": 0}
+
+    def _band_keys(self, sig):
+        r = self.rows
+        return [sig[i * r : (i + 1) * r].tobytes() for i in range(self.bands)]
+
+    def add(self, key, sig):
+        with self._lock:
+            if key in self._signatures:
+                self._remove_locked(key)
+            self._signatures[key] = sig
+            for bucket, band in zip(self._buckets, self._band_keys(sig)):
+                bucket[band].add(key)
+            while len(self._signatures) > self.max_entries:
+                self._remove_locked(next(iter(self._signatures)))
+                self.stats["evictions"] += 1
+
+    def remove(self, key):
+        with self._lock:
+            if key in self._signatures:
+                self._remove_locked(key)
+
+    def _remove_locked(self, key):
+        sig = self._signatures.pop(key)
+        for bucket, band in zip(self._buckets, self._band_keys(sig)):
+            members = bucket.get(band)
+            if members is not None:
+                members.discard(key)
+                if not members:
+                    del bucket[band]
+
+    def similar(self, sig, limit=None, accept=None):
+        """
+        [(id, similarity)] with similarity >= threshold, best first.
+        accept(id) can veto candidates (e.g. ids that can't be parents).
+        """
+        with self._lock:
+            candidates = set()
+            for bucket, band in zip(self._buckets, self._band_keys(sig)):
+                members = bucket.get(band)
+                if members:
+                    candidates |= members
+            self.stats["lookups"] += 1
+            self.stats["candidates"] += len(candidates)
+            scored = []
+            for key in candidates:
+                if accept is not None and not accept(key):
+                    continue
+                score = similarity(sig, self._signatures[key])
+                if score >= self.threshold:
+                    scored.append((key, score))
+        # Most similar first; the most recent of equally similar ones
+        scored.sort(key=lambda kv: (-kv[1], -kv[0]))
+        return scored[:limit] if limit is not None else scored
+
+    def signature(self, key):
+        """The indexed signature of key, or None."""
+        with self._lock:
+            return self._signatures.get(key)
+
+    def keys(self):
+        """Indexed ids, oldest first."""
+        with self._lock:
+            return list(self._signatures)
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def __contains__(self, key):
+        return key in self._signatures
+
+    def clear(self):
+        with self._lock:
+            for bucket in self._buckets:
+                bucket.clear()
+            self._signatures.clear()
+
+    def info(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                entries=len(self._signatures),
+                max_entries=self.max_entries,
+                threshold=self.threshold,
+                num_perm=self.num_perm,
+                bands=self.bands,
+                rows=self.rows,
+            )
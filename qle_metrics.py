@@ -0,0 +1,246 @@
+# qle_metrics.py
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+_local = threading.local()
+
+
+class PhaseTimer:
+    """Nanosecond (perf_counter_ns) durations of the named phases of one operation."""
+
+    __slots__ = ("phases_ns", "_start")
+
+    def __init__(self):
+        self.phases_ns = {}
+        self._start = time.perf_counter_ns()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter_ns() - start)
+
+    def add(self, name, ns):
+        self.phases_ns[name] = self.phases_ns.get(name, 0) + ns
+
+    def elapsed_ns(self):
+        return time.perf_counter_ns() - self._start
+
+    def as_us(self):
+        return {name: ns // 1000 for name, ns in self.phases_ns.items()}
+
+
+def current_timer():
+    """The PhaseTimer of the timed() call running on this thread, if any."""
+    return getattr(_local, "timer", None)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    parts = []
+    for name, value in key:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class MetricsRegistry:
+    """
+    Counters and fixed-bucket histograms keyed by name + labels, plus
+    collectors that report gauges (pool sizes, queue depths, ...) on demand.
+    Renders as Prometheus text exposition format or as a JSON-able dict.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}  # name -> {label key: value}
+        self._histograms = {}  # name -> {label key: [bucket counts..., +Inf, sum]}
+        self._collectors = []
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[i] += 1
+                    break
+            else:
+                h[len(self.buckets)] += 1
+            h[-1] += seconds
+
+    def observe_phases(self, name, timer, **labels):
+        for phase, ns in timer.phases_ns.items():
+            self.observe(name, ns / 1e9, phase=phase, **labels)
+
+    def add_collector(self, collect):
+        """collect() -> iterable of (name, labels dict, value) gauge samples."""
+        self._collectors.append(collect)
+
+    def _gauges(self):
+        gauges = {}
+        for collect in list(self._collectors):
+            try:
+                samples = list(collect())
+            except Exception:
+                # A failing collector must not break the whole scrape
+                continue
+            for name, labels, value in samples:
+                gauges.setdefault(name, {})[_label_key(labels)] = value
+        return gauges
+
+    def snapshot(self):
+        """JSON-able view: counters, histograms (count/sum/cumulative buckets) and gauges."""
+        with self._lock:
+            counters = {n: dict(s) for n, s in self._counters.items()}
+            histograms = {
+                n: {k: list(h) for k, h in s.items()} for n, s in self._histograms.items()
+            }
+        out = {"counters": {}, "histograms": {}, "gauges": {}}
+        for name, series in counters.items():
+            out["counters"][name] = [
+                {"labels": dict(key), "value": value} for key, value in series.items()
+            ]
+        for name, series in histograms.items():
+            out["histograms"][name] = [
+                dict(self._histogram_summary(h), labels=dict(key))
+                for key, h in series.items()
+            ]
+        for name, series in self._gauges().items():
+            out["gauges"][name] = [
+                {"labels": dict(key), "value": value} for key, value in series.items()
+            ]
+        return out
+
+    def _histogram_summary(self, h):
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), h[:-1]):
+            running += count
+            cumulative.append([bound if bound != float("inf") else "+Inf", running])
+        return {"count": running, "sum": h[-1], "buckets": cumulative}
+
+    def render_prometheus(self):
+        snap = self.snapshot()
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, series in sorted(snap["counters"].items()):
+            header(name, "counter")
+            for s in series:
+                lines.append(f"{name}{_format_labels(_label_key(s['labels']))} {s['value']}")
+        for name, series in sorted(snap["histograms"].items()):
+            header(name, "histogram")
+            for s in series:
+                key = _label_key(s["labels"])
+                for bound, count in s["buckets"]:
+                    le = bound if bound == "+Inf" else repr(float(bound))
+                    lines.append(
+                        f"{name}_bucket{_format_labels(key + (('le', le),))} {count}"
+                    )
+                lines.append(f"{name}_sum{_format_labels(key)} {s['sum']}")
+                lines.append(f"{name}_count{_format_labels(key)} {s['count']}")
+        for name, series in sorted(snap["gauges"].items()):
+            header(name, "gauge")
+            for s in series:
+                lines.append(f"{name}{_format_labels(_label_key(s['labels']))} {s['value']}")
+        return "\n".join(lines) + "\n"
+
+    def timed(self, name, **labels):
+        """
+        Decorator: time each call with a PhaseTimer installed for the calling
+        thread (so helpers can add phases via current_timer()) and record
+        every phase, plus "total", in histogram `name`. Time not claimed by a
+        phase is recorded as "serialize" (building the returned objects).
+        Nested timed calls are accounted to the outermost one.
+        """
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if current_timer() is not None:
+                    return fn(*args, **kwargs)
+                timer = PhaseTimer()
+                _local.timer = timer
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    _local.timer = None
+                    total = timer.elapsed_ns()
+                    timer.add("serialize", max(0, total - sum(timer.phases_ns.values())))
+                    timer.add("total", total)
+                    self.observe_phases(name, timer, **labels)
+
+            return wrapper
+
+        return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path in ("/", "/metrics"):
+            body = self.registry.render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body = json.dumps(self.registry.snapshot(), default=str).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(registry, host="127.0.0.1", port=9464):
+    """Serve /metrics (Prometheus text) and /metrics.json on a daemon thread; returns the server."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="qle-metrics-http", daemon=True
+    ).start()
+    return server
@@ -0,0 +1,169 @@
+# qle_plans.py
+"""
+Helpers for EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) output: per-plan
+summaries and parent/child plan diffs. Plans are the JSON documents Postgres
+returns, i.e. a list holding one {"Plan": ..., "Planning Time": ...} object.
+"""
+
+# How many worst row estimates to report per plan
+TOP_ESTIMATE_ERRORS = 5
+
+
+def _root(plan_doc):
+    if isinstance(plan_doc, list):
+        plan_doc = plan_doc[0]
+    return plan_doc
+
+
+def walk(plan_doc):
+    """Yield (path, node) for every plan node, depth first; path is a tuple of child indexes."""
+    stack = [((), _root(plan_doc)["Plan"])]
+    while stack:
+        path, node = stack.pop()
+        yield path, node
+        children = node.get("Plans", [])
+        for i in range(len(children) - 1, -1, -1):
+            stack.append((path + (i,), children[i]))
+
+
+def node_label(node):
+    """Node type plus the relation / index it works on, e.g. "Index Scan on title (title_pkey)"."""
+    label = node["Node Type"]
+    if node.get("Relation Name"):
+        label += f" on {node['Relation Name']}"
+    if node.get("Index Name"):
+        label += f" ({node['Index Name']})"
+    return label
+
+
+def _actual_rows(node):
+    # "Actual Rows" is per loop
+    return node.get("Actual Rows", 0) * max(node.get("Actual Loops", 1), 1)
+
+
+def _estimated_rows(node):
+    return node.get("Plan Rows", 0) * max(node.get("Actual Loops", 1), 1)
+
+
+def estimate_error(node):
+    """q-error of the row estimate: max(est/actual, actual/est), both floored at 1 row."""
+    est = max(_estimated_rows(node), 1)
+    act = max(_actual_rows(node), 1)
+    return max(est / act, act / est)
+
+
+def summarize(plan_doc):
+    """Timing, cost, buffer totals, node type counts and worst row estimates of one plan."""
+    doc = _root(plan_doc)
+    top = doc["Plan"]
+    node_types = {}
+    access_paths = {}
+    errors = []
+    for path, node in walk(plan_doc):
+        node_types[node["Node Type"]] = node_types.get(node["Node Type"], 0) + 1
+        if node.get("Relation Name"):
+            access_paths.setdefault(node["Relation Name"], []).append(node["Node Type"])
+        if "Actual Rows" in node:
+            errors.append(
+                {
+                    "path": list(path),
+                    "node": node_label(node),
+                    "estimated_rows": _estimated_rows(node),
+                    "actual_rows": _actual_rows(node),
+                    "q_error": round(estimate_error(node), 2),
+                }
+            )
+    errors.sort(key=lambda e: e["q_error"], reverse=True)
+    return {
+        "planning_ms": doc.get("Planning Time"),
+        "execution_ms": doc.get("Execution Time"),
+        "total_cost": top.get("Total Cost"),
+        # Buffer counters of the top node include everything below it
+        "shared_hit_blocks": top.get("Shared Hit Blocks", 0),
+        "shared_read_blocks": top.get("Shared Read Blocks", 0),
+        "temp_written_blocks": top.get("Temp Written Blocks", 0),
+        "node_types": node_types,
+        "access_paths": {rel: sorted(types) for rel, types in access_paths.items()},
+        "worst_estimates": errors[:TOP_ESTIMATE_ERRORS],
+    }
+
+
+def _aligned_changes(parent_node, child_node, path, changes):
+    """Walk both trees in lockstep, recording positions whose node differs."""
+    if node_label(parent_node) != node_label(child_node):
+        changes.append(
+            {
+                "path": list(path),
+                "parent": node_label(parent_node),
+                "child": node_label(child_node),
+            }
+        )
+    p_children = parent_node.get("Plans", [])
+    c_children = child_node.get("Plans", [])
+    for i, (p, c) in enumerate(zip(p_children, c_children)):
+        _aligned_changes(p, c, path + (i,), changes)
+    # Subtrees only one side has
+    for i in range(len(p_children), len(c_children)):
+        changes.append(
+            {"path": list(path + (i,)), "parent": None, "child": node_label(c_children[i])}
+        )
+    for i in range(len(c_children), len(p_children)):
+        changes.append(
+            {"path": list(path + (i,)), "parent": node_label(p_children[i]), "child": None}
+        )
+
+
+def _ratio(new, old):
+    if not old:
+        return None
+    return round(new / old, 2)
+
+
+def diff(parent_doc, child_doc):
+    """
+    Compare a parent's plan with its child's.
+
+    Returns a dict with both summaries plus:
+      node_types:    per node type, count in parent / child where they differ
+      access_paths:  relations scanned differently (e.g. Index Scan -> Seq Scan)
+      changed_nodes: positions in the two trees whose node type/relation differ
+      buffers:       shared hit/read blocks for both and their deltas
+      slowdown:      child execution time / parent execution time
+    """
+    parent = summarize(parent_doc)
+    child = summarize(child_doc)
+
+    node_types = {}
+    for t in set(parent["node_types"]) | set(child["node_types"]):
+        p = parent["node_types"].get(t, 0)
+        c = child["node_types"].get(t, 0)
+        if p != c:
+            node_types[t] = {"parent": p, "child": c}
+
+    access_paths = []
+    for rel in sorted(set(parent["access_paths"]) | set(child["access_paths"])):
+        p = parent["access_paths"].get(rel, [])
+        c = child["access_paths"].get(rel, [])
+        if p != c:
+            access_paths.append({"relation": rel, "parent": p, "child": c})
+
+    changes = []
+    _aligned_changes(_root(parent_doc)["Plan"], _root(child_doc)["Plan"], (), changes)
+
+    buffers = {}
+    for key in ("shared_hit_blocks", "shared_read_blocks", "temp_written_blocks"):
+        buffers[key] = {
+            "parent": parent[key],
+            "child": child[key],
+            "delta": child[key] - parent[key],
+        }
+
+    return {
+        "parent": parent,
+        "child": child,
+        "slowdown": _ratio(child["execution_ms"] or 0, parent["execution_ms"]),
+        "node_types": node_types,
+        "access_paths": access_paths,
+        "changed_nodes": changes,
+        "buffers": buffers,
+    }
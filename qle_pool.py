@@ -0,0 +1,219 @@
+# qle_pool.py
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe psycopg2 connection pool.
+
+    Unlike psycopg2.pool.ThreadedConnectionPool, a checkout blocks (up to
+    `timeout` seconds) when all `maxconn` connections are in use instead of
+    failing immediately, and idle connections are health-checked before
+    being handed out again.
+    """
+
+    def __init__(
+        self,
+        dsn,
+        minconn=1,
+        maxconn=5,
+        name="pool",
+        timeout=30.0,
+        health_check_after=30.0,
+        reset_sql=None,
+    ):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: need 0 <= minconn <= maxconn, maxconn >= 1")
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.name = name
+        self.timeout = timeout
+        # Idle connections older than this (seconds) get a SELECT 1 before reuse
+        self.health_check_after = health_check_after
+        # Optional statement run on check-in, e.g. "DISCARD ALL" for user sessions
+        self.reset_sql = reset_sql
+
+        self._cond = threading.Condition()
+        self._idle = []  # list of (conn, last_used_monotonic)
+        self._size = 0  # open connections, idle + checked out
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "timeouts": 0,
+            "connects": 0,
+            "discarded": 0,
+            "health_checks": 0,
+            "health_failures": 0,
+        }
+
+        for _ in range(minconn):
+            conn = self._connect()
+            self._idle.append((conn, time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        with self._cond:
+            self._stats["connects"] += 1
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_after:
+            return True
+        with self._cond:
+            self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            with self._cond:
+                self._stats["health_failures"] += 1
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _drop(self, conn):
+        self._close_quietly(conn)
+        with self._cond:
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def getconn(self):
+        """Check out a connection, waiting for one to be returned if the pool is full."""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        conn = None
+        last_used = None
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError(f"Pool '{self.name}' is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    # Reserve a slot, connect outside the lock
+                    self._size += 1
+                    break
+                waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"No connection available in pool '{self.name}' "
+                        f"after {self.timeout:.1f}s"
+                    )
+                self._cond.wait(remaining)
+
+            self._stats["checkouts"] += 1
+            if waited:
+                wait_ms = (time.monotonic() - start) * 1000.0
+                self._stats["waits"] += 1
+                self._stats["wait_time_ms"] += wait_ms
+                self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+
+        if conn is not None and not self._is_healthy(conn, last_used):
+            # Keep the slot and replace the dead connection with a fresh one
+            self._close_quietly(conn)
+            with self._cond:
+                self._stats["discarded"] += 1
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, resetting its session state."""
+        if not discard and not conn.closed:
+            try:
+                if conn.autocommit:
+                    conn.autocommit = False
+                if (
+                    conn.info.transaction_status
+                    != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                ):
+                    conn.rollback()
+                if self.reset_sql:
+                    conn.autocommit = True
+                    with conn.cursor() as cur:
+                        cur.execute(self.reset_sql)
+                    conn.autocommit = False
+            except psycopg2.Error:
+                discard = True
+
+        if discard or conn.closed:
+            self._drop(conn)
+            return
+
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                conn.close()
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager: check out a connection and always return it."""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, discard=broken)
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s["size"] = self._size
+            s["idle"] = len(self._idle)
+            s["in_use"] = self._size - len(self._idle)
+            s["minconn"] = self.minconn
+            s["maxconn"] = self.maxconn
+        s["avg_wait_ms"] = s["wait_time_ms"] / s["waits"] if s["waits"] else 0.0
+        return s
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
@@ -0,0 +1,123 @@
+# qle_refresh.py
+import threading
+import time
+
+
+class RefreshScheduler:
+    """
+    Background refresher for pinned materialized views.
+
+    Every `interval` seconds a poller thread asks `find_stale()` for the ids
+    of views whose source tables changed (most urgent first) and hands them
+    to at most `max_concurrent` worker threads, each calling `refresh(id)`.
+    A view is never refreshed twice at the same time, and a tick is skipped
+    while `busy()` returns True (e.g. every interactive connection is in
+    use), so refreshes yield to the analyst's own queries.
+    """
+
+    def __init__(self, find_stale, refresh, interval=30.0, max_concurrent=1, busy=None):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be >= 1")
+        self._find_stale = find_stale
+        self._refresh = refresh
+        self._busy = busy
+        self.interval = interval
+        self.max_concurrent = max_concurrent
+
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._in_flight = set()
+        self._workers = set()
+        self._closed = False
+        self._wake = False
+        self.last_error = None
+        self.stats = {
+            "ticks": 0,
+            "skipped_busy": 0,
+            "refreshed": 0,
+            "failures": 0,
+            "total_refresh_ms": 0.0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name="qle-refresh", daemon=True)
+        self._thread.start()
+
+    def trigger(self):
+        """Check for stale views now instead of waiting for the next tick."""
+        with self._cond:
+            self._wake = True
+            self._cond.notify_all()
+
+    def in_flight(self):
+        with self._cond:
+            return sorted(self._in_flight)
+
+    def close(self, timeout=None):
+        """Stop polling and wait for running refreshes to finish."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        for worker in list(self._workers):
+            worker.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._wake and not self._closed:
+                    self._cond.wait(self.interval)
+                if self._closed:
+                    return
+                self._wake = False
+                self.stats["ticks"] += 1
+
+            try:
+                if self._busy is not None and self._busy():
+                    with self._cond:
+                        self.stats["skipped_busy"] += 1
+                    continue
+                stale = self._find_stale()
+            except Exception as e:
+                with self._cond:
+                    self.last_error = e
+                    self.stats["failures"] += 1
+                continue
+
+            for view_id in stale:
+                with self._cond:
+                    if self._closed:
+                        return
+                    if view_id in self._in_flight:
+                        continue
+                # Wait for a free slot; remaining ids are reconsidered next tick
+                # if they are still stale by then
+                if not self._slots.acquire(timeout=self.interval):
+                    break
+                with self._cond:
+                    self._in_flight.add(view_id)
+                    worker = threading.Thread(
+                        target=self._work,
+                        args=(view_id,),
+                        name=f"qle-refresh-{view_id}",
+                        daemon=True,
+                    )
+                    self._workers.add(worker)
+                worker.start()
+
+    def _work(self, view_id):
+        start = time.perf_counter()
+        try:
+            self._refresh(view_id)
+        except Exception as e:
+            with self._cond:
+                self.last_error = e
+                self.stats["failures"] += 1
+        else:
+            with self._cond:
+                self.stats["refreshed"] += 1
+                self.stats["total_refresh_ms"] += (time.perf_counter() - start) * 1000
+        finally:
+            with self._cond:
+                self._in_flight.discard(view_id)
+                self._workers.discard(threading.current_thread())
+            self._slots.release()
@@ -0,0 +1,391 @@
+# qle_snapshots.py
+"""
+On-disk result snapshots, one directory per query_id.
+
+Every column is written as flat binary files (values, optional NULL mask;
+other values as encoded bytes plus int64 offsets), so reading a page back
+is a memory-mapped slice and only the pages looked at are ever paged in.
+The store keeps total size under a quota by evicting the least recently
+read snapshots.
+"""
+import collections
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+from qle_columnar import ColumnarResult
+
+_META = "meta.json"
+
+# Python types of object columns that can be snapshotted, as (type, tag),
+# checked in order (bool is an int, datetime a date); the tag is kept in
+# the meta file so the reader gives back values of the same type
+_OBJECT_TAGS = [
+    (str, "text"),
+    ((bytes, bytearray, memoryview), "bytes"),
+    ((dict, list), "json"),
+    (Decimal, "decimal"),
+    (bool, "bool"),
+    (int, "int"),
+    (float, "float"),
+    (datetime, "datetime"),
+    (date, "date"),
+    (dt_time, "time"),
+    (timedelta, "interval"),
+    (uuid.UUID, "uuid"),
+]
+
+_ENCODERS = {
+    "text": lambda v: v.encode("utf-8"),
+    "bytes": bytes,
+    "json": lambda v: json.dumps(v, separators=(",", ":")).encode("utf-8"),
+    "bool": lambda v: b"t" if v else b"f",
+    "float": lambda v: repr(v).encode("ascii"),
+    "datetime": lambda v: v.isoformat().encode("ascii"),
+    "date": lambda v: v.isoformat().encode("ascii"),
+    "time": lambda v: v.isoformat().encode("ascii"),
+    # Whole microseconds: exact, unlike str(timedelta)
+    "interval": lambda v: str(v // timedelta(microseconds=1)).encode("ascii"),
+}
+
+_DECODERS = {
+    "text": lambda b: b.decode("utf-8"),
+    "bytes": bytes,
+    "json": lambda b: json.loads(b.decode("utf-8")),
+    "decimal": lambda b: Decimal(b.decode("ascii")),
+    "bool": lambda b: b == b"t",
+    "int": int,
+    "float": float,
+    "datetime": lambda b: datetime.fromisoformat(b.decode("ascii")),
+    "date": lambda b: date.fromisoformat(b.decode("ascii")),
+    "time": lambda b: dt_time.fromisoformat(b.decode("ascii")),
+    "interval": lambda b: timedelta(microseconds=int(b)),
+    "uuid": lambda b: uuid.UUID(b.decode("ascii")),
+}
+
+
+def _tag_of(value):
+    for types, tag in _OBJECT_TAGS:
+        if isinstance(value, types):
+            return tag
+    return None
+
+
+def _encode(tag, value):
+    encode = _ENCODERS.get(tag)
+    return encode(value) if encode is not None else str(value).encode("ascii")
+
+
+class _ColumnWriter:
+    """Appends batches of one column to its files."""
+
+    def __init__(self, path, kind, dtype):
+        self.kind = kind
+        self.dtype = dtype
+        self.rows = 0
+        self.has_nulls = False
+        self._values = open(path + ".bin", "wb")
+        self._mask = open(path + ".mask", "wb")
+        self._offsets = None
+        self.tag = None  # object columns: what their values are, from the first one
+        if kind == "object":
+            # Everything that isn't a native array type is kept as encoded bytes
+            self._offsets = open(path + ".offsets", "wb")
+            self._offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+            self._end = 0
+
+    def append(self, array, mask):
+        n = len(array)
+        if mask is None:
+            mask = np.zeros(n, dtype=np.bool_)
+        else:
+            self.has_nulls = self.has_nulls or bool(mask.any())
+        if self._offsets is not None:
+            encoded = [b"" if m else self._encode(v) for v, m in zip(array, mask)]
+            lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=n)
+            offsets = self._end + np.cumsum(lengths)
+            if n:
+                self._end = int(offsets[-1])
+            self._offsets.write(offsets.tobytes())
+            self._values.write(b"".join(encoded))
+        else:
+            self._values.write(np.ascontiguousarray(array, dtype=self.dtype).tobytes())
+        self._mask.write(mask.astype(np.bool_).tobytes())
+        self.rows += n
+
+    def _encode(self, value):
+        tag = _tag_of(value)
+        if self.tag is None:
+            self.tag = tag
+        if tag is None or tag != self.tag:
+            raise _Unsupported(type(value).__name__)
+        try:
+            return _encode(tag, value)
+        except (TypeError, ValueError):
+            # e.g. a json-like list holding values json can't represent
+            raise _Unsupported(type(value).__name__)
+
+    def close(self):
+        for f in (self._values, self._mask, self._offsets):
+            if f is not None:
+                f.close()
+
+
+class SnapshotReader:
+    """Memory-mapped view of one snapshot; page(n) decodes only rows of page n."""
+
+    def __init__(self, path, meta, page_size):
+        self.path = path
+        self.query_id = meta["query_id"]
+        self.cols = meta["cols"]
+        self.kinds = meta["kinds"]
+        # Snapshots from before tags were recorded hold text only
+        self.tags = meta.get("tags") or [None] * len(self.cols)
+        self.row_count = meta["row_count"]
+        self.created_at = meta["created_at"]
+        self.nbytes = meta["nbytes"]
+        self.page_size = page_size
+        self._columns = [
+            self._map_column(j, kind, dtype, has_nulls) + (_DECODERS[tag or "text"],)
+            for j, (kind, dtype, has_nulls, tag) in enumerate(
+                zip(self.kinds, meta["dtypes"], meta["has_nulls"], self.tags)
+            )
+        ]
+
+    def _map(self, name, dtype, count):
+        if count == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=(count,))
+
+    def _map_column(self, j, kind, dtype, has_nulls):
+        mask = self._map(f"c{j}.mask", np.bool_, self.row_count) if has_nulls else None
+        if kind == "object":
+            offsets = self._map(f"c{j}.offsets", np.int64, self.row_count + 1)
+            size = int(offsets[-1]) if self.row_count else 0
+            return (self._map(f"c{j}.bin", np.uint8, size), offsets, mask)
+        return (self._map(f"c{j}.bin", dtype, self.row_count), None, mask)
+
+    def num_pages(self):
+        return max(1, -(-self.row_count // self.page_size))
+
+    def rows(self, start, stop):
+        """Rows [start, stop) as a ColumnarResult."""
+        stop = min(stop, self.row_count)
+        start = min(start, stop)
+        arrays, masks = [], []
+        for values, offsets, mask, decode in self._columns:
+            m = mask[start:stop] if mask is not None else None
+            if offsets is not None:
+                out = np.empty(stop - start, dtype=object)
+                for i in range(start, stop):
+                    if m is not None and m[i - start]:
+                        out[i - start] = None
+                    else:
+                        out[i - start] = decode(bytes(values[offsets[i] : offsets[i + 1]]))
+                arrays.append(out)
+                masks.append(None)
+            else:
+                arrays.append(values[start:stop])
+                masks.append(m)
+        return ColumnarResult(self.cols, self.kinds, arrays, masks)
+
+    def page(self, n):
+        return self.rows(n * self.page_size, (n + 1) * self.page_size)
+
+
+class SnapshotStore:
+    """
+    Result snapshots under `root`, at most `max_bytes` in total.
+
+    write() streams batches to a temporary directory and renames it into
+    place, so readers never see a partial snapshot. Recency survives
+    restarts through the mtime of each snapshot's meta file.
+    """
+
+    def __init__(self, root, max_bytes=1 << 30, max_rows=1_000_000, page_size=50):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # query_id -> bytes, least recent first
+        self._tmp_ids = iter(range(1, 1 << 62))
+        self.stats = {"writes": 0, "reads": 0, "evictions": 0, "skipped": 0}
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def _dir(self, query_id):
+        return os.path.join(self.root, f"q{query_id}")
+
+    def _scan(self):
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(".tmp-"):
+                # Left behind by a write that never finished
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            meta_path = os.path.join(path, _META)
+            if not (name.startswith("q") and name[1:].isdigit() and os.path.exists(meta_path)):
+                continue
+            found.append((os.path.getmtime(meta_path), int(name[1:]), _dir_bytes(path)))
+        for _, query_id, size in sorted(found):
+            self._entries[query_id] = size
+
+    def write(self, query_id, batches, expected_rows=None, expected_bytes=None):
+        """
+        Write an iterable of ColumnarResult batches as query_id's snapshot.
+        Returns its size in bytes, or None if it had more than max_rows rows,
+        can never fit the quota or holds values of a type that can't be
+        written back faithfully (nothing is kept then). With an estimate
+        (expected_rows / expected_bytes) over those limits, batches isn't
+        read at all; otherwise reading stops at the first batch over max_rows.
+        """
+        if (expected_rows is not None and expected_rows > self.max_rows) or (
+            expected_bytes is not None and expected_bytes > self.max_bytes
+        ):
+            with self._lock:
+                self.stats["skipped"] += 1
+            return None
+        tmp = os.path.join(self.root, f".tmp-{os.getpid()}-{next(self._tmp_ids)}")
+        os.makedirs(tmp)
+        writers = None
+        meta = {"query_id": query_id, "row_count": 0}
+        try:
+            for batch in batches:
+                if meta["row_count"] + len(batch) > self.max_rows:
+                    raise _TooLarge()
+                if writers is None:
+                    meta["cols"] = list(batch.cols)
+                    meta["kinds"] = list(batch.kinds)
+                    writers = [
+                        _ColumnWriter(os.path.join(tmp, f"c{j}"), kind, array.dtype)
+                        for j, (_, kind, array, _) in enumerate(batch.parts())
+                    ]
+                for w, (_, _, array, mask) in zip(writers, batch.parts()):
+                    w.append(array, mask)
+                meta["row_count"] += len(batch)
+        except (_TooLarge, _Unsupported):
+            self._discard(tmp, writers)
+            with self._lock:
+                self.stats["skipped"] += 1
+            return None
+        except BaseException:
+            self._discard(tmp, writers)
+            raise
+        if writers is None:
+            # No batches at all: nothing to show later either
+            self._discard(tmp, writers)
+            return None
+        for w in writers:
+            w.close()
+        meta["dtypes"] = [w.dtype.str if w.kind != "object" else "|O" for w in writers]
+        meta["has_nulls"] = [w.has_nulls for w in writers]
+        meta["tags"] = [w.tag for w in writers]
+        for j, w in enumerate(writers):
+            if not w.has_nulls:
+                os.remove(os.path.join(tmp, f"c{j}.mask"))
+        meta["created_at"] = time.time()
+        meta["nbytes"] = _dir_bytes(tmp)
+        with open(os.path.join(tmp, _META), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        size = _dir_bytes(tmp)
+        if size > self.max_bytes:
+            shutil.rmtree(tmp, ignore_errors=True)
+            with self._lock:
+                self.stats["skipped"] += 1
+            return None
+
+        with self._lock:
+            target = self._dir(query_id)
+            if query_id in self._entries:
+                shutil.rmtree(target, ignore_errors=True)
+                del self._entries[query_id]
+            os.replace(tmp, target)
+            self._entries[query_id] = size
+            self.stats["writes"] += 1
+            self._enforce_quota(protect=query_id)
+        return size
+
+    def _discard(self, tmp, writers):
+        for w in writers or ():
+            w.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def open(self, query_id):
+        """SnapshotReader for query_id, or None if there is no snapshot."""
+        with self._lock:
+            if query_id not in self._entries:
+                return None
+            self._entries.move_to_end(query_id)
+            path = self._dir(query_id)
+            meta_path = os.path.join(path, _META)
+            try:
+                os.utime(meta_path)
+                with open(meta_path, encoding="utf-8") as f:
+                    meta = json.load(f)
+            except OSError:
+                del self._entries[query_id]
+                return None
+            self.stats["reads"] += 1
+        return SnapshotReader(path, meta, self.page_size)
+
+    def __contains__(self, query_id):
+        with self._lock:
+            return query_id in self._entries
+
+    def delete(self, query_ids):
+        with self._lock:
+            for query_id in query_ids:
+                if self._entries.pop(query_id, None) is not None:
+                    shutil.rmtree(self._dir(query_id), ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            for query_id in list(self._entries):
+                shutil.rmtree(self._dir(query_id), ignore_errors=True)
+            self._entries.clear()
+
+    def _enforce_quota(self, protect=None):
+        used = sum(self._entries.values())
+        for query_id in list(self._entries):
+            if used <= self.max_bytes:
+                break
+            if query_id == protect:
+                continue
+            used -= self._entries.pop(query_id)
+            shutil.rmtree(self._dir(query_id), ignore_errors=True)
+            self.stats["evictions"] += 1
+
+    def info(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                root=self.root,
+                snapshots=len(self._entries),
+                bytes=sum(self._entries.values()),
+                max_bytes=self.max_bytes,
+            )
+
+
+class _TooLarge(Exception):
+    pass
+
+
+class _Unsupported(Exception):
+    """An object column value _OBJECT_TAGS has no faithful encoding for."""
+
+
+def _dir_bytes(path):
+    return sum(
+        os.path.getsize(os.path.join(path, name))
+        for name in os.listdir(path)
+        if os.path.isfile(os.path.join(path, name))
+    )
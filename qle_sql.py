@@ -0,0 +1,417 @@
+# qle_sql.py
+import collections
+import hashlib
+import re
+import threading
+
+# Parsed statements kept in the LRU cache
+PARSE_CACHE_SIZE = 4096
+
+Token = collections.namedtuple("Token", "kind value start end")
+
+ParsedSQL = collections.namedtuple(
+    "ParsedSQL",
+    [
+        "tables",  # base tables referenced (CTE names excluded), sorted
+        "ctes",  # CTE names defined by the statement, sorted
+        "functions",  # function names called, sorted
+        "statement_type",  # main statement keyword: select, insert, update, ...
+        "fingerprint",  # normalized text with literals replaced by ?
+        "fingerprint_hash",
+        "normalized",  # normalized text with literals kept
+        "normalized_hash",
+        # (start, end, normalized_hash) of every parenthesized subquery / CTE
+        # body, as character offsets into the original text
+        "subqueries",
+    ],
+)
+
+_TOKEN_REGEX = re.compile(
+    r"""
+      (?P<ws>\s+)
+    | (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+    | (?P<string>[eEbBxXnN]?'(?:[^']|'')*(?:'|\Z))
+    | (?P<dollar>\$(?P<tag>[A-Za-z_][A-Za-z0-9_]*)?\$.*?(?:(?(tag)\$(?P=tag)\$|\$\$)|\Z))
+    | (?P<qident>"(?:[^"]|"")*(?:"|\Z))
+    | (?P<param>\$\d+|%\([^)]*\)s|%s)
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<ident>[A-Za-z_\u0080-\uffff][A-Za-z0-9_$\u0080-\uffff]*)
+    | (?P<op>::|<=|>=|<>|!=|\|\||->>|->|[(),;.\[\]])
+    | (?P<other>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# Keywords that end a FROM list / table position
+_CLAUSE_KEYWORDS = {
+    "where", "group", "order", "having", "limit", "offset", "window", "union",
+    "intersect", "except", "returning", "set", "values", "fetch", "for",
+    "select", "on", "using", "tablesample", "do", "default",
+}
+_JOIN_KEYWORDS = {"join"}
+# Words that may sit between FROM/JOIN and the table name
+_TABLE_PREFIX_KEYWORDS = {"only", "lateral"}
+_STATEMENT_KEYWORDS = {
+    "select", "insert", "update", "delete", "values", "table", "with", "create",
+    "alter", "drop", "truncate", "explain", "copy", "merge", "grant", "revoke",
+    "set", "show", "begin", "commit", "rollback", "vacuum", "analyze",
+}
+# Keywords that can precede "(" without being function calls
+_NOT_FUNCTIONS = {
+    "in", "exists", "any", "all", "some", "as", "over", "filter", "within",
+    "not", "and", "or", "on", "using", "values", "from", "select", "where",
+    "conflict", "distinct", "case", "when", "then", "else", "between", "like",
+    "ilike", "is", "by", "sets", "limit", "offset", "returning",
+}
+_SIMPLE_IDENT = re.compile(r"^[a-z_][a-z0-9_$]*$")
+
+
+def tokenize(sql_text: str):
+    """Split SQL into tokens, dropping whitespace and comments."""
+    tokens = []
+    for m in _TOKEN_REGEX.finditer(sql_text):
+        kind = m.lastgroup
+        if kind == "tag":
+            kind = "dollar"
+        if kind in ("ws", "comment"):
+            continue
+        if kind == "dollar":
+            kind = "string"
+        tokens.append(Token(kind, m.group(), m.start(), m.end()))
+    return tokens
+
+
+def _ident_name(tok):
+    """Canonical identifier text: unquoted folded to lower case, quoted kept as written."""
+    if tok.kind == "ident":
+        return tok.value.lower()
+    raw = tok.value[1:-1].replace('""', '"')
+    if _SIMPLE_IDENT.match(raw):
+        return raw
+    return '"' + raw.replace('"', '""') + '"'
+
+
+def _normalize(tokens, strip_literals):
+    parts = []
+    for tok in tokens:
+        if tok.kind in ("string", "number", "param"):
+            parts.append("?" if strip_literals else tok.value)
+        elif tok.kind == "ident":
+            parts.append(tok.value.lower())
+        else:
+            parts.append(tok.value)
+    while parts and parts[-1] == ";":
+        parts.pop()
+    return " ".join(parts)
+
+
+def _digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class _Frame:
+    """Parser state for one parenthesis level."""
+
+    __slots__ = (
+        "is_query", "in_from", "expect_table", "expect_alias", "cte_state", "started",
+        "open_index",
+    )
+
+    def __init__(self, is_query, open_index=None):
+        self.is_query = is_query
+        self.open_index = open_index  # token index of the "(" that opened it
+        self.in_from = False
+        self.expect_table = False
+        # Just after a FROM item, where an alias (with column list) may follow
+        self.expect_alias = False
+        # None, "name", "after_name", "as", "after_body"
+        self.cte_state = None
+        self.started = False
+
+
+def _parse(sql_text):
+    tokens = tokenize(sql_text)
+    tables = set()
+    ctes = set()
+    functions = set()
+    subqueries = []
+    statement_type = None
+
+    stack = [_Frame(is_query=True)]
+    i = 0
+    n = len(tokens)
+    while i < n:
+        tok = tokens[i]
+        frame = stack[-1]
+        word = tok.value.lower() if tok.kind == "ident" else None
+        nxt = tokens[i + 1] if i + 1 < n else None
+
+        if tok.value == "(":
+            after = tokens[i + 1].value.lower() if nxt is not None else ""
+            is_query = after in ("select", "with", "values")
+            if frame.cte_state == "as":
+                frame.cte_state = "after_body"
+            elif frame.expect_table:
+                # Derived table: the alias after ")" is not a table
+                frame.expect_table = False
+            if len(stack) == 1 and not frame.started and is_query:
+                # (SELECT ...) UNION (SELECT ...)
+                statement_type = statement_type or after
+            frame.started = True
+            stack.append(_Frame(is_query=is_query, open_index=i))
+            i += 1
+            continue
+
+        if tok.value == ")":
+            if len(stack) > 1:
+                closed = stack.pop()
+                parent = stack[-1]
+                # Derived table / function in FROM: an alias may follow
+                parent.expect_alias = parent.is_query and parent.in_from
+                if closed.is_query and i > closed.open_index + 1:
+                    inner = tokens[closed.open_index + 1 : i]
+                    subqueries.append(
+                        (
+                            inner[0].start,
+                            inner[-1].end,
+                            _digest(_normalize(inner, strip_literals=False)),
+                        )
+                    )
+            i += 1
+            continue
+
+        if tok.value == ";":
+            stack = [_Frame(is_query=True)]
+            i += 1
+            continue
+
+        if not frame.is_query:
+            if (
+                tok.kind == "ident"
+                and nxt is not None
+                and nxt.value == "("
+                and word not in _NOT_FUNCTIONS
+            ):
+                functions.add(word)
+            i += 1
+            continue
+
+        alias_pos = frame.expect_alias
+        frame.expect_alias = False
+
+        if len(stack) == 1 and not frame.started and word in _STATEMENT_KEYWORDS:
+            statement_type = word
+        if not frame.started and word == "table":
+            # TABLE name: shorthand for SELECT * FROM name
+            frame.started = True
+            frame.expect_table = True
+            i += 1
+            continue
+        frame.started = True
+
+        # --- WITH name [(cols)] AS [NOT] [MATERIALIZED] (body), ... -----
+        if word == "with" and frame.cte_state is None and not frame.in_from:
+            frame.cte_state = "name"
+            i += 1
+            continue
+        if frame.cte_state == "name":
+            if word == "recursive":
+                i += 1
+                continue
+            if tok.kind in ("ident", "qident"):
+                ctes.add(_ident_name(tok))
+                frame.cte_state = "after_name"
+            i += 1
+            continue
+        if frame.cte_state == "after_name":
+            if word == "as":
+                frame.cte_state = "as"
+            i += 1
+            continue
+        if frame.cte_state == "as":
+            # NOT / MATERIALIZED before the body
+            i += 1
+            continue
+        if frame.cte_state == "after_body":
+            if tok.value == ",":
+                frame.cte_state = "name"
+                i += 1
+                continue
+            frame.cte_state = None
+            if len(stack) == 1 and word in _STATEMENT_KEYWORDS:
+                statement_type = word
+
+        # --- table positions ---------------------------------------------
+        if word == "from":
+            prev = tokens[i - 1].value.lower() if i > 0 else ""
+            if prev == "distinct":
+                # IS [NOT] DISTINCT FROM: an operator, not a FROM clause
+                i += 1
+                continue
+            frame.in_from = True
+            frame.expect_table = True
+            i += 1
+            continue
+        prev_word = tokens[i - 1].value.lower() if i > 0 else ""
+        if word == "update" and prev_word in ("for", "do", "key"):
+            # FOR [NO KEY] UPDATE / ON CONFLICT DO UPDATE: not a table position
+            frame.expect_table = False
+            frame.in_from = False
+            i += 1
+            continue
+        if word in _JOIN_KEYWORDS or word in ("update", "into"):
+            frame.in_from = word != "into" or frame.in_from
+            # INSERT INTO t (cols): the "(" after the name is a column list
+            frame.expect_table = "into" if word == "into" else True
+            i += 1
+            continue
+        if (
+            word == "using"
+            and (frame.in_from or statement_type == "merge")
+            and nxt is not None
+            and nxt.value != "("
+        ):
+            # DELETE ... USING / MERGE ... USING: a FROM list, unlike JOIN ... USING (cols)
+            frame.in_from = True
+            frame.expect_table = True
+            i += 1
+            continue
+        if word in _CLAUSE_KEYWORDS:
+            frame.expect_table = False
+            if word not in ("on", "using"):
+                frame.in_from = False
+            i += 1
+            continue
+        if tok.value == "," and frame.in_from:
+            frame.expect_table = True
+            i += 1
+            continue
+
+        if frame.expect_table and word in _TABLE_PREFIX_KEYWORDS:
+            i += 1
+            continue
+
+        if alias_pos and not frame.expect_table and tok.kind in ("ident", "qident"):
+            # [AS] alias [(col, ...)]: the column list is not a call
+            frame.expect_alias = word == "as"
+            i += 1
+            continue
+
+        if tok.kind in ("ident", "qident"):
+            # Read a possibly schema-qualified name
+            parts = [tok]
+            j = i + 1
+            while (
+                j + 1 < n
+                and tokens[j].value == "."
+                and tokens[j + 1].kind in ("ident", "qident")
+            ):
+                parts.append(tokens[j + 1])
+                j += 2
+            is_call = (
+                j < n and tokens[j].value == "(" and frame.expect_table != "into"
+            )
+            if is_call and word not in _NOT_FUNCTIONS:
+                functions.add(".".join(_ident_name(p) for p in parts))
+            elif not is_call and frame.expect_table:
+                tables.add(".".join(_ident_name(p) for p in parts))
+                frame.expect_alias = frame.in_from
+            frame.expect_table = False
+            i = j
+            continue
+
+        i += 1
+
+    base_tables = sorted(t for t in tables if t not in ctes)
+    fingerprint = _normalize(tokens, strip_literals=True)
+    normalized = _normalize(tokens, strip_literals=False)
+    return ParsedSQL(
+        tables=tuple(base_tables),
+        ctes=tuple(sorted(ctes)),
+        functions=tuple(sorted(functions)),
+        statement_type=statement_type,
+        fingerprint=fingerprint,
+        fingerprint_hash=_digest(fingerprint),
+        normalized=normalized,
+        normalized_hash=_digest(normalized),
+        subqueries=tuple(sorted(subqueries)),
+    )
+
+
+class _LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_parse_cache = _LRUCache(PARSE_CACHE_SIZE)
+
+
+def sql_hash(sql_text: str):
+    """Hash of the exact statement text (the parse cache key)."""
+    return hashlib.blake2b(sql_text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def content_hash(sql_text: str):
+    """md5 of the exact statement text: the key of qle.sql_text (Postgres' md5() agrees)."""
+    return hashlib.md5(sql_text.encode("utf-8")).hexdigest()
+
+
+def parse_sql(sql_text: str):
+    """
+    Tokenize and scan a statement once, returning a ParsedSQL.
+
+    Handles comma joins, JOINs, schema-qualified and quoted names, subqueries
+    and CTEs (CTE names are reported separately from base tables); FROM
+    inside function calls (EXTRACT, SUBSTRING, ...) and IS DISTINCT FROM are
+    not mistaken for table positions. Results are memoized in a bounded LRU
+    keyed on the hash of the text, so replayed statements skip parsing.
+    """
+    key = sql_hash(sql_text)
+    parsed = _parse_cache.get(key)
+    if parsed is None:
+        parsed = _parse(sql_text)
+        _parse_cache.put(key, parsed)
+    return parsed
+
+
+def parse_cache_info():
+    return _parse_cache.info()
+
+
+def clear_parse_cache():
+    _parse_cache.clear()
@@ -0,0 +1,191 @@
+import contextlib
+import time
+
+import pytest
+
+from qle_cache import FunctionVolatility, ResultCache, function_name, is_cacheable
+from qle_sql import parse_sql
+
+V1 = (("t", 1, 10, 0, 0),)
+V2 = (("t", 1, 11, 0, 0),)
+
+
+def rows(n):
+    return [{"id": i} for i in range(n)]
+
+
+def test_hit_with_same_versions():
+    cache = ResultCache()
+    assert cache.put("q", V1, ["t"], rows(3), ["id"], 5)
+    entry = cache.get("q", V1)
+    assert entry.row_count == 3
+    assert entry.cols == ["id"]
+    assert cache.info()["hits"] == 1
+
+
+def test_changed_versions_drop_the_entry():
+    cache = ResultCache()
+    cache.put("q", V1, ["t"], rows(3), ["id"], 5)
+    assert cache.get("q", V2) is None
+    # The stale entry is gone, not just skipped
+    assert cache.get("q", V1) is None
+    info = cache.info()
+    assert info["stale"] == 1
+    assert info["entries"] == 0
+    assert info["rows"] == 0
+
+
+def test_invalidate_tables():
+    cache = ResultCache()
+    cache.put("a", V1, ["t"], rows(1), ["id"], 1)
+    cache.put("b", V1, ["u"], rows(1), ["id"], 1)
+    cache.invalidate_tables(["t"])
+    assert cache.get("a", V1) is None
+    assert cache.get("b", V1) is not None
+
+
+def test_oversized_results_are_not_cached():
+    cache = ResultCache(max_entry_rows=2)
+    assert not cache.put("q", V1, ["t"], rows(3), ["id"], 5)
+    assert cache.get("q", V1) is None
+
+
+def test_entry_limit_evicts_cheapest_of_least_recent():
+    cache = ResultCache(max_entries=2, eviction_sample=2)
+    cache.put("expensive", V1, ["t"], rows(1), ["id"], 1000)
+    cache.put("cheap", V1, ["t"], rows(1), ["id"], 1)
+    cache.put("new", V1, ["t"], rows(1), ["id"], 1)
+    assert cache.get("cheap", V1) is None
+    assert cache.get("expensive", V1) is not None
+    assert cache.get("new", V1) is not None
+    assert cache.info()["evictions"] == 1
+
+
+def test_eviction_only_samples_least_recently_used():
+    cache = ResultCache(max_entries=2, eviction_sample=1)
+    cache.put("old", V1, ["t"], rows(1), ["id"], 1000)
+    cache.put("cheap", V1, ["t"], rows(1), ["id"], 1)
+    cache.put("new", V1, ["t"], rows(1), ["id"], 1)
+    # Only the least recent entry is a candidate, however expensive
+    assert cache.get("old", V1) is None
+    assert cache.get("cheap", V1) is not None
+
+
+def test_row_limit_keeps_the_new_entry():
+    cache = ResultCache(max_rows=5)
+    cache.put("a", V1, ["t"], rows(3), ["id"], 1)
+    cache.put("b", V1, ["t"], rows(4), ["id"], 1)
+    assert cache.get("a", V1) is None
+    assert cache.get("b", V1) is not None
+    assert cache.info()["rows"] == 4
+
+
+def test_replacing_a_key_keeps_row_count_right():
+    cache = ResultCache()
+    cache.put("q", V1, ["t"], rows(3), ["id"], 1)
+    cache.put("q", V2, ["t"], rows(2), ["id"], 1)
+    assert cache.info()["rows"] == 2
+    assert cache.get("q", V2).row_count == 2
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("random", "random"),
+        ("RANDOM", "random"),
+        ("pg_catalog.random", "random"),
+        ('"MySchema"."Random"', "random"),
+        ('public."my_func"', "my_func"),
+    ],
+)
+def test_function_name(name, expected):
+    assert function_name(name) == expected
+
+
+@pytest.mark.parametrize(
+    "sql, cacheable",
+    [
+        ("SELECT a FROM t WHERE b = 1", True),
+        ("SELECT random() FROM t", False),
+        ("SELECT pg_catalog.now() FROM t", False),
+        ("SELECT a FROM t WHERE d < current_date", False),
+        ("SELECT a FROM t TABLESAMPLE system (10)", False),
+        ("SELECT a FROM t TABLESAMPLE system (10) REPEATABLE (42)", True),
+        ("SELECT a FROM t FOR UPDATE", False),
+        ("SELECT a INTO u FROM t", False),
+        ("SELECT 1", False),  # reads no table
+        ("UPDATE t SET a = 1", False),
+    ],
+)
+def test_is_cacheable(sql, cacheable):
+    assert is_cacheable(parse_sql(sql)) is cacheable
+
+
+class StubConn:
+    """Answers the pg_proc lookup from `catalog` (name -> [provolatile, ...])."""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.lookups = []
+
+    @contextlib.contextmanager
+    def cursor(self):
+        yield self
+
+    def execute(self, sql, params):
+        (names,) = params
+        self.lookups.append(list(names))
+        self._rows = [
+            (n, any(v == "v" for v in self.catalog[n]) if n in self.catalog else None)
+            for n in names
+        ]
+
+    def fetchall(self):
+        return self._rows
+
+
+CATALOG = {"lower": ["i"], "my_stable": ["s"], "my_random": ["i", "v"]}
+
+
+@pytest.mark.parametrize(
+    "functions, volatile",
+    [
+        ((), False),
+        (("lower",), False),
+        (("pg_catalog.lower", "my_stable"), False),
+        (("my_random",), True),  # one volatile overload is enough
+        (("no_such_function",), True),
+        # Special forms aren't in pg_proc but aren't volatile either
+        (("cast", "coalesce", "decimal", "greatest", "least", "nullif", "system"), False),
+        # ... unless schema-qualified, which makes them ordinary functions
+        (("myschema.coalesce",), True),
+    ],
+)
+def test_calls_volatile(functions, volatile):
+    conn = StubConn(CATALOG)
+    assert FunctionVolatility().calls_volatile(conn, functions) is volatile
+
+
+def test_special_forms_are_not_looked_up():
+    conn = StubConn(CATALOG)
+    FunctionVolatility().calls_volatile(conn, ("coalesce", "lower"))
+    assert conn.lookups == [["lower"]]
+
+
+def test_volatility_is_remembered_until_ttl_or_clear():
+    conn = StubConn(CATALOG)
+    volatility = FunctionVolatility(ttl=60)
+    assert not volatility.calls_volatile(conn, ("my_stable",))
+    conn.catalog = {"my_stable": ["v"]}
+    assert not volatility.calls_volatile(conn, ("my_stable",))
+    assert len(conn.lookups) == 1
+
+    volatility.clear()
+    assert volatility.calls_volatile(conn, ("my_stable",))
+
+    volatility = FunctionVolatility(ttl=0)
+    conn.catalog = CATALOG
+    assert not volatility.calls_volatile(conn, ("my_stable",))
+    time.sleep(0.01)
+    conn.catalog = {"my_stable": ["v"]}
+    assert volatility.calls_volatile(conn, ("my_stable",))
@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from qle_lsh import LSHIndex, MinHasher, choose_bands, shingles, similarity  # noqa: E402
+
+
+@pytest.mark.parametrize("threshold", [0.3, 0.5, 0.7, 0.9])
+@pytest.mark.parametrize("num_perm", [64, 128, 256])
+def test_choose_bands_fits_and_centres_on_threshold(threshold, num_perm):
+    bands, rows = choose_bands(threshold, num_perm)
+    assert bands * rows <= num_perm
+    midpoint = (1.0 / bands) ** (1.0 / rows)
+    assert abs(midpoint - threshold) < 0.05
+
+
+def test_choose_bands_default_config():
+    assert choose_bands(0.7, 128) == (16, 8)
+
+
+def test_stricter_threshold_means_longer_bands():
+    rows = [choose_bands(t, 128)[1] for t in (0.3, 0.5, 0.7, 0.9)]
+    assert rows == sorted(rows)
+
+
+def test_shingles_ignore_literals_and_case():
+    assert shingles("SELECT * FROM t WHERE id = 1") == shingles("select * from T where id = 99;")
+
+
+def test_identical_statements_have_similarity_one():
+    hasher = MinHasher()
+    sig = hasher.signature_of("SELECT a FROM t WHERE b > 3")
+    assert similarity(sig, hasher.signature_of("SELECT a FROM t WHERE b > 3")) == 1.0
+
+
+@pytest.mark.parametrize("overlap", [0, 250, 500, 750])
+def test_similarity_estimates_jaccard(overlap):
+    hasher = MinHasher(num_perm=256)
+    a = set(range(1000))
+    b = set(range(1000 - overlap, 2000 - overlap))
+    jaccard = len(a & b) / len(a | b)
+    estimate = similarity(hasher.signature(a), hasher.signature(b))
+    # Standard error is sqrt(J (1 - J) / num_perm) <= 0.032
+    assert abs(estimate - jaccard) < 0.13
+
+
+def test_empty_shingle_set():
+    hasher = MinHasher(num_perm=16)
+    assert similarity(hasher.signature(set()), hasher.signature(set())) == 1.0
+
+
+def test_index_finds_near_duplicates_only():
+    hasher = MinHasher()
+    index = LSHIndex(threshold=0.5)
+    base = (
+        "SELECT t.title, t.year FROM title t "
+        "JOIN movie_info mi ON mi.movie_id = t.id WHERE t.year > 2000"
+    )
+    index.add(1, hasher.signature_of(base))
+    index.add(2, hasher.signature_of("SELECT name FROM person WHERE gender = 'f' ORDER BY name"))
+    found = index.similar(hasher.signature_of(base + " AND mi.info_type_id = 3"))
+    assert [key for key, _ in found] == [1]
+    assert index.similar(hasher.signature_of(base), accept=lambda key: key != 1) == []
+
+
+def test_index_evicts_oldest_and_removes():
+    hasher = MinHasher(num_perm=32)
+    index = LSHIndex(threshold=0.5, num_perm=32, max_entries=2)
+    for key in (1, 2, 3):
+        index.add(key, hasher.signature_of(f"SELECT * FROM t{key}"))
+    assert index.keys() == [2, 3]
+    assert index.info()["evictions"] == 1
+    index.remove(2)
+    assert 2 not in index
+    assert index.signature(2) is None
+    assert len(index) == 1
+
+
+def test_threshold_is_validated():
+    with pytest.raises(ValueError):
+        LSHIndex(threshold=0)
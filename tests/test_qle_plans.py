@@ -0,0 +1,126 @@
+import qle_plans
+
+
+def scan(node_type, relation, rows, actual, index=None, loops=1):
+    node = {
+        "Node Type": node_type,
+        "Relation Name": relation,
+        "Plan Rows": rows,
+        "Actual Rows": actual,
+        "Actual Loops": loops,
+    }
+    if index:
+        node["Index Name"] = index
+    return node
+
+
+def plan(top, execution_ms, hit=0, read=0):
+    top = dict(top, **{"Shared Hit Blocks": hit, "Shared Read Blocks": read})
+    return [{"Plan": top, "Planning Time": 0.1, "Execution Time": execution_ms}]
+
+
+PARENT = plan(
+    {
+        "Node Type": "Nested Loop",
+        "Plan Rows": 10,
+        "Actual Rows": 10,
+        "Actual Loops": 1,
+        "Total Cost": 100.0,
+        "Plans": [
+            scan("Seq Scan", "movie_info", 10, 10),
+            scan("Index Scan", "title", 1, 1, index="title_pkey", loops=10),
+        ],
+    },
+    execution_ms=2.0,
+    hit=50,
+    read=5,
+)
+
+CHILD = plan(
+    {
+        "Node Type": "Hash Join",
+        "Plan Rows": 10,
+        "Actual Rows": 5000,
+        "Actual Loops": 1,
+        "Total Cost": 900.0,
+        "Plans": [
+            scan("Seq Scan", "movie_info", 10, 5000),
+            {
+                "Node Type": "Hash",
+                "Plan Rows": 1000,
+                "Actual Rows": 1000,
+                "Actual Loops": 1,
+                "Plans": [scan("Seq Scan", "title", 1000, 1000)],
+            },
+        ],
+    },
+    execution_ms=8.0,
+    hit=60,
+    read=400,
+)
+
+
+def test_walk_is_depth_first_with_paths():
+    paths = [(path, qle_plans.node_label(node)) for path, node in qle_plans.walk(CHILD)]
+    assert paths == [
+        ((), "Hash Join"),
+        ((0,), "Seq Scan on movie_info"),
+        ((1,), "Hash"),
+        ((1, 0), "Seq Scan on title"),
+    ]
+
+
+def test_estimate_error_accounts_for_loops():
+    node = scan("Index Scan", "title", 1, 2, loops=10)
+    assert qle_plans.estimate_error(node) == 2.0
+    # Zero rows on either side is floored at one row
+    assert qle_plans.estimate_error(scan("Seq Scan", "t", 0, 0)) == 1.0
+
+
+def test_summarize():
+    summary = qle_plans.summarize(PARENT)
+    assert summary["execution_ms"] == 2.0
+    assert summary["total_cost"] == 100.0
+    assert summary["shared_read_blocks"] == 5
+    assert summary["node_types"] == {"Nested Loop": 1, "Seq Scan": 1, "Index Scan": 1}
+    assert summary["access_paths"] == {"movie_info": ["Seq Scan"], "title": ["Index Scan"]}
+
+
+def test_worst_estimates_first():
+    worst = qle_plans.summarize(CHILD)["worst_estimates"]
+    assert worst[0]["q_error"] == 500.0
+    assert [e["path"] for e in worst[:2]] == [[], [0]]
+
+
+def test_diff_reports_plan_changes():
+    d = qle_plans.diff(PARENT, CHILD)
+    assert d["slowdown"] == 4.0
+    assert d["node_types"] == {
+        "Nested Loop": {"parent": 1, "child": 0},
+        "Hash Join": {"parent": 0, "child": 1},
+        "Index Scan": {"parent": 1, "child": 0},
+        "Hash": {"parent": 0, "child": 1},
+        "Seq Scan": {"parent": 1, "child": 2},
+    }
+    assert d["access_paths"] == [
+        {"relation": "title", "parent": ["Index Scan"], "child": ["Seq Scan"]}
+    ]
+    assert d["changed_nodes"] == [
+        {"path": [], "parent": "Nested Loop", "child": "Hash Join"},
+        {"path": [1], "parent": "Index Scan on title (title_pkey)", "child": "Hash"},
+        {"path": [1, 0], "parent": None, "child": "Seq Scan on title"},
+    ]
+    assert d["buffers"]["shared_read_blocks"] == {"parent": 5, "child": 400, "delta": 395}
+
+
+def test_diff_of_identical_plans_is_empty():
+    d = qle_plans.diff(PARENT, PARENT)
+    assert d["slowdown"] == 1.0
+    assert d["node_types"] == {}
+    assert d["access_paths"] == []
+    assert d["changed_nodes"] == []
+
+
+def test_slowdown_without_parent_timing():
+    parent = [dict(PARENT[0], **{"Execution Time": None})]
+    assert qle_plans.diff(parent, CHILD)["slowdown"] is None
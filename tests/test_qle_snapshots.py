@@ -0,0 +1,56 @@
+import uuid
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from qle_columnar import ColumnarResult  # noqa: E402
+from qle_snapshots import SnapshotStore  # noqa: E402
+
+
+def _round_trip(tmp_path, rows, cols):
+    store = SnapshotStore(str(tmp_path))
+    size = store.write(1, iter([ColumnarResult.from_rows(rows, cols)]))
+    if size is None:
+        return None
+    return list(store.open(1).rows(0, len(rows)))
+
+
+def test_object_columns_keep_their_types(tmp_path):
+    row = (
+        "naïve text",
+        b"\x00\xffbytes",
+        {"a": [1, 2], "b": None},
+        Decimal("12.3400"),
+        True,
+        42,
+        0.1,
+        datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc),
+        date(2024, 5, 1),
+        time(23, 59, 1),
+        timedelta(days=-3, seconds=5, microseconds=7),
+        uuid.UUID("12345678-1234-5678-1234-567812345678"),
+    )
+    cols = [f"c{j}" for j in range(len(row))]
+    rows = _round_trip(tmp_path, [row, (None,) * len(row)], cols)
+    assert rows == [dict(zip(cols, row)), dict.fromkeys(cols)]
+
+
+def test_memoryview_comes_back_as_bytes(tmp_path):
+    rows = _round_trip(tmp_path, [(memoryview(b"abc"),)], ["b"])
+    assert rows == [{"b": b"abc"}]
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        [object()],  # no encoding at all
+        ["text", 1],  # mixed types in one column
+        [{"n": Decimal("1")}],  # a document json can't represent
+    ],
+)
+def test_unsupported_values_are_not_snapshotted(tmp_path, values):
+    assert _round_trip(tmp_path, [(v,) for v in values], ["x"]) is None
+    assert SnapshotStore(str(tmp_path)).info()["snapshots"] == 0
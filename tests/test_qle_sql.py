@@ -0,0 +1,113 @@
+import pytest
+
+from qle_sql import content_hash, parse_sql, tokenize
+
+
+@pytest.mark.parametrize(
+    "sql, tables",
+    [
+        ("SELECT * FROM title", ("title",)),
+        ("SELECT * FROM a, b WHERE a.id = b.id", ("a", "b")),
+        ("SELECT * FROM a JOIN public.b ON a.id = b.id", ("a", "public.b")),
+        ('SELECT * FROM "Mixed Case" m', ('"Mixed Case"',)),
+        ("SELECT * FROM a LEFT JOIN b USING (id)", ("a", "b")),
+        ("INSERT INTO t (a, b) SELECT a, b FROM s", ("s", "t")),
+        ("UPDATE t SET a = 1 FROM s WHERE t.id = s.id", ("s", "t")),
+        ("SELECT extract(year FROM ts) FROM events", ("events",)),
+        ("SELECT * FROM a WHERE x IS DISTINCT FROM y", ("a",)),
+        ("SELECT * FROM a FOR UPDATE", ("a",)),
+    ],
+)
+def test_tables(sql, tables):
+    assert parse_sql(sql).tables == tables
+
+
+def test_table_statement():
+    parsed = parse_sql("TABLE title")
+    assert parsed.tables == ("title",)
+    assert parsed.statement_type == "table"
+    assert parse_sql("TABLE public.title;").tables == ("public.title",)
+
+
+def test_delete_using_list():
+    parsed = parse_sql("DELETE FROM foo USING bar, baz WHERE foo.id = bar.id")
+    assert parsed.tables == ("bar", "baz", "foo")
+    assert parsed.statement_type == "delete"
+
+
+def test_merge_using_source():
+    assert parse_sql(
+        "MERGE INTO t USING s ON t.id = s.id WHEN MATCHED THEN DELETE"
+    ).tables == ("s", "t")
+    assert parse_sql(
+        "MERGE INTO t USING (SELECT * FROM u) s ON t.id = s.id WHEN MATCHED THEN DELETE"
+    ).tables == ("t", "u")
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * FROM t1 t (a, b)",
+        "SELECT * FROM t1 AS t (a, b)",
+        "SELECT * FROM (SELECT 1, 2) AS t (a, b)",
+        "SELECT * FROM generate_series(1, 3) t (a)",
+    ],
+)
+def test_column_alias_list_is_not_a_call(sql):
+    assert "t" not in parse_sql(sql).functions
+
+
+def test_functions():
+    parsed = parse_sql(
+        "SELECT count(*) FROM a JOIN b ON f(a.x) = b.y "
+        "WHERE pg_catalog.lower(b.z) = 'q' AND a.v IN (1, 2)"
+    )
+    assert parsed.functions == ("count", "f", "pg_catalog.lower")
+    assert parsed.tables == ("a", "b")
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT DISTINCT(a) FROM t ORDER BY (a) LIMIT (5) OFFSET (1)",
+        "SELECT CASE WHEN (a > 1) THEN (1) ELSE (2) END FROM t WHERE a BETWEEN (1) AND (2)",
+        "SELECT a FROM t WHERE a LIKE (b) OR a IS DISTINCT FROM (b)",
+        "SELECT a FROM t GROUP BY GROUPING SETS ((a), ())",
+    ],
+)
+def test_keywords_before_parentheses_are_not_calls(sql):
+    assert parse_sql(sql).functions == ()
+
+
+def test_ctes_are_not_tables():
+    parsed = parse_sql(
+        "WITH recent AS (SELECT * FROM title WHERE y > 2000), "
+        "top AS MATERIALIZED (SELECT * FROM recent) SELECT * FROM top"
+    )
+    assert parsed.ctes == ("recent", "top")
+    assert parsed.tables == ("title",)
+    assert parsed.statement_type == "select"  # the statement after the CTEs
+
+
+def test_fingerprint_ignores_literals_and_case():
+    a = parse_sql("SELECT * FROM t WHERE id = 1")
+    b = parse_sql("select *   from T where id = 42;")
+    assert a.fingerprint_hash == b.fingerprint_hash
+    assert a.normalized_hash != b.normalized_hash
+
+
+def test_subquery_spans():
+    sql = "SELECT * FROM (SELECT id FROM t WHERE x = 1) s"
+    parsed = parse_sql(sql)
+    ((start, end, h),) = parsed.subqueries
+    assert sql[start:end] == "SELECT id FROM t WHERE x = 1"
+    assert h == parse_sql("select id from t where x = 1").normalized_hash
+
+
+def test_tokenize_skips_comments_and_keeps_dollar_strings():
+    tokens = tokenize("SELECT $q$ -- not a comment $q$ -- a comment\nFROM t")
+    assert [t.kind for t in tokens] == ["ident", "string", "ident", "ident"]
+
+
+def test_content_hash_is_md5():
+    assert content_hash("") == "d41d8cd98f00b204e9800998ecf8427e"